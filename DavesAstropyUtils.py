@@ -16,6 +16,13 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import abc
+import gzip
+import io
+import json
+import os
+import shutil
+
 __author__ = "Dave Strickland"
 __copyright__ = "Copyright 2018, Dave Strickland"
 __date__ = "2018/02/23"
@@ -24,94 +31,128 @@ __email__ =  "dave.strickland@gmail.com"
 __license__ = "GPLv3"
 __version__ = "0.2.0"
 
+# Greek alphabet mapping from https://gist.github.com/beniwohli/765262
+GREEK_ALPHABET = {
+    u'\u0391': 'Alpha',
+    u'\u0392': 'Beta',
+    u'\u0393': 'Gamma',
+    u'\u0394': 'Delta',
+    u'\u0395': 'Epsilon',
+    u'\u0396': 'Zeta',
+    u'\u0397': 'Eta',
+    u'\u0398': 'Theta',
+    u'\u0399': 'Iota',
+    u'\u039A': 'Kappa',
+    u'\u039B': 'Lamda',
+    u'\u039C': 'Mu',
+    u'\u039D': 'Nu',
+    u'\u039E': 'Xi',
+    u'\u039F': 'Omicron',
+    u'\u03A0': 'Pi',
+    u'\u03A1': 'Rho',
+    u'\u03A3': 'Sigma',
+    u'\u03A4': 'Tau',
+    u'\u03A5': 'Upsilon',
+    u'\u03A6': 'Phi',
+    u'\u03A7': 'Chi',
+    u'\u03A8': 'Psi',
+    u'\u03A9': 'Omega',
+    u'\u03B1': 'alpha',
+    u'\u03B2': 'beta',
+    u'\u03B3': 'gamma',
+    u'\u03B4': 'delta',
+    u'\u03B5': 'epsilon',
+    u'\u03B6': 'zeta',
+    u'\u03B7': 'eta',
+    u'\u03B8': 'theta',
+    u'\u03B9': 'iota',
+    u'\u03BA': 'kappa',
+    u'\u03BB': 'lamda',
+    u'\u03BC': 'mu',
+    u'\u03BD': 'nu',
+    u'\u03BE': 'xi',
+    u'\u03BF': 'omicron',
+    u'\u03C0': 'pi',
+    u'\u03C1': 'rho',
+    u'\u03C3': 'sigma',
+    u'\u03C4': 'tau',
+    u'\u03C5': 'upsilon',
+    u'\u03C6': 'phi',
+    u'\u03C7': 'chi',
+    u'\u03C8': 'psi',
+    u'\u03C9': 'omega'}
+
+# Unicode characters Simbad can't handle, and the ASCII to use instead.
+# These are mostly look-alikes of ASCII quotes, dashes and spaces that
+# turn up in names copied from web pages. Invisible characters are
+# removed.
+TRICKY_UNICODE = {
+    u'\u2018': "'",    # U+2018 single left quote
+    u'\u2019': "'",    # U+2019 single right quote
+    u'\u201A': "'",    # U+201A single low-9 quote
+    u'\u201B': "'",    # U+201B single high-reversed-9 quote
+    u'\u2032': "'",    # U+2032 prime
+    u'\u00B4': "'",    # U+00B4 acute accent
+    u'\u02BC': "'",    # U+02BC modifier letter apostrophe
+    u'\u201C': '"',    # U+201C double left quote
+    u'\u201D': '"',    # U+201D double right quote
+    u'\u201E': '"',    # U+201E double low-9 quote
+    u'\u2033': '"',    # U+2033 double prime
+    u'\u2010': '-',    # U+2010 hyphen
+    u'\u2011': '-',    # U+2011 non-breaking hyphen
+    u'\u2012': '-',    # U+2012 figure dash
+    u'\u2013': '-',    # U+2013 en dash
+    u'\u2014': '-',    # U+2014 em dash
+    u'\u2015': '-',    # U+2015 horizontal bar
+    u'\u2212': '-',    # U+2212 minus sign
+    u'\uFF0D': '-',    # U+FF0D fullwidth hyphen-minus
+    u'\uFF0B': '+',    # U+FF0B fullwidth plus sign
+    u'\u00A0': ' ',    # U+00A0 no-break space
+    u'\u2007': ' ',    # U+2007 figure space
+    u'\u2009': ' ',    # U+2009 thin space
+    u'\u200A': ' ',    # U+200A hair space
+    u'\u202F': ' ',    # U+202F narrow no-break space
+    u'\u3000': ' ',    # U+3000 ideographic space
+    u'\u200B': None,   # U+200B zero width space
+    u'\u200C': None,   # U+200C zero width non-joiner
+    u'\u200D': None,   # U+200D zero width joiner
+    u'\u2060': None,   # U+2060 word joiner
+    u'\uFEFF': None,   # U+FEFF zero width no-break space (BOM)
+    u'\u00AD': None,   # U+00AD soft hyphen
+    u'\u00B5': 'mu',   # U+00B5 micro sign, often used for greek mu
+    u'\u03C2': 'sigma',    # U+03C2 greek final sigma
+    u'\u03D1': 'theta',    # U+03D1 greek theta symbol
+    u'\u03D5': 'phi',      # U+03D5 greek phi symbol
+    u'\u03D6': 'pi',       # U+03D6 greek pi symbol
+    }
+
+# Translation table for str.translate, built once, that makes both sets
+# of replacements in a single pass over a string
+UNICODE_TRANSLATION = str.maketrans({**GREEK_ALPHABET, **TRICKY_UNICODE})
+
 def convert_greek_unicode_symbol(anInputStr):
     """Replaces unicode greek symbols with the ASCII textual name 
     of that symbol.
     
     Also replaces some problematic unicode characters that are not
-    recognized by the Simbad ID service. Note that unicode characters
+    recognized by the Simbad ID service, listed in TRICKY_UNICODE.
+    Note that unicode characters
     and their hex codes can be looked up on the web, e.g. at
     https://www.fileformat.info/info/unicode/char/search.htm or
     https://unicodelookup.com/, if you know what you're looking 
     for. To find what unicode character is
     in some text use http://www.babelstone.co.uk/Unicode/whatisit.html
     """
-    # Greek alphabet mapping from https://gist.github.com/beniwohli/765262
-    greek_alphabet = {
-        u'\u0391': 'Alpha',
-        u'\u0392': 'Beta',
-        u'\u0393': 'Gamma',
-        u'\u0394': 'Delta',
-        u'\u0395': 'Epsilon',
-        u'\u0396': 'Zeta',
-        u'\u0397': 'Eta',
-        u'\u0398': 'Theta',
-        u'\u0399': 'Iota',
-        u'\u039A': 'Kappa',
-        u'\u039B': 'Lamda',
-        u'\u039C': 'Mu',
-        u'\u039D': 'Nu',
-        u'\u039E': 'Xi',
-        u'\u039F': 'Omicron',
-        u'\u03A0': 'Pi',
-        u'\u03A1': 'Rho',
-        u'\u03A3': 'Sigma',
-        u'\u03A4': 'Tau',
-        u'\u03A5': 'Upsilon',
-        u'\u03A6': 'Phi',
-        u'\u03A7': 'Chi',
-        u'\u03A8': 'Psi',
-        u'\u03A9': 'Omega',
-        u'\u03B1': 'alpha',
-        u'\u03B2': 'beta',
-        u'\u03B3': 'gamma',
-        u'\u03B4': 'delta',
-        u'\u03B5': 'epsilon',
-        u'\u03B6': 'zeta',
-        u'\u03B7': 'eta',
-        u'\u03B8': 'theta',
-        u'\u03B9': 'iota',
-        u'\u03BA': 'kappa',
-        u'\u03BB': 'lamda',
-        u'\u03BC': 'mu',
-        u'\u03BD': 'nu',
-        u'\u03BE': 'xi',
-        u'\u03BF': 'omicron',
-        u'\u03C0': 'pi',
-        u'\u03C1': 'rho',
-        u'\u03C3': 'sigma',
-        u'\u03C4': 'tau',
-        u'\u03C5': 'upsilon',
-        u'\u03C6': 'phi',
-        u'\u03C7': 'chi',
-        u'\u03C8': 'psi',
-        u'\u03C9': 'omega'}
-    
-    # Unicode characters Simbad can't handle
-    tricky_unicode = {
-        u'\u2019': "'"    # U+2019 single right quote
-        }
-    
-    # iterate over input string character by character
-    outputList = []
-    for c in anInputStr:
-        if c in greek_alphabet:
-            out = greek_alphabet[c]
-            #print('found {} in alphabet, replace with {}'.format(c, out))
-            outputList.append(out)
-        elif c in tricky_unicode:
-            out = tricky_unicode[c]
-            outputList.append(out)
-        else:
-            outputList.append(c)
-    outputStr = ''.join(outputList).strip()
-    return outputStr
+    return anInputStr.translate(UNICODE_TRANSLATION).strip()
 
-def read_table(input_file, p_verbose=False):
+def read_table(input_file, p_verbose=False, columns=None):
     """Attempts to read the file into an astropy Table object.
 
     This function attempts to determine the file type based on the file
     name, and then calls the correct reader function.
+
+    If a list of column names is given only those columns are returned.
+    FITS files are memory-mapped so the other columns are never loaded.
     """
     import sys
     import os.path
@@ -122,15 +163,20 @@ def read_table(input_file, p_verbose=False):
         sys.exit(3)
     
     try:
-        if 'txt' in input_file or 'csv' in input_file:
+        if '.ecsv' in input_file:
+            from astropy.table import Table
+            p_data = Table.read(input_file, format='ascii.ecsv')
+        elif 'txt' in input_file or 'csv' in input_file:
             p_data = read_ascii(input_file, p_verbose)
         elif 'html' in input_file:
             p_data = read_html(input_file, p_verbose)
         elif 'fits' in input_file:
-            p_data = read_fits(input_file, p_verbose)
+            p_data = read_fits(input_file, p_verbose, columns)
         else:
             print('Error: Unexpected file format for input file {}'.format(input_file))
             sys.exit(1)
+        if columns is not None:
+            p_data.keep_columns(columns)
     except:
         print('Error: Failed to correctly read {}'.format(input_file))
         sys.exit(2)
@@ -167,17 +213,58 @@ def read_html(input_html_table, p_verbose=False):
         print(p_data.info)
     return p_data
 
-def read_fits(input_html_table, p_verbose=False):
-    """Reads data from a FITS or gzipped FITS file, returning an astropy Tables object"""
-    from astropy.table import Table
+def read_fits(input_html_table, p_verbose=False, columns=None):
+    """Reads data from a FITS or gzipped FITS file, returning an astropy Tables object
+
+    If a list of column names is given then only those columns are
+    kept. The file is then memory-mapped, so that the other columns are
+    never copied into memory or converted into table columns.
+    """
+    import numpy as np
+    from astropy.table import Table, MaskedColumn
     if p_verbose:
         print('Reading data table from {}'.format(input_html_table))
-    p_data = Table.read(input_html_table, 
-        format='fits')
+    if columns is None:
+        p_data = Table.read(input_html_table, 
+            format='fits')
+    else:
+        p_data = Table.read(input_html_table, 
+            format='fits', memmap=True)
+        p_data.keep_columns(columns)
+        # Table.read doesn't mask invalid values in memory-mapped files,
+        # so mask NaNs and empty strings in the selected columns here.
+        for name in columns:
+            col = p_data[name]
+            if hasattr(col, 'mask'):
+                continue
+            if col.dtype.kind == 'f':
+                invalid = np.isnan(col)
+            elif col.dtype.kind in ['S', 'U']:
+                invalid = np.char.str_len(col) == 0
+            else:
+                continue
+            if np.any(invalid):
+                p_data.replace_column(name, MaskedColumn(col, mask=invalid, copy=False))
     if p_verbose:
         print(p_data.info)
     return p_data
 
+def read_fits_column_names(input_fits_file):
+    """Returns the list of column names in the first table HDU of
+    a FITS or gzipped FITS file, without reading the table data.
+    """
+    from astropy.io import fits
+    with fits.open(input_fits_file, memmap=True) as hdu_list:
+        return list(first_table_hdu(hdu_list).columns.names)
+
+def first_table_hdu(hdu_list):
+    """Returns the first binary or ASCII table HDU in a FITS HDUList"""
+    from astropy.io import fits
+    for hdu in hdu_list:
+        if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)):
+            return hdu
+    raise ValueError('No table HDU found in FITS file')
+
 def write_table(atable, an_output_file, a_css_style):
     """Writes the astropy Table to disk using a format determined
     from the file name itself.
@@ -186,13 +273,21 @@ def write_table(atable, an_output_file, a_css_style):
         write_to_fits(atable, an_output_file)
     elif '.html' in an_output_file:
         write_to_html(atable, an_output_file, a_css_style)
+    elif '.ecsv' in an_output_file:
+        atable.write(an_output_file, format='ascii.ecsv', overwrite=True)
+    elif '.csv' in an_output_file:
+        atable.write(an_output_file, format='ascii.csv', overwrite=True)
     else:
-        print('Error: Unexpected file format for output table')
-        print('  File name: {}'.format(an_output_file))
-        print('  Expecting file name suffix to include either "fits" or "html"')
+        print_unexpected_format(an_output_file)
         print('  Nothing will be written now...')
     return
 
+def print_unexpected_format(an_output_file):
+    print('Error: Unexpected file format for output table')
+    print('  File name: {}'.format(an_output_file))
+    print('  Expecting file name suffix to include "fits", "html", "ecsv" or "csv"')
+    return
+
 def write_to_fits(atable, an_output_file):
     """Write an astropy table to a fits file
     """
@@ -201,7 +296,21 @@ def write_to_fits(atable, an_output_file):
 
 def write_to_html(atable, an_output_file, a_css_style=None):
     """Writes out an astropy Table to HTML while applying a CSS style to it."""
-    from astropy.table import Table
+    p_html_dict = make_html_dict(a_css_style)
+    p_style = p_html_dict['table_class']
+
+    # For some reason the include_names and exclude_names options listed
+    # in the astropy documentation don't work.
+    atable.write(an_output_file, 
+        format='ascii.html', 
+        overwrite=True, 
+        htmldict=p_html_dict)
+    print('Wrote formatted table to {} using CSS style {}'.format(an_output_file, p_style))
+    return
+
+def make_html_dict(a_css_style=None):
+    """Returns the htmldict for astropy's HTML writer that applies the
+    table style in the CSS file a_css_style to the table."""
     if a_css_style is None:
         a_css_style = 'darkTable.css'
     # This reads the css and applies it within the table
@@ -215,16 +324,500 @@ def write_to_html(atable, an_output_file, a_css_style=None):
 
     p_html_dict = {'css': p_css_str,
         'table_class': p_style}
+    return p_html_dict
 
-    # For some reason the include_names and exclude_names options listed
-    # in the astropy documentation don't work.
-    atable.write(an_output_file, 
-        format='ascii.html', 
-        overwrite=True, 
-        htmldict=p_html_dict)
-    print('Wrote formatted table to {} using CSS style {}'.format(an_output_file, p_style))
+def open_table_writer(an_output_file, a_css_style=None):
+    """Returns a TableWriter that writes astropy Tables to disk a batch
+    of rows at a time, using a format determined from the file name
+    itself as write_table does. Any other file name, e.g. out.fit, is
+    written as FITS.
+    """
+    if '.fits' in an_output_file:
+        return FitsTableWriter(an_output_file)
+    elif '.html' in an_output_file:
+        return HtmlTableWriter(an_output_file, a_css_style)
+    elif '.ecsv' in an_output_file:
+        return TextTableWriter(an_output_file, 'ascii.ecsv')
+    elif '.csv' in an_output_file:
+        return TextTableWriter(an_output_file, 'ascii.csv')
+    print('Warning: Writing {} as FITS, as its name does not include "fits",'.format(an_output_file)+
+        ' "html", "ecsv" or "csv"')
+    return FitsTableWriter(an_output_file)
+
+class TableWriter(abc.ABC):
+    """Writes an astropy Table to disk a batch of rows at a time, so
+    the whole table never has to be held in memory.
+
+    The columns are fixed by the first batch with any rows. The columns
+    of later batches are converted to the same types, except that string
+    columns are widened to fit longer strings. The file is a complete
+    table after each batch, so partial results can be looked at while
+    a long run is still going.
+
+    Subclasses implement write_batch and close_file.
+    """
+    def __init__(self, an_output_file):
+        self.output_file = an_output_file
+        self.num_rows = 0
+        self.dtypes = None
+        # The last empty batch written before any rows
+        self.empty_table = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, atable):
+        """Appends the rows of the astropy Table atable"""
+        if self.dtypes is None and len(atable) == 0:
+            # The columns of an empty table may not have the types of
+            # the rows to come, e.g. a column made from an empty list is
+            # float, so wait for some rows before fixing the types.
+            self.empty_table = atable
+            return
+        self.write_batch(self.conform(atable))
+        self.num_rows += len(atable)
+        return
+
+    def conform(self, atable):
+        """Returns atable with the column types of the first batch,
+        widening the string columns of both if necessary"""
+        import numpy as np
+        from astropy.table import Table
+        if self.dtypes is None:
+            self.dtypes = [(name, atable[name].dtype) for name in atable.colnames]
+            return atable
+        if atable.colnames != [name for name, dtype in self.dtypes]:
+            raise ValueError('Columns {} do not match those of the first batch written to {}'.format(atable.colnames,
+                self.output_file))
+        # Don't modify the caller's table
+        atable = Table(atable, copy=False)
+        for num, (name, dtype) in enumerate(self.dtypes):
+            if atable[name].dtype == dtype:
+                continue
+            p_reset_fill = False
+            if dtype.kind in 'SU' and atable[name].dtype.kind in 'SU':
+                dtype = np.promote_types(dtype, atable[name].dtype)
+                self.dtypes[num] = (name, dtype)
+                if hasattr(atable[name], 'mask'):
+                    # The default fill value of a narrow column is cut
+                    # short (e.g. 'N' for 'N/A'), and would be written
+                    # out in place of '' once the column is widened
+                    p_default = np.ma.default_fill_value(atable[name].dtype)
+                    p_reset_fill = atable[name].fill_value in (p_default,
+                        np.array(p_default, dtype=atable[name].dtype)[()])
+            atable[name] = atable[name].astype(dtype)
+            if p_reset_fill:
+                atable[name].fill_value = None
+        return atable
+
+    def close(self):
+        """Finishes the output. If only empty batches were written the
+        last of them is written, so the output still has its columns."""
+        if self.dtypes is None and self.empty_table is not None:
+            self.write_batch(self.conform(self.empty_table))
+        self.close_file()
+        return
+
+    @abc.abstractmethod
+    def write_batch(self, atable):
+        """Writes atable, whose columns have been conformed to those
+        already written"""
+
+    @abc.abstractmethod
+    def close_file(self):
+        """Closes the output once everything has been written"""
+
+class TextTableWriter(TableWriter):
+    """Writes an astropy Table as text in one of astropy's ascii formats,
+    e.g. 'ascii.ecsv' or 'ascii.csv'.
+
+    Each batch is formatted by astropy as a table of its own, and its
+    rows are spliced in between the header and footer of the first.
+    """
+    def __init__(self, an_output_file, a_format, write_kwargs=None):
+        TableWriter.__init__(self, an_output_file)
+        self.format = a_format
+        self.write_kwargs = {} if write_kwargs is None else write_kwargs
+        self.file = open(an_output_file, 'wb')
+        self.header_lines = None
+        self.footer_lines = None
+        self.footer = None
+        self.rows_end = 0
+        return
+
+    def format_lines(self, atable):
+        p_buffer = io.StringIO()
+        atable.write(p_buffer, format=self.format, **self.write_kwargs)
+        return p_buffer.getvalue().splitlines(keepends=True)
+
+    def write_batch(self, atable):
+        p_lines = self.format_lines(atable)
+        if self.header_lines is None:
+            # Lines of the batch that are not in an empty table are rows
+            p_empty_lines = self.format_lines(atable[:0])
+            num = 0
+            while num < len(p_empty_lines) and p_lines[num] == p_empty_lines[num]:
+                num += 1
+            self.header_lines = num
+            self.footer_lines = len(p_empty_lines) - num
+            self.footer = ''.join(p_empty_lines[num:]).encode('utf-8')
+            self.file.write(''.join(p_lines[:num]).encode('utf-8'))
+            self.rows_end = self.file.tell()
+
+        p_rows = ''.join(p_lines[self.header_lines:len(p_lines)-self.footer_lines])
+        # Overwrite the old footer, and end with a new one
+        self.file.seek(self.rows_end)
+        self.file.write(p_rows.encode('utf-8'))
+        self.rows_end = self.file.tell()
+        self.file.write(self.footer)
+        self.file.truncate()
+        self.file.flush()
+        return
+
+    def close_file(self):
+        self.file.close()
+        if self.dtypes is None:
+            print('Warning: No rows were written to {}'.format(self.output_file))
+            os.remove(self.output_file)
+        return
+
+class HtmlTableWriter(TextTableWriter):
+    """Writes an astropy Table to HTML while applying a CSS style to it,
+    as write_to_html does."""
+    def __init__(self, an_output_file, a_css_style=None):
+        p_html_dict = make_html_dict(a_css_style)
+        TextTableWriter.__init__(self, an_output_file, 'ascii.html',
+            {'htmldict': p_html_dict})
+        return
+
+    def close_file(self):
+        TextTableWriter.close_file(self)
+        if self.dtypes is None:
+            return
+        print('Wrote formatted table to {} using CSS style {}'.format(self.output_file,
+            self.write_kwargs['htmldict']['table_class']))
+        return
+
+class FitsTableWriter(TableWriter):
+    """Writes an astropy Table to a FITS binary table.
+
+    The NAXIS2 row count in the header is updated after each batch. If
+    a batch changes the header, for example by widening a string column,
+    the rows already written are rewritten to match, a chunk at a time.
+    A gzipped FITS file is written uncompressed to a .partial file, which
+    is compressed on close.
+
+    Integer columns that have been masked in any batch are masked in all
+    later ones, with the same TNULL null value, so their nulls stay
+    recognizable whichever batch they were written in.
+    """
+    # Number of rows rewritten at a time when the header changes
+    REWRITE_ROWS = 100000
+    # FITS headers and data are padded to a multiple of this many bytes
+    BLOCK_SIZE = 2880
+
+    def __init__(self, an_output_file):
+        TableWriter.__init__(self, an_output_file)
+        self.fits_file = an_output_file
+        if an_output_file.endswith('.gz'):
+            p_root, p_ext = os.path.splitext(an_output_file[:-3])
+            self.fits_file = p_root + '.partial' + p_ext
+        self.file = open(self.fits_file, 'w+b')
+        self.header = None
+        self.raw_dtype = None
+        # TNULL values of the columns written so far, by column name
+        self.null_values = {}
+        self.header_start = 0
+        self.data_start = 0
+        self.data_end = 0
+        return
+
+    def encode(self, atable):
+        """Returns the BinTableHDU header, on-disk row dtype and data of
+        atable, exactly as Table.write would write them"""
+        from astropy.io import fits
+        p_buffer = io.BytesIO()
+        atable.write(p_buffer, format='fits')
+        p_bytes = p_buffer.getvalue()
+        with fits.open(io.BytesIO(p_bytes)) as hdu_list:
+            p_hdu = hdu_list[1]
+            p_header = p_hdu.header.copy()
+            p_raw_dtype = p_hdu.columns.dtype.newbyteorder('>')
+            p_start = len(hdu_list[0].header.tostring()) + len(p_header.tostring())
+        p_size = p_header['NAXIS1'] * p_header['NAXIS2']
+        return p_header, p_raw_dtype, p_bytes[p_start:p_start+p_size]
+
+    def header_matches(self, header):
+        p_cards = [card for card in header.cards if card.keyword != 'NAXIS2']
+        p_old_cards = [card for card in self.header.cards if card.keyword != 'NAXIS2']
+        return [card.image for card in p_cards] == [card.image for card in p_old_cards]
+
+    def apply_nulls(self, atable):
+        """Returns atable with the columns that had TNULL values in
+        earlier batches masked, with those values as their fill values"""
+        import numpy as np
+        from astropy.table import Table, MaskedColumn
+        p_nulls = [(name, null) for name, null in self.null_values.items()
+            if not (hasattr(atable[name], 'mask') and atable[name].fill_value == null)]
+        if len(p_nulls) == 0:
+            return atable
+        # Don't modify the caller's table
+        atable = Table(atable, copy=False)
+        for name, null in p_nulls:
+            atable[name] = MaskedColumn(atable[name], mask=np.ma.getmaskarray(atable[name]),
+                fill_value=null)
+        return atable
+
+    def write_batch(self, atable):
+        from astropy.io import fits
+        header, raw_dtype, data = self.encode(self.apply_nulls(atable))
+        for num, name in enumerate(atable.colnames):
+            if 'TNULL{}'.format(num+1) in header:
+                self.null_values.setdefault(name, header['TNULL{}'.format(num+1)])
+        if self.header is None:
+            self.file.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+            self.header_start = self.file.tell()
+            self.set_header(header, raw_dtype)
+        elif not self.header_matches(header):
+            self.rewrite(header, raw_dtype)
+        self.file.seek(self.data_end)
+        self.file.write(data)
+        self.data_end = self.file.tell()
+        self.finish()
+        return
+
+    def set_header(self, header, raw_dtype):
+        """Writes header at header_start, ready for rows of raw_dtype to
+        be written"""
+        self.header = header.copy()
+        self.raw_dtype = raw_dtype
+        self.header['NAXIS2'] = 0
+        self.file.seek(self.header_start)
+        self.file.write(self.header.tostring().encode('ascii'))
+        self.data_start = self.file.tell()
+        self.data_end = self.data_start
+        return
+
+    def finish(self):
+        """Pads the data to a whole FITS block and updates the row
+        count, leaving a complete FITS file"""
+        p_num_rows = (self.data_end - self.data_start) // self.raw_dtype.itemsize
+        p_pad = -(self.data_end - self.data_start) % self.BLOCK_SIZE
+        self.file.write(b'\0' * p_pad)
+        self.file.truncate()
+        self.header['NAXIS2'] = p_num_rows
+        self.file.seek(self.header_start)
+        self.file.write(self.header.tostring().encode('ascii'))
+        self.file.flush()
+        return
+
+    def rewrite(self, header, raw_dtype):
+        """Rewrites the rows written so far to match a new header,
+        changing the null values of columns whose TNULL has changed"""
+        import numpy as np
+        old_file = self.file
+        old_dtype = self.raw_dtype
+        old_header = self.header
+        old_start = self.data_start
+        p_num_rows = (self.data_end - self.data_start) // old_dtype.itemsize
+
+        self.file = open(self.fits_file + '.tmp', 'w+b')
+        old_file.seek(0)
+        self.file.write(old_file.read(self.header_start))
+        self.set_header(header, raw_dtype)
+        for start in range(0, p_num_rows, self.REWRITE_ROWS):
+            count = min(self.REWRITE_ROWS, p_num_rows - start)
+            old_file.seek(old_start + start*old_dtype.itemsize)
+            old_rows = np.frombuffer(old_file.read(count*old_dtype.itemsize), dtype=old_dtype)
+            new_rows = np.zeros(count, dtype=self.raw_dtype)
+            for num, name in enumerate(old_dtype.names):
+                new_rows[name] = old_rows[name]
+                old_null = old_header.get('TNULL{}'.format(num+1))
+                new_null = header.get('TNULL{}'.format(num+1))
+                if old_null is not None and new_null is not None and old_null != new_null:
+                    new_rows[name][old_rows[name] == old_null] = new_null
+            self.file.write(new_rows.tobytes())
+        self.data_end = self.file.tell()
+        old_file.close()
+        os.replace(self.fits_file + '.tmp', self.fits_file)
+        return
+
+    def close_file(self):
+        self.file.close()
+        if self.header is None:
+            print('Warning: No rows were written to {}'.format(self.output_file))
+            os.remove(self.fits_file)
+            return
+        if self.fits_file != self.output_file:
+            with open(self.fits_file, 'rb') as fits_file:
+                with gzip.open(self.output_file, 'wb') as gz_file:
+                    shutil.copyfileobj(fits_file, gz_file)
+            os.remove(self.fits_file)
+        return
+
+class MemoryTableWriter(TableWriter):
+    """Keeps the batches written in memory, so the whole table can be
+    handed on to later processing with table() rather than written out
+    and read back in.
+
+    If a_file_writer, another TableWriter, is given the batches are
+    written with it as well, and it is closed along with this one.
+    """
+    def __init__(self, a_file_writer=None):
+        p_output_file = None
+        if a_file_writer is not None:
+            p_output_file = a_file_writer.output_file
+        TableWriter.__init__(self, p_output_file)
+        self.file_writer = a_file_writer
+        self.batches = []
+        return
+
+    def write_batch(self, atable):
+        self.batches.append(atable)
+        if self.file_writer is not None:
+            self.file_writer.write(atable)
+        return
+
+    def table(self):
+        """Returns a Table of all the rows written, or None if nothing
+        has been written"""
+        from astropy.table import vstack
+        if len(self.batches) == 0:
+            return None
+        if len(self.batches) == 1:
+            return self.batches[0]
+        return vstack(self.batches, metadata_conflicts='silent')
+
+    def close_file(self):
+        if self.file_writer is not None:
+            self.file_writer.close()
+        return
+
+def write_table_snapshot(atable, snapshot_dir, extra_arrays=None, meta=None):
+    """Writes an astropy Table to a directory of uncompressed numpy
+    .npy files, one per column, that can later be memory-mapped by
+    read_table_snapshot.
+
+    Optional extra_arrays is a dictionary of additional named numpy
+    arrays (e.g. an index) to store alongside the table, and meta is
+    a dictionary of JSON-serializable values stored in snapshot.json.
+
+    The snapshot is written to a temporary directory which then replaces
+    any existing snapshot_dir, so an interrupted write leaves the old
+    snapshot untouched, and no files of an older snapshot are left behind.
+    """
+    import numpy as np
+
+    final_dir = snapshot_dir
+    snapshot_dir = final_dir + '.tmp'
+    if os.path.isdir(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+
+    col_info = []
+    for col in atable.itercols():
+        is_masked = hasattr(col, 'mask')
+        np.save(os.path.join(snapshot_dir, '{}.npy'.format(col.name)),
+            np.asarray(col.data.data if is_masked else col.data))
+        if is_masked:
+            np.save(os.path.join(snapshot_dir, '{}.mask.npy'.format(col.name)),
+                np.ma.getmaskarray(col.data))
+        col_info.append({'name': col.name,
+            'masked':      is_masked,
+            'unit':        None if col.unit is None else col.unit.to_string(),
+            'format':      col.format,
+            'description': col.description})
+
+    extra_names = []
+    if extra_arrays is not None:
+        for name, data in extra_arrays.items():
+            np.save(os.path.join(snapshot_dir, '_{}.npy'.format(name)), data)
+            extra_names.append(name)
+
+    snapshot_meta = {'columns': col_info,
+        'extra_arrays': extra_names,
+        'meta': {} if meta is None else meta}
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'w') as json_file:
+        json.dump(snapshot_meta, json_file, indent=1)
+
+    # A directory can't be replaced by another in one step, so move the
+    # old snapshot aside first. Readers that find no snapshot in between
+    # fall back to the source table.
+    old_dir = final_dir + '.old'
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.isdir(final_dir):
+        os.rename(final_dir, old_dir)
+    os.rename(snapshot_dir, final_dir)
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
     return
 
+def read_snapshot_meta(snapshot_dir):
+    """Returns the meta dictionary stored by write_table_snapshot, or None
+    if snapshot_dir does not contain a snapshot."""
+    json_file_name = os.path.join(snapshot_dir, 'snapshot.json')
+    if not os.path.isfile(json_file_name):
+        return None
+    with open(json_file_name, 'r') as json_file:
+        return json.load(json_file)['meta']
+
+def read_snapshot_column_names(snapshot_dir):
+    """Returns the list of column names in the snapshot in snapshot_dir,
+    without reading the table data."""
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'r') as json_file:
+        return [info['name'] for info in json.load(json_file)['columns']]
+
+def read_table_snapshot(snapshot_dir, p_verbose=False, columns=None):
+    """Reads a snapshot written by write_table_snapshot, returning a tuple
+    of the astropy Table and the dictionary of extra arrays.
+
+    Column data is memory-mapped read-only from the .npy files, so
+    opening even a large snapshot is fast and only the parts of the
+    table that are actually used are read from disk.
+
+    If a list of column names is given only those columns of the
+    snapshot are returned.
+    """
+    import numpy as np
+    from astropy.table import Table, Column, MaskedColumn
+
+    if p_verbose:
+        print('Reading table snapshot from {}'.format(snapshot_dir))
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'r') as json_file:
+        snapshot_meta = json.load(json_file)
+
+    table_columns = []
+    for info in snapshot_meta['columns']:
+        if columns is not None and info['name'] not in columns:
+            continue
+        data = np.load(os.path.join(snapshot_dir, '{}.npy'.format(info['name'])),
+            mmap_mode='r')
+        col_kwargs = {'name': info['name'],
+            'unit':        info['unit'],
+            'format':      info['format'],
+            'description': info['description'],
+            'copy':        False}
+        if info['masked']:
+            mask = np.load(os.path.join(snapshot_dir, '{}.mask.npy'.format(info['name'])))
+            table_columns.append(MaskedColumn(data=data, mask=mask, **col_kwargs))
+        else:
+            table_columns.append(Column(data=data, **col_kwargs))
+    atable = Table(table_columns, copy=False)
+
+    extra_arrays = {}
+    for name in snapshot_meta['extra_arrays']:
+        extra_arrays[name] = np.load(os.path.join(snapshot_dir, '_{}.npy'.format(name)),
+            mmap_mode='r')
+    if p_verbose:
+        print(atable.info)
+    return atable, extra_arrays
+
 def read_star_aliases(star_alias_csv_file):
     """Creates a dictionary of problematic user star names and the
     names that Simbad will recognize, used by SimbadStarQuery.
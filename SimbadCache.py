@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""A persistent on-disk cache of Simbad query results, stored in a
+single SQLite file.
+
+Entries are keyed by the Simbad query ID and the set of votable fields
+requested, so changing the fields requested never returns stale
+columns. Each entry expires after its own time-to-live, and once the
+cache grows beyond its size budget the least recently used entries are
+removed.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pickle
+import sqlite3
+import time
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+CACHE_FILE = 'simbad_cache.sqlite'
+# Default time-to-live of a cache entry, in days.
+CACHE_TTL_DAYS = 30.0
+# Default size budget of the cache, in megabytes.
+CACHE_SIZE_MB = 100.0
+
+SECONDS_PER_DAY = 86400.0
+
+class SimbadCache:
+    """Stores the results of Simbad queries in a SQLite file so that
+    repeated queries for the same object need no network access.
+
+    Counts of cache hits, misses, expired entries and evictions made
+    by this object are kept in the attributes of the same names.
+    """
+    def __init__(self, cache_file=CACHE_FILE, ttl_days=CACHE_TTL_DAYS,
+        size_mb=CACHE_SIZE_MB):
+        self.cache_file = cache_file
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.max_bytes = int(size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self.connection = sqlite3.connect(cache_file, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries ('+
+                'key TEXT PRIMARY KEY, expires REAL, accessed REAL, size INTEGER, payload BLOB)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed '+
+                'ON entries (accessed)')
+            # The total size of the entries is kept up to date by triggers,
+            # so it never has to be summed over the whole table, and stays
+            # right when several processes share the cache
+            self.connection.execute('CREATE TABLE IF NOT EXISTS total_size ('+
+                'id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)')
+            self.connection.execute('INSERT OR IGNORE INTO total_size '+
+                'SELECT 0, COALESCE(SUM(size), 0) FROM entries')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS entries_insert '+
+                'AFTER INSERT ON entries BEGIN '+
+                'UPDATE total_size SET bytes = bytes + NEW.size; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS entries_update '+
+                'AFTER UPDATE OF size ON entries BEGIN '+
+                'UPDATE total_size SET bytes = bytes + NEW.size - OLD.size; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS entries_delete '+
+                'AFTER DELETE ON entries BEGIN '+
+                'UPDATE total_size SET bytes = bytes - OLD.size; END')
+        return
+
+    def make_key(self, query_id, votable_fields):
+        """Returns the cache key for a Simbad query of query_id that
+        requests the given votable fields"""
+        normalized_id = ' '.join(str(query_id).split())
+        return '{}|{}'.format(normalized_id, ','.join(sorted(votable_fields)))
+
+    def get(self, key):
+        """Returns the value stored under key, or None if it is not in
+        the cache or has expired"""
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """Returns a list of the values stored under each of keys, with
+        None for those not in the cache or expired, updating the cache
+        in a single transaction"""
+        now = time.time()
+        values = []
+        with self.connection:
+            for key in keys:
+                row = self.connection.execute('SELECT expires, payload FROM entries WHERE key = ?',
+                    (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    values.append(None)
+                    continue
+                expires, payload = row
+                if expires < now:
+                    self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    self.expired += 1
+                    self.misses += 1
+                    values.append(None)
+                    continue
+                self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+                self.hits += 1
+                values.append(pickle.loads(payload))
+        return values
+
+    def put(self, key, value, ttl_days=None):
+        """Stores value under key. ttl_days overrides the default
+        time-to-live of the cache for this entry."""
+        self.put_many([(key, value)], ttl_days)
+        return
+
+    def put_many(self, items, ttl_days=None):
+        """Stores a list of (key, value) tuples in a single transaction,
+        then evicts the least recently used entries if the cache is
+        larger than its size budget."""
+        now = time.time()
+        ttl = self.ttl
+        if ttl_days is not None:
+            ttl = ttl_days * SECONDS_PER_DAY
+        rows = []
+        for key, value in items:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, now + ttl, now, len(payload), payload))
+        # An upsert rather than INSERT OR REPLACE, whose deletes do not
+        # fire the trigger keeping the total size
+        with self.connection:
+            self.connection.executemany('INSERT INTO entries '+
+                '(key, expires, accessed, size, payload) VALUES (?, ?, ?, ?, ?) '+
+                'ON CONFLICT (key) DO UPDATE SET expires = excluded.expires, '+
+                'accessed = excluded.accessed, size = excluded.size, payload = excluded.payload',
+                rows)
+        self.evict()
+        return
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is
+        within its size budget"""
+        total_bytes = self.total_bytes()
+        if total_bytes <= self.max_bytes:
+            return
+        evict_keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if total_bytes <= self.max_bytes:
+                break
+            evict_keys.append((key,))
+            total_bytes -= size
+        with self.connection:
+            self.connection.executemany('DELETE FROM entries WHERE key = ?', evict_keys)
+        self.evictions += len(evict_keys)
+        return
+
+    def total_bytes(self):
+        """Returns the total size of the cached entries, in bytes"""
+        return self.connection.execute('SELECT bytes FROM total_size').fetchone()[0]
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self.connection:
+            self.connection.execute('DELETE FROM entries')
+        return
+
+    def summary(self):
+        """Returns a one-line summary of the cache counters"""
+        return '{} hits, {} misses ({} expired), {} evictions'.format(self.hits,
+            self.misses, self.expired, self.evictions)
+
+    def close(self):
+        self.connection.close()
+        return
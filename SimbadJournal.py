@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""An append-only journal of the Simbad responses received during a
+star_query.py run, so that a run that dies part way through can be
+resumed without querying Simbad again for the objects already done.
+
+Each record is pickled and appended to the journal file as soon as the
+response arrives. A batched response is recorded once for the whole
+batch, before it is split up by object, which keeps the cost of a
+record small compared to that of the query itself. Requests that fail
+are recorded too, so a resumed run reports the same failures. A record
+cut short by the run dying is ignored when the journal is read back.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import pickle
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+# Suffix added to the name of the output table to name its journal.
+JOURNAL_SUFFIX = '.journal'
+
+# Kinds of journal record.
+BATCH = 'batch'
+RESULTS = 'results'
+FAILED = 'failed'
+
+class SimbadJournal:
+    """Records Simbad responses in an append-only file.
+
+    Each record is a tuple of its kind, the Simbad IDs queried and the
+    response. A BATCH record holds the table returned for a batched
+    query of all the IDs, a RESULTS record a list of the
+    (result_table, identifiers) tuples of each ID, and a FAILED record
+    the error message of a request for the IDs that failed.
+
+    The journal starts with a header giving the votable fields
+    requested. When resuming, a journal written with different fields
+    is discarded, as its tables would have the wrong columns.
+    """
+    def __init__(self, journal_file, votable_fields, resume=False):
+        self.journal_file = journal_file
+        self.header = ('header', sorted(votable_fields))
+        # Records read back from an earlier run
+        self.records = []
+
+        good_size = 0
+        if resume and os.path.exists(journal_file):
+            good_size = self.read()
+        if good_size == 0:
+            self.records = []
+            self.file = open(journal_file, 'wb')
+            self.append(self.header)
+        else:
+            # Drop any record cut short at the end, then carry on from there
+            self.file = open(journal_file, 'r+b')
+            self.file.truncate(good_size)
+            self.file.seek(good_size)
+        return
+
+    def read(self):
+        """Reads the records of an earlier run into records, returning
+        the size of the journal up to the end of the last whole record,
+        or 0 if the journal cannot be used"""
+        good_size = 0
+        with open(self.journal_file, 'rb') as file:
+            try:
+                header = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError):
+                print('Warning: Could not read journal {}. Starting a new one.'.format(self.journal_file))
+                return 0
+            if header != self.header:
+                print('Warning: Journal {} was written for different Simbad fields.'.format(self.journal_file)+
+                    ' Starting a new one.')
+                return 0
+            good_size = file.tell()
+            while True:
+                try:
+                    record = pickle.load(file)
+                except (EOFError, pickle.UnpicklingError):
+                    # The end of the journal, or a record cut short
+                    break
+                self.records.append(record)
+                good_size = file.tell()
+        return good_size
+
+    def add_batch(self, batch_ids, result_table):
+        """Records the table returned by a batched query of batch_ids"""
+        self.append((BATCH, batch_ids, result_table))
+        return
+
+    def add_results(self, simbad_ids, results):
+        """Records the (result_table, identifiers) tuples returned by
+        querying each of simbad_ids"""
+        self.append((RESULTS, simbad_ids, results))
+        return
+
+    def add_failed(self, simbad_ids, error):
+        """Records that the request for simbad_ids failed with error"""
+        self.append((FAILED, simbad_ids, str(error)))
+        return
+
+    def append(self, record):
+        # Flushed so the record survives the process dying, but not
+        # synced to disk, which would slow down every record.
+        pickle.dump(record, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        return
+
+    def close(self):
+        self.file.close()
+        return
+
+    def remove(self):
+        """Closes and deletes the journal, once it is no longer needed"""
+        self.close()
+        os.remove(self.journal_file)
+        return
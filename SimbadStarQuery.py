@@ -15,12 +15,16 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-from astroquery.simbad import Simbad
-from astropy.table import Table, Column, hstack
+from astroquery.simbad import SimbadClass
+import concurrent.futures
+import threading
+import time
+import numpy as np
+import SimbadJournal
+from astropy.table import Table, Column, MaskedColumn
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 import warnings
-from astropy.utils.exceptions import AstropyUserWarning, AstropyWarning
 
 __author__ = "Dave Strickland"
 __copyright__ = "Copyright 2018, Dave Strickland"
@@ -30,35 +34,110 @@ __email__ =  "dave.strickland@gmail.com"
 __license__ = "GPLv3"
 __version__ = "0.2.0"
 
+# Number of objects to query Simbad for in each batched request.
+BATCH_SIZE = 100
+# Number of Simbad requests prefetch keeps in flight at once.
+THREADS = 4
+# Maximum number of Simbad requests per second, to stay polite to CDS.
+RATE_LIMIT = 5.0
+
+# Simbad votable fields requested by default.
+VOTABLE_FIELDS = ['ra(icrs)', 'dec(icrs)', 'coo_bibcode',
+    'flux(B)', 'flux_error(B)', 'flux_bibcode(B)',
+    'flux(V)', 'flux_error(V)', 'flux_bibcode(V)',
+    'plx', 'plx_error', 'plx_bibcode',
+    'pm', 'pm_bibcode',
+    'sp', 'sp_qual', 'sp_bibcode',
+    'fe_h', 'ids']
+
+# Only the fields needed for the columns of the star_query.py HTML summary.
+MINIMAL_VOTABLE_FIELDS = ['ra(icrs)', 'dec(icrs)', 'flux(V)', 'sp', 'fe_h', 'ids']
+
+# Fields that are always requested, as processing the results needs them.
+REQUIRED_VOTABLE_FIELDS = ['ra(icrs)', 'dec(icrs)', 'ids']
+
+# Identifier catalogs chosen by parse_identifiers, which are also the
+# names of their output columns.
+ID_NAMES  = ['WDS', 'SAO', 'HIP', 'NAME', 'HD']
+# Can't use ints for HD as some have Alphanumeric suffices.
+ID_DTYPES = ['U20', 'U20', 'U20', 'U20', 'U20']
+
+class TokenBucket:
+    """Limits requests made from any number of threads to rate per
+    second on average, allowing bursts of up to capacity requests.
+    A rate of None or 0 means no limit.
+    """
+    def __init__(self, rate=RATE_LIMIT, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        return
+
+    def acquire(self):
+        """Waits until a request is allowed"""
+        if self.rate is None or self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 class SimbadStarQuery:
     """Queries Simbad for information about a stellar object,
     making the data available as an astropy Tables object.
     """
     
-    def __init__(self, simbad_alias_dict=None):
+    def __init__(self, simbad_alias_dict=None, cache=None, rate_limit=RATE_LIMIT,
+        votable_fields=None):
         """Initializes a SimbadStarQuery object
         
         Inputs are an optional user-supplied dictionary that contains a
         mapping between known problematic user names
         and valid Simbad identifiers. This dictionary
         can be construced using DavesAstropyUtils.read_star_aliases().
+
+        If an optional SimbadCache.SimbadCache is given, results are
+        read from it where possible and new results are stored in it.
+
+        No more than rate_limit Simbad requests are made per second.
+
+        votable_fields is the list of Simbad votable fields to request,
+        by default VOTABLE_FIELDS. MINIMAL_VOTABLE_FIELDS gives only the
+        fields needed for the star_query.py HTML summary, keeping the
+        responses small. REQUIRED_VOTABLE_FIELDS are always requested.
         """
         self.user_ident = None
         self.simbad_alias_dict = simbad_alias_dict
+        self.cache = cache
+        self.journal = None
+        self.rate_limiter = TokenBucket(rate_limit)
+        # Results of batched queries made by prefetch, keyed by Simbad ID.
+        self.prefetched = {}
+        # Identifier types in ID_NAMES matching each identifier prefix.
+        self.prefix_types = {}
 
         warnings.simplefilter('ignore', category=UserWarning, append=True)
 
-        # This changes the default behaviour of ALL Simbad queries,
-        # so it has the unfortunate effect of affecting future queries.
-        Simbad.reset_votable_fields()
-        Simbad.remove_votable_fields('coordinates')
-        Simbad.add_votable_fields('ra(icrs)', 'dec(icrs)', 'coo_bibcode',
-            'flux(B)', 'flux_error(B)', 'flux_bibcode(B)',
-            'flux(V)', 'flux_error(V)', 'flux_bibcode(V)',
-            'plx', 'plx_error', 'plx_bibcode', 
-            'pm', 'pm_bibcode',
-            'sp', 'sp_qual', 'sp_bibcode',
-            'fe_h')
+        if votable_fields is None:
+            votable_fields = VOTABLE_FIELDS
+        for field in REQUIRED_VOTABLE_FIELDS:
+            if field not in votable_fields:
+                votable_fields = votable_fields + [field]
+
+        # Use our own Simbad instance so other Simbad queries, including
+        # those of other SimbadStarQuery objects, are not affected.
+        self.simbad = SimbadClass()
+        self.simbad.reset_votable_fields()
+        self.simbad.remove_votable_fields('coordinates')
+        self.simbad.add_votable_fields(*votable_fields)
         
         # depends on prior knowledge of output names
         self.format_code_dict = {'FLUX_B': '{:.2f}',
@@ -152,19 +231,270 @@ class SimbadStarQuery:
         instead of just "Barnard's Star". This function removes
         any "NAME " in the MAIN_ID. 
         """
+        main_ids = result_table['MAIN_ID']
         # Convert to string from bytes if necessary
-        if result_table['MAIN_ID'].dtype in ['object']:
-            wdth = self.best_str_len( len(result_table['MAIN_ID'][0]) )
-            result_table['MAIN_ID'] = result_table['MAIN_ID'].astype('U{}'.format(wdth))
-        
-        if 'NAME ' in result_table['MAIN_ID'][0]:
-            result_table['MAIN_ID'][0] = result_table['MAIN_ID'][0].replace('NAME ', '')
+        is_object = main_ids.dtype in ['object']
+        if is_object:
+            main_ids = main_ids.astype('U{}'.format(self.str_width(main_ids)))
+
+        p_fixed_ids = [main_id.replace('NAME ', '') for main_id in main_ids]
+        main_ids[:] = p_fixed_ids
+        if is_object:
+            wdth = self.str_width(p_fixed_ids)
+            main_ids = main_ids.astype('U{}'.format(wdth))
+        result_table['MAIN_ID'] = main_ids
         return
         
+    def prefetch(self, query_ids, batch_size=BATCH_SIZE, threads=1):
+        """Queries Simbad for many objects at once, in batches of up to
+        batch_size objects per request, so that later calls to do_query
+        for these objects need no further Simbad queries. A batch_size
+        of 0 queries the objects one at a time.
+
+        Each batch fetches the main data and the identifiers of all of
+        its objects in a single request. Objects whose results cannot be
+        matched up are left to be queried individually by do_query.
+
+        Up to threads requests are kept in flight at once, subject to
+        the rate limit. Objects whose request fails are recorded as
+        having no results, so do_query reports them as failed.
+        """
+        simbad_ids = []
+        for query_id in query_ids:
+            simbad_id = self.get_simbad_object_id(query_id, self.simbad_alias_dict)
+            if simbad_id not in self.prefetched:
+                simbad_ids.append(simbad_id)
+        # Remove duplicates, keeping the original order
+        simbad_ids = list(dict.fromkeys(simbad_ids))
+
+        if self.cache is not None:
+            uncached_ids = []
+            cached_list = self.cache.get_many([self.cache_key(simbad_id) for simbad_id in simbad_ids])
+            for simbad_id, cached in zip(simbad_ids, cached_list):
+                if cached is None:
+                    uncached_ids.append(simbad_id)
+                else:
+                    self.prefetched[simbad_id] = cached
+            simbad_ids = uncached_ids
+
+        if batch_size > 0:
+            batch_list = [simbad_ids[start:start+batch_size]
+                for start in range(0, len(simbad_ids), batch_size)]
+            query_function = self.query_batch
+        else:
+            batch_list = [[simbad_id] for simbad_id in simbad_ids]
+            query_function = lambda batch_ids: [self.query_simbad(batch_ids[0])]
+
+        # Results are stored and journaled as each request completes, from
+        # this thread only, as the cache and journal cannot be shared
+        # between threads.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            future_dict = {executor.submit(query_function, batch_ids): batch_ids
+                for batch_ids in batch_list}
+            for future in concurrent.futures.as_completed(future_dict):
+                batch_ids = future_dict[future]
+                try:
+                    results = future.result()
+                except Exception as err:
+                    print('  Warning: Simbad query failed for {}: {}'.format(', '.join(batch_ids), err))
+                    for simbad_id in batch_ids:
+                        self.prefetched[simbad_id] = (None, None)
+                    if self.journal is not None:
+                        self.journal.add_failed(batch_ids, err)
+                    continue
+                if batch_size > 0:
+                    # Record the response before it is split up by object,
+                    # which is much cheaper than recording each object.
+                    if self.journal is not None:
+                        self.journal.add_batch(batch_ids, results)
+                    results = self.split_batch(batch_ids, results)
+                elif self.journal is not None:
+                    self.journal.add_results(batch_ids, results)
+                if results is not None:
+                    self.store_results(batch_ids, results)
+        return
+
+    def release(self, query_ids):
+        """Drops the prefetched results for query_ids once they are no
+        longer needed, so memory use stays bounded on long lists"""
+        for query_id in query_ids:
+            self.prefetched.pop(self.get_simbad_object_id(query_id, self.simbad_alias_dict), None)
+        return
+
+    def set_journal(self, journal):
+        """Records the responses to all further Simbad queries in the
+        SimbadJournal.SimbadJournal journal, after restoring the results
+        recorded in it by an earlier run so that they are not queried
+        again.
+
+        Objects whose request failed are restored as having no results,
+        so they are reported as failed again rather than queried.
+
+        Returns the number of objects whose results were restored.
+        """
+        num_restored = 0
+        num_failed = 0
+        for kind, simbad_ids, response in journal.records:
+            if kind == SimbadJournal.FAILED:
+                for simbad_id in simbad_ids:
+                    self.prefetched[simbad_id] = (None, None)
+                num_failed += len(simbad_ids)
+                continue
+            if kind == SimbadJournal.BATCH:
+                response = self.split_batch(simbad_ids, response)
+                if response is None:
+                    continue
+            for simbad_id, result in zip(simbad_ids, response):
+                self.prefetched[simbad_id] = result
+                num_restored += 1
+        if num_failed > 0:
+            print('  Warning: Not querying Simbad again for {} objects whose request failed'.format(num_failed)+
+                ' in the journaled run. Run without --resume to retry them.')
+        self.journal = journal
+        return num_restored + num_failed
+
+    def query_batch(self, batch_ids):
+        """Queries Simbad for all the objects in batch_ids in one request,
+        returning the table of results for split_batch.
+        """
+        self.rate_limiter.acquire()
+        return self.simbad.query_objects(batch_ids)
+
+    def split_batch(self, batch_ids, result_table):
+        """Splits the result_table of a batched query of batch_ids by object.
+
+        Returns a list of (result_table, identifiers) tuples, one for each
+        object, or None if the rows returned cannot be matched to the
+        objects. Simbad numbers the objects in a batched query in the
+        SCRIPT_NUMBER_ID column, and leaves out any it fails to resolve.
+        result_table is not modified.
+        """
+        if result_table is None:
+            return None
+        if 'SCRIPT_NUMBER_ID' in result_table.colnames:
+            object_nums = np.asarray(result_table['SCRIPT_NUMBER_ID'], dtype=int) - 1
+            result_table = result_table.copy(copy_data=False)
+            result_table.remove_column('SCRIPT_NUMBER_ID')
+        elif len(result_table) == len(batch_ids):
+            object_nums = np.arange(len(batch_ids))
+        else:
+            print('  Warning: Could not match {} rows from Simbad to {} objects.'.format(len(result_table),
+                len(batch_ids))+
+                ' They will be queried one at a time.')
+            return None
+
+        results = []
+        for num in range(len(batch_ids)):
+            rows = np.flatnonzero(object_nums == num)
+            identifiers = None
+            if len(rows) == 1 and 'IDS' in result_table.colnames:
+                identifiers = result_table['IDS'][rows[0]]
+            results.append((result_table[rows], identifiers))
+        return results
+
+    def store_results(self, simbad_ids, results):
+        """Stores the results of querying Simbad for each of simbad_ids
+        for use by do_query, and in the cache"""
+        for simbad_id, result in zip(simbad_ids, results):
+            self.prefetched[simbad_id] = result
+        if self.cache is not None:
+            self.cache.put_many([(self.cache_key(simbad_id), result)
+                for simbad_id, result in zip(simbad_ids, results)])
+        return
+
+    def cache_key(self, simbad_id):
+        """Returns the key for results of querying Simbad for simbad_id
+        with the current votable fields in the SimbadCache"""
+        return self.cache.make_key(simbad_id, self.simbad.get_votable_fields())
+
+    def fetch_object(self, simbad_id):
+        """Returns a tuple of the table of results of a Simbad query of
+        simbad_id and its identifiers, which are None unless exactly one
+        object was found. Results are taken from the cache if possible.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(self.cache_key(simbad_id))
+            if cached is not None:
+                return cached
+
+        result = self.query_simbad(simbad_id)
+        if self.journal is not None:
+            self.journal.add_results([simbad_id], [result])
+        if self.cache is not None:
+            self.cache.put(self.cache_key(simbad_id), result)
+        return result
+
+    def query_simbad(self, simbad_id):
+        """Queries Simbad for a single object, returning a tuple of the
+        table of results and its identifiers.
+
+        The identifiers come from the IDS field of the same query, so
+        only if the 'ids' votable field was not requested is a second
+        query needed to get them.
+        """
+        self.rate_limiter.acquire()
+        result_table = self.simbad.query_object(simbad_id)
+        identifiers = None
+        if result_table is not None and len(result_table) == 1:
+            if 'IDS' in result_table.colnames:
+                identifiers = result_table['IDS'][0]
+            else:
+                self.rate_limiter.acquire()
+                ids_table = self.simbad.query_objectids(simbad_id)
+                if ids_table is not None:
+                    identifiers = ids_table['ID'].data.tolist()
+        return result_table, identifiers
+
+    def split_ids(self, identifiers):
+        """Returns a list of the identifiers of an object as strings.
+
+        identifiers may be the '|'-separated IDS field of a Simbad query
+        result, or the list of identifiers returned by Simbad.query_objectids.
+        """
+        if identifiers is None or identifiers is np.ma.masked:
+            return []
+        if isinstance(identifiers, bytes):
+            identifiers = identifiers.decode('utf-8')
+        if isinstance(identifiers, str):
+            identifiers = identifiers.split('|')
+        ids_list = []
+        for ident in identifiers:
+            if isinstance(ident, bytes):
+                ident = ident.decode('utf-8')
+            ident = ident.strip()
+            if len(ident) > 0:
+                ids_list.append(ident)
+        return ids_list
+
     def do_query(self, user_ident, query_id=None):
         """Queries Simbad for the user-supplied target object,
         using that an optional ID for the Simbad query, and processes 
         the resulting astropy table output.
+
+        If the object was included in an earlier call to prefetch
+        the results of that batched query are used instead, and
+        otherwise results in the cache are used if possible.
+        """
+        self.table = None
+        self.fetch_result(user_ident, query_id)
+        if not self.successfully_queried:
+            return
+
+        p_id_vals = self.parse_identifiers_batch([self.identifiers], [self.query_id])
+        # Don't modify the prefetched or cached results
+        self.table = self.process_results(Table(self.result_table, copy=True),
+            [self.user_ident], p_id_vals)
+        return
+
+    def fetch_result(self, user_ident, query_id=None):
+        """Gets the raw Simbad results for the user-supplied target
+        object, as do_query does, without processing them.
+
+        successfully_queried is set if exactly one object with data was
+        found, in which case its one-row table of results is left in
+        result_table and its identifiers in identifiers. These are
+        shared with the prefetched and cached results, so must not be
+        modified.
         """
         if query_id is None:
             # Use user_ident as the query id
@@ -175,7 +505,8 @@ class SimbadStarQuery:
         # Reset some stuff.
         self.successfully_queried = False
         self.num_rows_returned = 0
-        self.table = None
+        self.result_table = None
+        self.identifiers = None
 
         # Turn non-Simbad compliant IDs into ones acceptable to Simbad
         self.user_ident = user_ident
@@ -183,7 +514,10 @@ class SimbadStarQuery:
             self.simbad_alias_dict)
         
         # Query Simbad and make sure we get one (1) row returned
-        result_table = Simbad.query_object(self.simbad_object_id)
+        if self.simbad_object_id in self.prefetched:
+            result_table, identifiers = self.prefetched[self.simbad_object_id]
+        else:
+            result_table, identifiers = self.fetch_object(self.simbad_object_id)
  
         # check what we've got back
         if result_table is None:
@@ -199,8 +533,26 @@ class SimbadStarQuery:
         if self.sanity_check(result_table) is False:
             return
 
+        self.result_table = result_table
+        self.identifiers = identifiers
+        self.successfully_queried = True
+        return
+
+    def process_results(self, result_table, user_idents, id_values_list):
+        """Processes a table of raw Simbad results, with one row for each
+        object, into the output table, modifying result_table in place.
+
+        user_idents are the user-supplied IDs of the objects and
+        id_values_list the identifiers chosen for each of them by
+        parse_identifiers_batch. Processing all the objects together
+        gives the same table as processing them one at a time and
+        adding each row to the table of the first.
+        """
+        if 'IDS' in result_table.colnames:
+            result_table.remove_column('IDS')
+
         self.fix_main_id(result_table)
-        self.add_user_ident(result_table)
+        self.add_user_ident(result_table, user_idents)
 
         # Fix up the coordinates so we have a uniform presentation
         self.fix_coordinates(result_table, 'RA_icrs', 'DEC_icrs')
@@ -214,28 +566,24 @@ class SimbadStarQuery:
         # to Unicode strings.
         for colname in result_table.colnames:
             if result_table[colname].dtype in ['object']:
-                wdth = self.best_str_len( len(result_table[colname][0]) )
+                wdth = self.str_width(result_table[colname])
                 result_table[colname] = result_table[colname].astype('U{}'.format(wdth))
 
-        # Get the alternate IDs in a table, column name 'ID"
-        ids_table = Simbad.query_objectids(self.simbad_object_id)
-        ids_list = ids_table['ID'].data.tolist()
-        p_interesting_ids = self.parse_identifiers(ids_list)
-        self.table = self.join_data_and_ids(result_table, p_interesting_ids)
+        # The alternate IDs were returned along with the main data
+        p_interesting_ids = self.make_id_table(id_values_list)
+        table = self.join_data_and_ids(result_table, p_interesting_ids)
         
-        for col in self.table.colnames:
+        for col in table.colnames:
             # Add or update description, uses original column names
             if col in self.vo_extra_description_dict.keys():
-                self.table[col].description = self.vo_extra_description_dict[col]
+                table[col].description = self.vo_extra_description_dict[col]
             # Fix/improve formatting
             if col in self.format_code_dict.keys():
-                self.table[col].format = self.format_code_dict[col]
+                table[col].format = self.format_code_dict[col]
             # Final clean-up column names
             if col in self.vo_to_output_name_dict.keys():
-                self.table.rename_column(col, self.vo_to_output_name_dict[col])
-
-        self.successfully_queried = True
-        return
+                table.rename_column(col, self.vo_to_output_name_dict[col])
+        return table
 
     def process_fe_h(self, query_result_table):
         """Removes unwanted column returned as part of 'fe_h' query
@@ -247,7 +595,8 @@ class SimbadStarQuery:
         - Fe_H_CatNo Not interested in the catalog number
         """
         fe_h_exclude_list = ['Fe_H_log_g', 'Fe_H_flag', 'Fe_H_CompStar', 'Fe_H_CatNo']
-        query_result_table.remove_columns(fe_h_exclude_list)
+        query_result_table.remove_columns([col for col in fe_h_exclude_list
+            if col in query_result_table.colnames])
         return
     
     def sanity_check(self, query_result_table):
@@ -293,37 +642,96 @@ class SimbadStarQuery:
         # // does integer division in python 3
         return wdth*(1 + (an_input_str_len // wdth))
 
-    def parse_identifiers(self, ids_list):
+    def str_width(self, values):
+        """Work out the str width for a column of string values, the
+        best_str_len of the longest value. The width of the longest
+        value in several tables is the widest of their widths, so tables
+        of results processed in batches widen to the same width as one
+        table of them all.
+        """
+        longest = 0
+        for value in values:
+            if value is not np.ma.masked and value is not None:
+                longest = max(longest, len(value))
+        return self.best_str_len(longest)
+
+    def parse_identifiers(self, identifiers):
         """
         Returns a single-row table containing the chosen identifiers
-        that can be hstack'd onto a 1-row table of other info about this
-        object.
+        that can be hstack'd onto a 1-row table of other info about the
+        object of the latest query.
+
+        identifiers may be the '|'-separated IDS field returned along with
+        the main data of the object, or a list of identifiers as returned
+        by Simbad.query_objectids.
         """
-        p_id_names  = ['WDS', 'SAO', 'HIP', 'NAME', 'HD'];
-        p_id_vals   = []
-        # Can't use ints for HD as some have Alphanumeric suffices.
-        ##p_id_dtypes = ['U20', np.int32, np.int32, 'U20', np.int32]
-        p_id_dtypes = ['U20', 'U20', 'U20', 'U20', 'U20']
-    
-        ids_list.sort()
-    
-        for identifier in p_id_names:
-            p_identifier_list=[]
-            for line in ids_list:
-                p_split = line.decode('utf-8').split()
-                if identifier in p_split[0]:
-                    p_identifier_list.append(p_split[1])
-    
+        p_id_vals = self.parse_identifiers_batch([identifiers], [self.query_id])
+        return self.make_id_table(p_id_vals)
+
+    def make_id_table(self, id_values_list):
+        """Returns a table of the identifiers chosen by
+        parse_identifiers_batch, with a row for each object.
+        """
+        # create table, rows has really to be a list of lists, not just a list.
+        p_interesting_ids = Table(rows=id_values_list,
+            names=ID_NAMES, dtype=ID_DTYPES)
+            
+        return p_interesting_ids
+
+    def parse_identifiers_batch(self, identifiers_list, query_ids):
+        """Chooses the identifiers of each type in ID_NAMES for a batch of
+        objects, given the identifiers of each object (in any form
+        accepted by parse_identifiers) and the ID used to query Simbad
+        for it.
+
+        Returns a list with the chosen values for each object, in the
+        order of ID_NAMES, with None where an object has no identifier
+        of that type.
+        """
+        return [self.choose_identifiers(self.classify_identifiers(identifiers), query_id)
+            for identifiers, query_id in zip(identifiers_list, query_ids)]
+
+    def classify_identifiers(self, identifiers):
+        """Returns a dictionary of the identifiers of each type in ID_NAMES
+        found in identifiers, each a list of (identifier, value) tuples.
+
+        Each identifier is split only once. Its type is found from its
+        catalog prefix, e.g. 'HD' for 'HD 12345', and is any of ID_NAMES
+        contained in the prefix.
+        """
+        classified = {}
+        for ident in self.split_ids(identifiers):
+            p_split = ident.split()
+            if len(p_split) < 2:
+                continue
+            id_types = self.prefix_types.get(p_split[0])
+            if id_types is None:
+                id_types = [name for name in ID_NAMES if name in p_split[0]]
+                self.prefix_types[p_split[0]] = id_types
+            for name in id_types:
+                classified.setdefault(name, []).append((ident, p_split[1]))
+        return classified
+
+    def choose_identifiers(self, classified, query_id):
+        """Chooses one value of each identifier type in ID_NAMES from the
+        classified identifiers of an object, warning if there are several.
+        """
+        p_id_vals = []
+        for identifier in ID_NAMES:
+            p_pairs = classified.get(identifier, [])
+
             # check how many results we've got
-            if len(p_identifier_list) > 1:
+            if len(p_pairs) > 1:
+                # Choose among identifiers in sorted order
+                p_identifier_list = [value for ident, value in sorted(p_pairs)]
                 p_choice = None
                 # Treatment depends on type of identifier
                 if identifier in 'WDS':
                     # choose shortest string unless that WDS is the
                     # actual query. 
-                    if 'WDS' in self.query_id:
+                    if 'WDS' in query_id:
                         for wds_item in p_identifier_list:
-                            if wds_item in self.query_id:
+                            if wds_item in query_id:
                                 # Matches input query, so choose that
                                 p_choice = wds_item
                     if p_choice is None:
@@ -337,22 +745,17 @@ class SimbadStarQuery:
                 p_id_vals.append(p_choice)
                 print('  Warning: For identifier={} multiple responses found: {}'.format(identifier, p_identifier_list))
                 print('    Choosing {}'.format(p_choice))
-            elif len(p_identifier_list) == 1:
-                p_id_vals.append(p_identifier_list[0])
+            elif len(p_pairs) == 1:
+                p_id_vals.append(p_pairs[0][1])
             else:
                 p_id_vals.append(None)
-    
-        # create table, rows has really to be a list of lists, not just a list.
-        p_interesting_ids = Table(rows=[p_id_vals],
-            names=p_id_names, dtype=p_id_dtypes)
-            
-        return p_interesting_ids
+        return p_id_vals
     
     def fix_coordinates(self, simbad_table, ra_name, dec_name, sys='icrs'):
         """Perform some fix-up work on the coordinate info returned by a Simbad query_object
         
         This routine takes the arbitrary precision string-formatted
-        coordinates from the table row returned by the simbad query,
+        coordinates from the table rows returned by the simbad query,
         and does the following:
         - Creates a SkyCooord object
         - Extracts floating point RA and DEC in decimal degrees, more
@@ -361,31 +764,29 @@ class SimbadStarQuery:
           precision (0.1 seconds, 0.1 arcseconds), which looks better
           for textual presentation as it has a fixed width.
         """
-        ra_str  = simbad_table[ra_name][0]
-        dec_str = simbad_table[dec_name][0]
+        ra_strs  = simbad_table[ra_name]
+        dec_strs = simbad_table[dec_name]
     
-        # convert to sky coord
-        sc = SkyCoord([(ra_str, dec_str)], unit=(u.hourangle, u.deg), frame=sys)
-        # returns a list, so just get first element
-        ra_deg  = sc.ra.degree[0]
-        dec_deg = sc.dec.degree[0]
-        # sc.ra.to_string returns a list, so just get first element
-        ra_str  = sc.ra.to_string(u.hour, sep=':', precision=1)[0]
-        dec_str = sc.dec.to_string(u.deg, sep=':', precision=1)[0]
+        # convert to sky coord, one for each row
+        sc = SkyCoord(list(zip(ra_strs, dec_strs)), unit=(u.hourangle, u.deg), frame=sys)
+        ra_deg  = sc.ra.degree
+        dec_deg = sc.dec.degree
+        ra_strs  = sc.ra.to_string(u.hour, sep=':', precision=1)
+        dec_strs = sc.dec.to_string(u.deg, sep=':', precision=1)
             
         # update existing columns
-        simbad_table[ra_name][0] = ra_str
-        simbad_table[dec_name][0] = dec_str
+        simbad_table[ra_name][:] = ra_strs
+        simbad_table[dec_name][:] = dec_strs
         simbad_table[ra_name].description = 'Right ascension, HMS, ICRS at J2000 epoch'
         simbad_table[dec_name].description = 'Declination, DMS, ICRS at J2000 epoch'
 
         # add in floating point degrees
         dec_index = simbad_table.index_column(dec_name)
-        ra_col = Column([ra_deg], 
+        ra_col = Column(ra_deg, 
             name='{}_deg'.format(ra_name), unit='deg',
             format='{:.6f}',
             description='Right ascension in decimal degrees')
-        dec_col = Column([dec_deg], 
+        dec_col = Column(dec_deg, 
             name='{}_deg'.format(dec_name), unit='deg',
             format='{:.6f}',
             description='Declination in decimal degrees')
@@ -397,11 +798,106 @@ class SimbadStarQuery:
             copy=True)
         return
     
-    def add_user_ident(self, simbad_table):
-        """Adds a column for the user-supplied ID to the table
+    def add_user_ident(self, simbad_table, user_idents):
+        """Adds a column for the user-supplied IDs to the table
         """
-        user_col = Column([self.user_ident],
+        user_col = Column(user_idents,
             name='Star', format='{}', dtype='U24',
             description='User-supplied star object ID')
         simbad_table.add_column(user_col, index=0)
         return
+
+class SimbadResultBuffer:
+    """Collects the raw Simbad results of many objects, found by
+    SimbadStarQuery.fetch_result, in preallocated per-column buffers and
+    processes them into a single table at the end, rather than building
+    a table for each object and adding its row to the output table.
+    Long lists can be processed a batch at a time with flush.
+
+    The columns and their types are fixed by the first result added.
+    String columns are only as wide as the results since the last flush
+    need, so each batch's table depends on its own results alone, and
+    the TableWriter it is written with widens the columns to fit.
+    """
+    def __init__(self, star_query, num_rows):
+        """Initializes a buffer for the results of up to num_rows objects
+        found by the SimbadStarQuery star_query, or up to num_rows
+        between calls to flush"""
+        self.star_query = star_query
+        self.num_rows = num_rows
+        self.num_used = 0
+        self.columns = None
+        self.data = {}
+        self.mask = {}
+        self.user_idents = []
+        self.id_values_list = []
+        return
+
+    def make_buffers(self):
+        """Allocates empty buffers for the columns, with string columns
+        one character wide"""
+        for column in self.columns:
+            dtype = column.dtype
+            if dtype.kind in 'SU':
+                dtype = np.dtype(dtype.kind + '1')
+            self.data[column.name] = np.zeros(self.num_rows, dtype=dtype)
+        self.mask = {}
+        return
+
+    def add(self, sid):
+        """Adds the result of the latest successful call of fetch_result
+        of the SimbadStarQuery sid as the next row"""
+        result_table = sid.result_table
+        if self.columns is None:
+            # The columns of the first result define the schema
+            self.columns = result_table.columns.values()
+            self.make_buffers()
+
+        row = self.num_used
+        for colname, data in self.data.items():
+            column = result_table[colname]
+            # Widen string columns to the widest value
+            if column.dtype != data.dtype and column.dtype.kind in 'SU':
+                data = data.astype(np.promote_types(data.dtype, column.dtype))
+                self.data[colname] = data
+            data[row] = np.ma.getdata(column)[0]
+            if isinstance(column, MaskedColumn) and column.mask[0]:
+                if colname not in self.mask:
+                    self.mask[colname] = np.zeros(self.num_rows, dtype=bool)
+                self.mask[colname][row] = True
+
+        # Choose the identifiers now so any warnings go with this object
+        self.id_values_list += self.star_query.parse_identifiers_batch([sid.identifiers],
+            [sid.query_id])
+        self.user_idents.append(sid.user_ident)
+        self.num_used += 1
+        return
+
+    def table(self):
+        """Returns the processed table of all the results added, or None
+        if there are none"""
+        if self.num_used == 0:
+            return None
+        result_table = Table()
+        for column in self.columns:
+            data = self.data[column.name][:self.num_used]
+            if column.name in self.mask:
+                data = np.ma.array(data, mask=self.mask[column.name][:self.num_used])
+                if not isinstance(column, MaskedColumn):
+                    column = MaskedColumn(column)
+            elif isinstance(column, MaskedColumn):
+                data = np.ma.array(data, mask=False)
+            result_table.add_column(column.copy(data=data), copy=False)
+        return self.star_query.process_results(result_table, self.user_idents,
+            self.id_values_list)
+
+    def flush(self):
+        """Returns the processed table of the results added since the
+        last flush, or None if there are none, and empties the buffer"""
+        table = self.table()
+        self.num_used = 0
+        self.user_idents = []
+        self.id_values_list = []
+        if self.columns is not None:
+            self.make_buffers()
+        return table
@@ -14,7 +14,13 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-from astropy.table import Table, Column, Row, vstack
+import hashlib
+import os
+import os.path
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Column, MaskedColumn
 import DavesAstropyUtils as dapu
 
 __author__     = "Dave Strickland"
@@ -25,31 +31,558 @@ __email__      = "dave.strickland@gmail.com"
 __license__    = "GPLv3"
 __version__    = "0.2.0"
 
+# Substrings of the WDS 'Comp' and 'Notes' columns used by the filters.
+SPECTROSCOPIC_COMPS = ['a,']
+ABC_COMPS           = ['AB', 'Aa', 'AC', 'BC']
+PHYSICAL_NOTES      = ['C', 'O', 'T', 'V', 'Z']
+UNPHYSICAL_NOTES    = ['S', 'U', 'X', 'Y']
+
+# Columns of the WDS catalog that we're not likely to need. These are
+# not read from the catalog at all when it is in FITS format.
+CLEANED_COLUMNS = ['Disc', 'Obs1', 'Nobs', 'pa1', 'sep1',
+    'pmRA1', 'pmDE1', 'pmRA2', 'pmDE2', 'DM', 
+    'n_RAh', 'RAh', 'RAm', 'RAs',
+    'DE-', 'DEd', 'DEm', 'DEs']
+
+# WDS precise coordinate columns, used to calculate RAdeg and DEdeg.
+PRECISE_COORD_COLUMNS = ['RAh', 'RAm', 'RAs', 'DE-', 'DEd', 'DEm', 'DEs']
+
+# Low cardinality string columns that are stored as integer codes into
+# a dictionary of their distinct values. See WDS.encode_categories.
+CATEGORICAL_COLUMNS = ['Comp', 'Notes', 'SpType']
+
+# Columns added to the catalog by WDS itself rather than read from it.
+DERIVED_COLUMNS = ['RAdeg', 'DEdeg']
+
+# Increment whenever the contents of the catalog snapshot change.
+SNAPSHOT_VERSION = 4
+
 class WDS:
     """Utility to access data from the Washington Double Star
     catalog
     """
-    def __init__(self, wds_data_file, max_mag_diff, verbose):
+    def __init__(self, wds_data_file, max_mag_diff, verbose,
+        snapshot_dir=None, use_snapshot=True, columns=None):
+        """Loads the WDS catalog.
+
+        If an up to date snapshot of the cleaned catalog exists (see
+        write_snapshot and wds_snapshot.py) it is memory-mapped from
+        snapshot_dir, otherwise the catalog is read from wds_data_file.
+        By default snapshot_dir lives alongside wds_data_file.
+
+        columns optionally lists the catalog columns to read from
+        wds_data_file. By default every column except CLEANED_COLUMNS
+        is read. It must include the columns used by the filters.
+        """
         self.wds_data_file = wds_data_file
+        self.columns = columns
         self.max_mag_diff = float(max_mag_diff)
         self.verbose = verbose
-        self.wdsdata = dapu.read_table(self.wds_data_file, verbose)
+        self.current_id = None
+        self.current_data = None
+        self.filter_cache = {}
+        self.id_list_arrays = {}
+        self.id_list_memo = {}
+        if snapshot_dir is None:
+            snapshot_dir = default_snapshot_dir(wds_data_file)
+        self.snapshot_dir = snapshot_dir
+        if use_snapshot and self.snapshot_is_current():
+            self.read_snapshot()
+        else:
+            self.read_catalog()
+        return
+
+    def read_catalog(self):
+        """Reads, cleans and indexes the WDS catalog from wds_data_file"""
+        columns = self.columns
+        if columns is None and 'fits' in self.wds_data_file:
+            # Project out the unwanted columns while reading, keeping
+            # those needed to calculate the primary position.
+            columns = [col for col in dapu.read_fits_column_names(self.wds_data_file)
+                if col not in CLEANED_COLUMNS or col in PRECISE_COORD_COLUMNS]
+        self.wdsdata = dapu.read_table(self.wds_data_file, self.verbose, columns)
+        self.add_coordinates()
         self.clean()
-        self.wdsdata.add_index('WDS')
+        self.build_index()
+        self.build_spatial_index()
+        # The remaining string columns are left as byte strings, which
+        # need a quarter of the memory of unicode. Tables of selected
+        # components are converted to unicode by decode_table.
+        self.encode_categories()
+        return
+
+    def encode_categories(self):
+        """Replaces each of the CATEGORICAL_COLUMNS of the catalog by an
+        integer column of codes into a dictionary of the column's distinct
+        values, which is stored as the unicode array
+        wdsdata[name].meta['categories']. Missing values are stored as
+        empty strings.
+
+        Filters on these columns are evaluated once per distinct value
+        rather than once per row (see categorical_parts).
+        """
+        for name in CATEGORICAL_COLUMNS:
+            if name not in self.wdsdata.colnames:
+                continue
+            col = self.wdsdata[name]
+            categories, codes = np.unique(np.ma.filled(np.ma.asarray(col), ''),
+                return_inverse=True)
+            if categories.dtype.kind == 'S':
+                categories = np.char.decode(categories, 'ascii')
+            self.wdsdata.replace_column(name, Column(
+                codes.astype(np.min_scalar_type(len(categories))), name=name,
+                description=col.description, meta={'categories': categories}))
+        if self.verbose:
+            for name in CATEGORICAL_COLUMNS:
+                if name in self.wdsdata.colnames:
+                    print('Stored {} as codes for {} distinct values'.format(name,
+                        len(self.wdsdata[name].meta['categories'])))
+        return
+
+    def decode_table(self, wds_table):
+        """Converts a table of catalog rows, e.g. a slice of wdsdata, into
+        the form written to output tables: categorical columns are replaced
+        by their string values (masked where missing) and byte string
+        columns are converted to unicode.
+        """
+        for name in wds_table.colnames:
+            categories, codes = categorical_parts(wds_table[name])
+            if categories is None:
+                continue
+            data = categories[codes]
+            wds_table.replace_column(name, MaskedColumn(data, name=name,
+                mask=(data == ''), description=wds_table[name].description))
+        wds_table.convert_bytestring_to_unicode()
+        return wds_table
+
+    def snapshot_is_current(self):
+        """Checks whether the snapshot in snapshot_dir was built from the
+        current version of wds_data_file by this version of the code.
+        """
+        meta = dapu.read_snapshot_meta(self.snapshot_dir)
+        if meta is None:
+            return False
+        if meta.get('version') != SNAPSHOT_VERSION:
+            print('Warning: WDS snapshot {} was written by a different version'.format(
+                self.snapshot_dir) + ' of WDS.py. Reading {} instead.'.format(self.wds_data_file))
+            return False
+        if os.path.isfile(self.wds_data_file):
+            # The size rules most changes out without reading the file.
+            # A copy keeping the old size and time needs the checksum.
+            if (meta.get('source_size') != os.path.getsize(self.wds_data_file) or
+                meta.get('source_sha256') != file_sha256(self.wds_data_file)):
+                print('Warning: WDS snapshot {} is older than {}. Reading that instead.'.format(
+                    self.snapshot_dir, self.wds_data_file))
+                print('  Run wds_snapshot.py to rebuild the snapshot.')
+                return False
+        if self.columns is not None:
+            missing = set(self.columns) - set(dapu.read_snapshot_column_names(self.snapshot_dir))
+            if len(missing) > 0:
+                print('Warning: WDS snapshot {} does not have columns {}. Reading {} instead.'.format(
+                    self.snapshot_dir, sorted(missing), self.wds_data_file))
+                return False
+        return True
+
+    def read_snapshot(self):
+        """Memory-maps the cleaned catalog and its index from snapshot_dir"""
+        columns = None
+        if self.columns is not None:
+            columns = list(self.columns) + DERIVED_COLUMNS
+        self.wdsdata, extra_arrays = dapu.read_table_snapshot(self.snapshot_dir,
+            self.verbose, columns)
+        self.index_keys = extra_arrays['index_keys']
+        self.index_bounds = extra_arrays['index_bounds']
+        self.coord_order = extra_arrays['coord_order']
+        self.coord_dec = extra_arrays['coord_dec']
+        for name in CATEGORICAL_COLUMNS:
+            if name in self.wdsdata.colnames:
+                self.wdsdata[name].meta['categories'] = extra_arrays['categories_'+name]
+
+        # Component ID lists precomputed by write_snapshot. Those that
+        # depend on the magnitude difference are only valid if it matches.
+        meta = dapu.read_snapshot_meta(self.snapshot_dir)
+        for idx, info in enumerate(meta.get('id_lists', [])):
+            if info['max_mag_diff'] not in [None, self.max_mag_diff]:
+                continue
+            self.id_list_arrays[info['filter']] = (extra_arrays['id_names_{}'.format(idx)],
+                extra_arrays['id_offsets_{}'.format(idx)])
+        return
+
+    def write_snapshot(self, filter_modes=None):
+        """Writes the cleaned, sorted catalog and its index to snapshot_dir
+        as uncompressed numpy files that later runs can memory-map.
+
+        The component ID lists of every system (see id_lists) are also
+        precomputed and stored for each of the filter modes listed in
+        filter_modes. Lists for filters that depend on the magnitude
+        difference are only used by later runs with the same max_mag_diff.
+        """
+        stat = os.stat(self.wds_data_file)
+        meta = {'version': SNAPSHOT_VERSION,
+            'source_file':     os.path.abspath(self.wds_data_file),
+            'source_size':     stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'source_sha256':   file_sha256(self.wds_data_file)}
+        extra_arrays = {'index_keys': self.index_keys,
+            'index_bounds': self.index_bounds,
+            'coord_order':  self.coord_order,
+            'coord_dec':    self.coord_dec}
+        for name in CATEGORICAL_COLUMNS:
+            if name in self.wdsdata.colnames:
+                extra_arrays['categories_'+name] = self.wdsdata[name].meta['categories']
+
+        meta['id_lists'] = []
+        for idx, filter_mode in enumerate(filter_modes or []):
+            compiled_filter = self.compile_filter(filter_mode)
+            names, offsets = self.id_lists(compiled_filter)
+            extra_arrays['id_names_{}'.format(idx)] = names
+            extra_arrays['id_offsets_{}'.format(idx)] = offsets
+            meta['id_lists'].append({'filter': compiled_filter.expression,
+                'max_mag_diff': self.max_mag_diff if compiled_filter.uses_max_mag_diff else None})
+
+        dapu.write_table_snapshot(self.wdsdata, self.snapshot_dir,
+            extra_arrays=extra_arrays, meta=meta)
+        print('Wrote snapshot of {} WDS components to {}'.format(len(self.wdsdata),
+            self.snapshot_dir))
         return
         
     def clean(self):
-        """Removes table columns we're not likely to need"""
-        cols_to_clean = ['Disc', 'Obs1', 'Nobs', 'pa1', 'sep1',
-            'pmRA1', 'pmDE1', 'pmRA2', 'pmDE2', 'DM', 
-            'n_RAh', 'RAh', 'RAm', 'RAs',
-            'DE-', 'DEd', 'DEm', 'DEs'];
+        """Removes table columns we're not likely to need, if they
+        weren't already left out when reading the catalog."""
+        cols_to_clean = [col for col in CLEANED_COLUMNS
+            if col in self.wdsdata.colnames]
         self.wdsdata.remove_columns(cols_to_clean)
         if self.verbose:
             print('Remaining table columns:')
             print(self.wdsdata.info)
         return
 
+    def build_index(self):
+        """Sorts the catalog by WDS ID and component, and records where
+        the rows of each WDS system start and end.
+
+        index_keys holds the unique WDS IDs in sorted order, and the
+        rows of system index_keys[i] are index_bounds[i] up to (but not
+        including) index_bounds[i+1]. This replaces an astropy table
+        index and allows many WDS IDs to be looked up at once with
+        numpy.searchsorted.
+        """
+        wds_col  = np.ma.filled(np.ma.asarray(self.wdsdata['WDS']), '')
+        comp_col = np.ma.filled(np.ma.asarray(self.wdsdata['Comp']), '')
+        # lexsort is stable, and sorts on the last key first.
+        order = np.lexsort((comp_col, wds_col))
+        del comp_col
+        wds_col = wds_col[order]
+        # Reorder one column at a time so that at most one extra column
+        # is held in memory, rather than a copy of the whole table.
+        for name in self.wdsdata.colnames:
+            self.wdsdata.replace_column(name, self.wdsdata[name][order])
+
+        starts = np.flatnonzero(np.append(True, wds_col[1:] != wds_col[:-1]))
+        self.index_keys = wds_col[starts]
+        self.index_bounds = np.append(starts, len(wds_col))
+        if self.verbose:
+            print('Indexed {} WDS systems'.format(len(self.index_keys)))
+        return
+
+    def lookup_systems(self, wds_ids):
+        """Finds the position of each WDS ID within index_keys.
+
+        Returns a tuple (pos, found) of integer positions and a boolean
+        array that is False for WDS IDs not present in the catalog, whose
+        positions are meaningless. Entries of wds_ids that are None are
+        treated as not found.
+        """
+        key_list = ['' if wds_id is None else wds_id for wds_id in wds_ids]
+        if self.index_keys.dtype.kind == 'S':
+            key_list = [key.encode('ascii') for key in key_list]
+        keys = np.array(key_list, dtype=self.index_keys.dtype)
+
+        num_keys = len(self.index_keys)
+        pos = np.searchsorted(self.index_keys, keys)
+        pos_clip = np.minimum(pos, num_keys - 1)
+        found = (pos < num_keys) & (self.index_keys[pos_clip] == keys)
+        return pos_clip, found
+
+    def lookup_rows(self, wds_ids):
+        """Finds the catalog rows of the components of each WDS ID.
+
+        Returns a tuple (rows, group, found) where rows are indices into
+        wdsdata, group gives the position within wds_ids that each of
+        those rows belongs to, and found is a boolean array that is False
+        for WDS IDs not present in the catalog. Entries of wds_ids that
+        are None are treated as not found.
+        """
+        pos_clip, found = self.lookup_systems(wds_ids)
+        starts = np.where(found, self.index_bounds[pos_clip], 0)
+        counts = np.where(found, self.index_bounds[pos_clip + 1] - starts, 0)
+        rows, group = expand_ranges(starts, counts)
+        return rows, group, found
+
+    def add_coordinates(self):
+        """Adds RAdeg and DEdeg columns holding the J2000 position of each
+        system's primary in decimal degrees.
+
+        These are computed from the WDS precise coordinate columns (RAh,
+        RAm, RAs, DE-, DEd, DEm and DEs). Where those are missing the
+        arcminute-precision position encoded in the WDS ID is used.
+        """
+        num_rows = len(self.wdsdata)
+        if all(col in self.wdsdata.colnames for col in PRECISE_COORD_COLUMNS):
+            piece = {}
+            for col in PRECISE_COORD_COLUMNS:
+                if col == 'DE-':
+                    continue
+                piece[col] = np.ma.filled(np.ma.asarray(self.wdsdata[col], dtype=float),
+                    np.nan)
+            de_sign = np.ma.filled(np.ma.asarray(self.wdsdata['DE-']), '')
+            de_sign = np.where(np.char.find(de_sign.astype('U1'), '-') >= 0, -1.0, 1.0)
+            ra_deg = 15.0 * (piece['RAh'] + piece['RAm']/60.0 + piece['RAs']/3600.0)
+            dec_deg = de_sign * (piece['DEd'] + piece['DEm']/60.0 + piece['DEs']/3600.0)
+        else:
+            ra_deg = np.full(num_rows, np.nan)
+            dec_deg = np.full(num_rows, np.nan)
+
+        missing = np.isnan(ra_deg) | np.isnan(dec_deg)
+        if np.any(missing):
+            wds_col = np.ma.filled(np.ma.asarray(self.wdsdata['WDS']), '')
+            ra_deg[missing], dec_deg[missing] = wds_id_coordinates(wds_col[missing])
+            if self.verbose:
+                print('Using WDS ID positions for {} components without precise'.format(
+                    np.count_nonzero(missing)) + ' coordinates')
+
+        self.wdsdata['RAdeg'] = Column(ra_deg, unit='deg', format='{:.6f}',
+            description='Right ascension of primary in decimal degrees, J2000')
+        self.wdsdata['DEdeg'] = Column(dec_deg, unit='deg', format='{:.6f}',
+            description='Declination of primary in decimal degrees, J2000')
+        return
+
+    def build_spatial_index(self):
+        """Builds a declination-sorted index of the catalog positions.
+
+        coord_dec holds the DEdeg of every row in increasing order and
+        coord_order the corresponding row numbers, so the candidates
+        for a cone search are a single slice found with searchsorted.
+        """
+        dec_deg = np.asarray(self.wdsdata['DEdeg'])
+        self.coord_order = np.argsort(dec_deg, kind='stable')
+        self.coord_dec = dec_deg[self.coord_order]
+        return
+
+    def add_secondary_positions(self, wds_table):
+        """Adds RA2deg and DE2deg columns to a table of WDS components,
+        holding the position of each pair's secondary in decimal degrees.
+
+        The positions are offset from the primary position (RAdeg, DEdeg)
+        by the most recent separation and position angle (sep2, pa2),
+        for every row of the table in a single SkyCoord calculation.
+        Rows without a separation or position angle get NaN positions.
+        """
+        ra_deg  = np.ma.filled(np.ma.asarray(wds_table['RAdeg'], dtype=float), np.nan)
+        dec_deg = np.ma.filled(np.ma.asarray(wds_table['DEdeg'], dtype=float), np.nan)
+        sep     = np.ma.filled(np.ma.asarray(wds_table['sep2'], dtype=float), np.nan)
+        pa      = np.ma.filled(np.ma.asarray(wds_table['pa2'], dtype=float), np.nan)
+        primary = SkyCoord(ra=ra_deg*u.deg, dec=dec_deg*u.deg, frame='icrs')
+        secondary = primary.directional_offset_by(pa*u.deg, sep*u.arcsec)
+
+        wds_table['RA2deg'] = Column(secondary.ra.degree, unit='deg', format='{:.6f}',
+            description='Right ascension of secondary in decimal degrees, J2000')
+        wds_table['DE2deg'] = Column(secondary.dec.degree, unit='deg', format='{:.6f}',
+            description='Declination of secondary in decimal degrees, J2000')
+        return
+
+    def component_positions(self, wds_table):
+        """Returns a dictionary mapping the Simbad compatible WDS ID of
+        each component in wds_table, J<wds_id><name> for each of the
+        component names given by component_list, to its (RA, Dec) in
+        decimal degrees.
+
+        Primaries take the RAdeg, DEdeg position and secondaries the
+        RA2deg, DE2deg position added by add_secondary_positions. Where
+        a component appears in several pairs the first position is used.
+        """
+        if 'RA2deg' not in wds_table.colnames:
+            self.add_secondary_positions(wds_table)
+        positions = {}
+        wds_col  = np.ma.filled(np.ma.asarray(wds_table['WDS']), '')
+        comp_col = np.ma.filled(np.ma.asarray(wds_table['Comp']), '')
+        coords = np.column_stack([np.asarray(wds_table[col], dtype=float)
+            for col in ['RAdeg', 'DEdeg', 'RA2deg', 'DE2deg']])
+        for wds_id, comp, coord in zip(wds_col, comp_col, coords):
+            primary, secondary = component_names(comp)
+            for name, position in [(primary, coord[0:2]), (secondary, coord[2:4])]:
+                if name is None:
+                    continue
+                simbad_id = ''.join(['J', wds_id, name])
+                if simbad_id not in positions:
+                    positions[simbad_id] = tuple(position)
+        return positions
+
+    def cone_search_batch(self, ra, dec, radius):
+        """Finds the catalog components within radius of many positions.
+
+        ra, dec and radius are in decimal degrees, and may be arrays or
+        scalars (a scalar radius applies to every position). Returns a
+        table of the matching catalog rows with an additional 'Target'
+        column giving the index of the position each row matched, and a
+        'Sep' column holding the separation in arcseconds. The table is
+        sorted by target and then by separation.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), ra.shape)
+
+        # Candidates lie in the declination band of each search cone.
+        lo = np.searchsorted(self.coord_dec, dec - radius, side='left')
+        hi = np.searchsorted(self.coord_dec, dec + radius, side='right')
+        positions, target = expand_ranges(lo, hi - lo)
+        rows = self.coord_order[positions]
+
+        sep = angular_separation(ra[target], dec[target],
+            np.asarray(self.wdsdata['RAdeg'])[rows],
+            np.asarray(self.wdsdata['DEdeg'])[rows])
+        inside = sep <= radius[target]
+        rows, target, sep = rows[inside], target[inside], sep[inside]
+        order = np.lexsort((sep, target))
+
+        matches = self.decode_table(self.wdsdata[rows[order]])
+        matches.add_column(Column(target[order], name='Target',
+            description='Index of the search position'), index=0)
+        matches['Sep'] = Column(3600.0*sep[order], unit='arcsec', format='{:.1f}',
+            description='Separation from the search position')
+        return matches
+
+    def cone_search(self, ra, dec, radius):
+        """Returns a table of the catalog components within radius of the
+        position ra, dec, sorted by separation. All inputs are in decimal
+        degrees. See cone_search_batch for the table contents.
+        """
+        matches = self.cone_search_batch([ra], [dec], radius)
+        matches.remove_column('Target')
+        return matches
+
+    def get_likely_components_batch(self, wds_ids, filter_mode=None):
+        """Filters the components of many WDS systems at once.
+
+        Every WDS ID in wds_ids is looked up in a single pass over the
+        sorted catalog, and the filters associated with filter_mode (see
+        get_likely_components) are applied to all of their components
+        together.
+
+        Returns a tuple of the combined table of the components that
+        passed filtering, in the same order as wds_ids, and a list
+        containing the Simbad compatible WDS IDs of each input WDS ID.
+        Entries in this list are None if no components remain after
+        filtering, or if the WDS ID is not in the catalog.
+        """
+        if filter_mode is None:
+            filter_mode = 'negative'
+        try:
+            compiled_filter = self.compile_filter(filter_mode)
+        except ValueError as err:
+            print('Error: Unexpected filter_mode={} specified. {}'.format(filter_mode, err))
+            compiled_filter = self.compile_filter('all')
+
+        rows, group, found = self.lookup_rows(wds_ids)
+        for wds_id in np.asarray(wds_ids, dtype=object)[~found]:
+            if wds_id is not None:
+                print('  Warning: WDS ID {} not found in {}'.format(wds_id,
+                    self.wds_data_file))
+
+        candidates = self.wdsdata[rows]
+        keep = compiled_filter.mask(candidates, self.max_mag_diff)
+        if self.verbose:
+            print('  Selected {} of {} WDS components using {} filter'.format(
+                np.count_nonzero(keep), len(keep), filter_mode))
+        detail_table = self.decode_table(candidates[keep])
+        self.add_secondary_positions(detail_table)
+        ids_lists = self.component_id_lists(wds_ids, compiled_filter)
+        return detail_table, ids_lists
+
+    def component_id_lists(self, wds_ids, filter_mode=None):
+        """Returns a list containing the Simbad compatible WDS IDs of
+        the components of each WDS ID in wds_ids that pass filter_mode,
+        J<wds_id><name> for each of the sorted, unique component names
+        given by component_list. Entries are None if no components
+        pass filtering, or if the WDS ID is not in the catalog.
+
+        The lists come from the arrays precomputed by id_lists, and are
+        remembered so that looking up the same system again is a single
+        dictionary access.
+        """
+        if filter_mode is None:
+            filter_mode = 'negative'
+        compiled_filter = self.compile_filter(filter_mode)
+        names, offsets = self.id_lists(compiled_filter)
+        memo = self.id_list_memo.setdefault(compiled_filter.expression, {})
+
+        new_ids = list(set([wds_id for wds_id in wds_ids
+            if wds_id is not None and wds_id not in memo]))
+        if len(new_ids) > 0:
+            pos, found = self.lookup_systems(new_ids)
+            for wds_id, idx, is_found in zip(new_ids, pos, found):
+                memo[wds_id] = None
+                if is_found and offsets[idx+1] > offsets[idx]:
+                    memo[wds_id] = [''.join(['J', wds_id, name])
+                        for name in names[offsets[idx]:offsets[idx+1]]]
+
+        ids_lists = []
+        for wds_id in wds_ids:
+            if wds_id is None or memo[wds_id] is None:
+                ids_lists.append(None)
+            else:
+                ids_lists.append(list(memo[wds_id]))
+        return ids_lists
+
+    def id_lists(self, filter_mode):
+        """Returns the component names of every WDS system in the catalog
+        that pass filter_mode, computing them the first time each filter
+        mode is used unless they were read from the snapshot.
+
+        Returns a tuple (names, offsets) where the sorted, unique Simbad
+        component names (see component_list) of system
+        index_keys[i] are names[offsets[i]:offsets[i+1]].
+        """
+        compiled_filter = self.compile_filter(filter_mode)
+        if compiled_filter.expression not in self.id_list_arrays:
+            self.id_list_arrays[compiled_filter.expression] = self.build_id_lists(
+                compiled_filter)
+        return self.id_list_arrays[compiled_filter.expression]
+
+    def build_id_lists(self, compiled_filter):
+        """Computes the (names, offsets) arrays described in id_lists by
+        applying a compiled filter to the whole catalog at once.
+        """
+        rows = np.flatnonzero(compiled_filter.mask(self.wdsdata, self.max_mag_diff))
+        system = np.searchsorted(self.index_bounds, rows, side='right') - 1
+        # There are few distinct Comp strings, so split each one once
+        # and expand the results into one entry per name of every row.
+        unique_comps, inverse = categorical_parts(self.wdsdata['Comp'])
+        if unique_comps is None:
+            comps = np.ma.filled(np.ma.asarray(self.wdsdata['Comp']), '')
+            unique_comps, inverse = np.unique(comps, return_inverse=True)
+            if unique_comps.dtype.kind == 'S':
+                unique_comps = np.char.decode(unique_comps, 'ascii')
+        inverse = inverse[rows]
+        split_comps = [component_list(comp) for comp in unique_comps]
+        name_counts = np.array([len(comp_names) for comp_names in split_comps], dtype=int)
+        all_names = np.array([name for comp_names in split_comps for name in comp_names],
+            dtype=str)
+        positions, group = expand_ranges((np.cumsum(name_counts) - name_counts)[inverse],
+            name_counts[inverse])
+        names = all_names[positions]
+        system = system[group]
+
+        # Sort by system then name, and remove duplicates.
+        order = np.lexsort((names, system))
+        names, system = names[order], system[order]
+        unique = np.append(True, (names[1:] != names[:-1]) | (system[1:] != system[:-1]))
+        names, system = names[unique], system[unique]
+        offsets = np.searchsorted(system, np.arange(len(self.index_keys) + 1))
+        if self.verbose:
+            print('Built component ID lists for {} filter'.format(compiled_filter.expression))
+        return names, offsets
+
     def get_likely_components(self, wds_id, filter_mode=None):
         """Performs a set of filtering operations on the
         list of possible stellar components.
@@ -71,267 +604,230 @@ class WDS:
         - prune_spectroscopic_binaries
         - prune_unphysical
         - prune_magnitude
-        """
-
-        if filter_mode is None:
-            filter_mode = 'negative'
-
-        self.current_id = wds_id
-        self.current_data = None
-        self.current_data = self.wdsdata.loc[wds_id]
-        
-        # If there is only a single row astropy returns a Row object
-        # instead of a Table. As other logic depends on Table format
-        # we convert these Rows into single row Tables
-        if isinstance(self.current_data, Row):
-            tmp_table = Table(rows=self.current_data, copy=True, copy_indices=False)
-            self.current_data = tmp_table
-
-        # This is necessary for string comparisons to table objects
-        # and the sort syntax to work.
-        self.current_data.convert_bytestring_to_unicode()
-
-        # Sort to get components in the sort of order we expect
-        self.current_data.sort('Comp')
-            
-        if 'negative' in filter_mode:
-            self.prune_spectroscopic_binaries()
-            self.prune_unphysical()
-            self.prune_mag_diff()
-        elif 'positive' in filter_mode:
-            self.select_physical()
-        elif 'abc' in filter_mode:
-            self.select_abc()
-        else:
-            print('Error: For {} unexpected filter_mode={} specified.'.format(wds_id, 
-                filter_mode))
 
-        ids_list = self.make_wds_id_list()
-        return self.current_data, ids_list
+        Any other filter expression understood by WDSFilter, combining
+        these modes with conditions on the catalog columns, may also
+        be used.
 
-    def make_wds_id_list(self):
-        """Convert remaining WDS components back into Simbad
-        compatible WDS IDs.
-        
-        The logic is relatively complex and is described within
-        the function body itself.
-        """
-        if self.current_data is None:
-            ids_list = None
-            return ids_list
-        num_comp = len(self.current_data)
-        if num_comp > 0:
-            ids_list = []
-            for idx in range(num_comp):
-                comp = self.current_data['Comp'][idx].strip()
-                if len(comp) == 0:
-                    # WDs seems not to state component names if there
-                    # aren't more than two, so AB is implied in such cases.
-                    comp='AB'
-                    
-                if 'a,' in comp:
-                    # If there is a lower case a, e.g. Aa,Ab then
-                    # Simbad will expect that entire string.
-                    ids_list.append(comp)
-                elif ',' in comp:
-                    # Cases like 'A,BC' seem to handled by Simbad
-                    # with a separate A and a separate BC component,
-                    # i.e. no separate B and C components.
-                    ids_list.extend( comp.split(',') )
-                else:
-                    # Cases like AB or BC, we need to split every
-                    # character
-                    for char in comp:
-                        ids_list.append(char)
-                
-            # Now remove duplicates and sort...
-            ids_list = list(sorted(set(ids_list)))
-        else:
-            ids_list = None
-            return ids_list
-            
-        # Convert back into Simbad form by adding in the J<wds_id> parts
-        simbad_ids_list = []
-        for comp in ids_list:
-            simbad_ids_list.append( ''.join(['J', self.current_id, comp]) )
-        return simbad_ids_list
-
-    def select_abc(self):
-        """A simplistic filter that only selects the A, B and C
-        components (if present) of any WDS system.
-        
-        This filter doesn't apply any physical criteria, rather
-        it exists to select the first few components that may
-        be part of a multiple system. This may correspond more
-        closely to common, purely visual, selection of close
-        double or triples than the 'negative'
-        filter implemented elsewhere in this class.
+        All the filters for the chosen mode are evaluated as boolean
+        masks over whole table columns (see filter_mask) and applied
+        to the component table in a single slice. To process many WDS
+        systems use get_likely_components_batch instead.
         """
-        if self.current_data is None:
-            return
-        if len(self.current_data) == 0:
-            self.current_data = None
-            return
-        row_list = []
-        for idx in range(len(self.current_data)):
-            comp = self.current_data['Comp'][idx].strip()
-            if len(comp) == 0:
-                # WDs seems not to state component names if there
-                # aren't more than two, so AB is implied in such cases.
-                comp='AB'
-
-            if 'AB' in comp:
-                continue
-            elif 'Aa' in comp:
-                # spectroscopic binary components
-                continue
-            elif 'AC' in comp:
-                continue
-            elif 'BC' in comp:
-                continue
-            else:
-                # remove to component
-                row_list.append(idx)
 
-        num_spec = len(row_list)
-        if num_spec > 0:
-            if self.verbose:
-                print('    For {} removed {} non-ABC components'.format(self.current_id,
-                    num_spec))
-            self.current_data.remove_rows(row_list)
+        detail_table, ids_lists = self.get_likely_components_batch([wds_id],
+            filter_mode)
+        self.current_id = wds_id
+        self.current_data = detail_table
         if len(self.current_data) == 0:
             self.current_data = None
-        return
+        return self.current_data, ids_lists[0]
 
-    def select_physical(self):
-        """Use WDS 'Notes' strings to select only those objects likely to
-        be physically part of the same stellar system.
-        
-        Select components with determined orbits, or statistically 
-        similar parallax and/or proper motions. These correspond 
-        to the WDS 'Note' column entries 'C', 'O', 'T', 'V' or 'Z'.
+    def filter_mask(self, wds_table, filter_mode):
+        """Returns a boolean mask selecting the rows of wds_table
+        that pass the filters associated with filter_mode.
+
+        filter_mode is either one of the named filter modes or a filter
+        expression (see WDSFilter), or an already compiled WDSFilter.
+        The mask is computed from whole table columns at once, so it
+        can be used on the components of a single WDS system or on
+        any number of systems at the same time.
         """
-        if self.current_data is None:
-            return
-        if len(self.current_data) == 0:
-            self.current_data = None
-            return
-        row_list = []
-        for idx in range(len(self.current_data)):
-            note_str = self.current_data['Notes'][idx]
-            if 'C' in note_str:
-                continue
-            elif 'O' in note_str:
-                continue
-            elif 'T' in note_str:
-                continue
-            elif 'V' in note_str:
-                continue
-            elif 'Z' in note_str:
-                continue
-            else:
-                # If we get here then we dont match any of the positive
-                # criteria, so add this row to the list to remove
-                row_list.append(idx)
+        try:
+            compiled_filter = self.compile_filter(filter_mode)
+        except ValueError as err:
+            print('Error: Unexpected filter_mode={} specified. {}'.format(filter_mode, err))
+            return np.ones(len(wds_table), dtype=bool)
+        return compiled_filter.mask(wds_table, self.max_mag_diff)
+
+    def compile_filter(self, filter_mode):
+        """Compiles a filter mode or expression into a WDSFilter, raising
+        ValueError if it is invalid or uses unknown catalog columns.
+
+        Compiled filters are cached, so each expression is only parsed
+        and checked once however many times it is used.
+        """
+        # Imported here as WDSFilter itself uses this module's filters.
+        import WDSFilter
+        if isinstance(filter_mode, WDSFilter.WDSFilter):
+            return filter_mode
+        if filter_mode not in self.filter_cache:
+            compiled_filter = WDSFilter.WDSFilter(filter_mode)
+            # Check the expression against an empty slice of the catalog.
+            compiled_filter.mask(self.wdsdata[:0], self.max_mag_diff)
+            self.filter_cache[filter_mode] = compiled_filter
+        return self.filter_cache[filter_mode]
+
+
+def contains_any(str_col, substrings):
+    """Returns a boolean mask that is True for every element of the
+    string column str_col that contains at least one of the substrings.
+
+    Works on unicode, byte string and categorical columns (see
+    categorical_parts).
+    """
+    categories, codes = categorical_parts(str_col)
+    if categories is not None:
+        return contains_any(categories, substrings)[codes]
+    data = np.ma.filled(np.ma.asarray(str_col), '')
+    is_bytes = data.dtype.kind == 'S'
+    mask = np.zeros(len(data), dtype=bool)
+    for sub in substrings:
+        if is_bytes:
+            sub = sub.encode('ascii')
+        mask |= np.char.find(data, sub) >= 0
+    return mask
+
+def categorical_parts(col):
+    """Returns a tuple (categories, codes) of the distinct values and
+    the integer codes of a categorical column created by
+    WDS.encode_categories, such that categories[codes] gives the value
+    of every row, or (None, None) for any other column.
+    """
+    meta = getattr(col, 'meta', None)
+    if meta is None or 'categories' not in meta:
+        return None, None
+    return np.asarray(meta['categories']), np.asarray(col)
+
+def spectroscopic_binary_mask(comp_col):
+    """Mask of components that are spectroscopic binaries, i.e. those
+    with lower case component names followed by commas, e.g. Aa,Ab.
+    """
+    return contains_any(comp_col, SPECTROSCOPIC_COMPS)
 
-        num_spec = len(row_list)
-        if num_spec > 0:
-            if self.verbose:
-                print('    For {} removed {} non-definite components'.format(self.current_id,
-                    num_spec))
-            self.current_data.remove_rows(row_list)
-        if len(self.current_data) == 0:
-            self.current_data = None
-        return
+def unphysical_mask(notes_col):
+    """Mask of components whose WDS notes flag them as unlikely to be
+    physically part of the same system (S, U, X or Y).
+    """
+    return contains_any(notes_col, UNPHYSICAL_NOTES)
 
+def physical_mask(notes_col):
+    """Mask of components whose WDS notes flag them as likely to be
+    physically part of the same system (C, O, T, V or Z).
+    """
+    return contains_any(notes_col, PHYSICAL_NOTES)
 
-    def prune_unphysical(self):
-        """Use WDS 'Notes' strings to remove objects likely not to
-        be physically part of the same stellar system.
-        
-        Remove components with statistically different parallax
-        and/or proper motions, or otherwise noted in the WDS as
-        being of dubious validity. These correspond to the WDS 'Note'
-        column entries 'S', 'U', 'X', and 'Y'
-        """
-        if self.current_data is None:
-            return
-        if len(self.current_data) == 0:
-            self.current_data = None
-            return
-        row_list = []
-        for idx in range(len(self.current_data)):
-            note_str = self.current_data['Notes'][idx]
-            if 'S' in note_str:
-                # S = statistically different parallax and proper motions
-                row_list.append(idx)
-            elif 'U' in note_str:
-                # U = proper motion indicates non-physical
-                row_list.append(idx)
-            elif 'X' in note_str:
-                # X = something else indicating unlikely to be physical
-                row_list.append(idx)
-            elif 'Y' in note_str:
-                # Y = statistically different parallax
-                row_list.append(idx)
-        num_spec = len(row_list)
-        if num_spec > 0:
-            if self.verbose:
-                print('    For {} pruning {} unlikely components'.format(self.current_id,
-                    num_spec))
-            self.current_data.remove_rows(row_list)
-        return
+def abc_mask(comp_col):
+    """Mask of the A, B and C components of a system. A blank
+    component name implies AB, so these are selected too.
+    """
+    categories, codes = categorical_parts(comp_col)
+    if categories is not None:
+        return abc_mask(categories)[codes]
+    data = np.ma.filled(np.ma.asarray(comp_col), '')
+    blank = np.char.str_len(np.char.strip(data)) == 0
+    return blank | contains_any(data, ABC_COMPS)
 
-    def prune_spectroscopic_binaries(self):
-        """Use 'Comp' strings to remove spectroscopic binary components
-        """
-        if self.current_data is None:
-            return
-        if len(self.current_data) == 0:
-            self.current_data = None
-            return
-        row_list = []
-        for idx in range(len(self.current_data)):
-            # Look for entries with lower case compents  with commas
-            if 'a,' in self.current_data['Comp'][idx]:
-                row_list.append(idx)
-        num_spec = len(row_list)
-        if num_spec > 0:
-            if self.verbose:
-                print('    For {} pruning {} spectroscopic binaries'.format(self.current_id,
-                    num_spec))
-            self.current_data.remove_rows(row_list)
-        return
+def mag_diff_mask(mag1_col, mag2_col, max_mag_diff):
+    """Mask of components where mag2-mag1 exceeds max_mag_diff.
 
-    def prune_mag_diff(self):
-        """Prune out components where the magnitude difference
-        listed in the WDS data is greater than the configured
-        maximum magnitude difference.
+    Missing magnitudes are treated as NaN and so are never masked.
+    """
+    mag1 = np.ma.filled(np.ma.asarray(mag1_col, dtype=float), np.nan)
+    mag2 = np.ma.filled(np.ma.asarray(mag2_col, dtype=float), np.nan)
+    with np.errstate(invalid='ignore'):
+        return (mag2 - mag1) > max_mag_diff
 
-        This filter is useful for amateur astronomical use where
-        very faint companions may be difficult to see and uninteresting
-        from an observing stand point.
-        """
-        if self.current_data is None:
-            return
-        if len(self.current_data) == 0:
-            self.current_data = None
-            return
-        row_list = []
-        for idx in range(len(self.current_data)):
-            mag1 = float(self.current_data['mag1'][idx])
-            mag2 = float(self.current_data['mag2'][idx])
-            dm = mag2 - mag1
-            if dm > self.max_mag_diff:
-                row_list.append(idx)
-        num_spec = len(row_list)
-        if num_spec > 0:
-            if self.verbose:
-                print('    For {} pruning {} components with mag2-mag1>{} mag'.format(self.current_id,
-                    num_spec, self.max_mag_diff))
-            self.current_data.remove_rows(row_list)
-        return
+def expand_ranges(starts, counts):
+    """Expands a set of ranges of integers, range i being starts[i] up to
+    starts[i]+counts[i], without a python loop.
 
+    Returns a tuple of the concatenated values of every range and an
+    array of the same length giving the range each value came from.
+    """
+    group = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    values = np.repeat(starts, counts) + offsets
+    return values, group
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Returns the great circle separation in degrees between positions
+    given in decimal degrees, using the haversine formula.
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(val) for val in [ra1, dec1, ra2, dec2]]
+    sin_ddec = np.sin(0.5*(dec2 - dec1))
+    sin_dra = np.sin(0.5*(ra2 - ra1))
+    hav = sin_ddec**2 + np.cos(dec1) * np.cos(dec2) * sin_dra**2
+    return np.degrees(2.0 * np.arcsin(np.sqrt(np.clip(hav, 0.0, 1.0))))
+
+def wds_id_coordinates(wds_ids):
+    """Returns arrays of the approximate RA and Dec, in decimal degrees,
+    encoded in an array of WDS IDs of the form HHMMm+DDMM. Both are NaN
+    for malformed IDs.
+    """
+    chars = np.asarray(wds_ids).astype('S10').view('S1').reshape(-1, 10)
+    digits = chars.view(np.uint8).astype(float) - ord('0')
+    number_cols = [0, 1, 2, 3, 4, 6, 7, 8, 9]
+    valid = np.all((digits[:,number_cols] >= 0) & (digits[:,number_cols] <= 9), axis=1)
+    valid &= (chars[:,5] == b'+') | (chars[:,5] == b'-')
+    digits[~valid] = np.nan
+    ra_deg = 15.0 * (10*digits[:,0] + digits[:,1] +
+        (10*digits[:,2] + digits[:,3] + 0.1*digits[:,4]) / 60.0)
+    dec_deg = 10*digits[:,6] + digits[:,7] + (10*digits[:,8] + digits[:,9]) / 60.0
+    dec_deg = np.where(chars[:,5] == b'-', -dec_deg, dec_deg)
+    return ra_deg, dec_deg
+
+def file_sha256(file_name):
+    """Returns the SHA-256 checksum of a file as a hex string"""
+    checksum = hashlib.sha256()
+    with open(file_name, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def default_snapshot_dir(wds_data_file):
+    """Returns the default location of the catalog snapshot for
+    wds_data_file, e.g. data/WDS/B_wds.snapshot for data/WDS/B_wds.fits.gz
+    """
+    base = wds_data_file
+    for suffix in ['.gz', '.fits', '.fit']:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    return base + '.snapshot'
+
+def component_list(comp):
+    """Returns the list of Simbad component names that a single WDS
+    'Comp' string refers to, each giving the Simbad compatible WDS ID
+    J<wds_id><name>.
+    For example 'AB' gives ['A', 'B'] and 'A,BC' gives ['A', 'BC'].
+    """
+    comp = comp.strip()
+    if len(comp) == 0:
+        # WDs seems not to state component names if there
+        # aren't more than two, so AB is implied in such cases.
+        comp='AB'
+        
+    if 'a,' in comp:
+        # If there is a lower case a, e.g. Aa,Ab then
+        # Simbad will expect that entire string.
+        return [comp]
+    elif ',' in comp:
+        # Cases like 'A,BC' seem to handled by Simbad
+        # with a separate A and a separate BC component,
+        # i.e. no separate B and C components.
+        return comp.split(',')
+    # Cases like AB or BC, we need to split every
+    # character
+    return list(comp)
+
+def component_names(comp):
+    """Returns the names of the primary and secondary of a WDS pair,
+    given its 'Comp' string, in the form used by component_list.
+
+    For example 'AB' gives ('A', 'B') and 'A,BC' gives ('A', 'BC').
+    Spectroscopic pairs such as 'Aa,Ab' are only known to Simbad by
+    the pair name, so these give ('Aa,Ab', None).
+    """
+    comp = comp.strip()
+    if len(comp) == 0:
+        # AB is implied if there are only two components.
+        comp = 'AB'
+    if 'a,' in comp:
+        return comp, None
+    elif ',' in comp:
+        primary, secondary = comp.split(',', 1)
+        return primary, secondary
+    return comp[0], comp[1:]
 
 def wds_id_from_simbad_wds(simbad_wds):
     """Extracts the main WDS ID from a Simbad WDS ID.
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""Compiles filter expressions used to select Washington Double Star
+components into vectorized column masks.
+
+An expression combines named filters and column comparisons with AND,
+OR, NOT and parentheses, for example
+
+    physical notes AND sep2 between 1 and 30 arcsec AND mag2 < 9
+
+Named filters are 'negative', 'positive' and 'abc' (the original
+process_wds_ids.py filter modes), 'physical', 'unphysical',
+'spectroscopic' and 'all'. Comparisons take the form
+
+    column <op> value [unit]             op is <, <=, >, >=, == or !=
+    column between value and value [unit]
+    column contains 'text'
+
+where column is any column of the WDS table, or 'dmag' for mag2-mag1.
+Values followed by a unit (e.g. arcmin) are converted into the unit of
+the column, which must have a compatible one. Keywords and column names are not case sensitive.
+
+The expression is parsed once into a tree of functions, each of which
+computes a boolean mask over whole table columns, so applying it to a
+table of any size involves no per-row python code.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import operator
+import re
+import numpy as np
+from astropy import units as u
+import WDS
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+# Numbers, comparison operators and parentheses, quoted strings, words.
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+    (?P<op><=|>=|==|!=|<|>|\(|\)) |
+    '(?P<squote>[^']*)' | "(?P<dquote>[^"]*)" |
+    (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+COMPARISONS = {'<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+    '==': operator.eq, '!=': operator.ne}
+
+# Units that may follow a value in a comparison.
+UNIT_WORDS = ['arcsec', 'arcmin', 'deg', 'mas', 'mag', 'yr']
+
+# Optional words that may follow a named filter, e.g. 'physical notes'.
+NAMED_FILTER_SUFFIXES = ['notes', 'binaries', 'components', 'filter']
+
+class WDSFilter:
+    """A WDS component filter expression, compiled into a function
+    that returns a boolean mask of the table rows to keep.
+    """
+    def __init__(self, expression):
+        """Parses the expression, raising ValueError if it is invalid"""
+        self.expression = expression
+        self.tokens = self.tokenize(expression)
+        self.pos = 0
+        # Whether the result depends on max_mag_diff.
+        self.uses_max_mag_diff = False
+        self.evaluate = self.parse_or()
+        if self.peek() is not None:
+            self.error('unexpected "{}"'.format(self.peek()[1]))
+        return
+
+    def mask(self, wds_table, max_mag_diff):
+        """Returns the boolean mask of rows of wds_table selected by the
+        expression. max_mag_diff is used by the 'negative' filter.
+        """
+        context = FilterContext(wds_table, max_mag_diff)
+        return np.asarray(self.evaluate(context), dtype=bool)
+
+    def error(self, message):
+        raise ValueError('Invalid filter "{}": {}'.format(self.expression, message))
+
+    def tokenize(self, expression):
+        """Splits the expression into a list of (kind, text) tuples"""
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            match = TOKEN_RE.match(expression, pos)
+            if match is None or match.end() == pos:
+                self.error('cannot parse "{}"'.format(expression[pos:].strip()))
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind in ['squote', 'dquote']:
+                kind = 'string'
+            tokens.append((kind, text))
+            pos = match.end()
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next_token(self):
+        token = self.peek()
+        if token is None:
+            self.error('unexpected end of expression')
+        self.pos += 1
+        return token
+
+    def accept_word(self, *words):
+        """Consumes the next token if it is one of the (lower case) words"""
+        token = self.peek()
+        if token is not None and token[0] == 'word' and token[1].lower() in words:
+            self.pos += 1
+            return token[1].lower()
+        return None
+
+    def expect_word(self, word):
+        if self.accept_word(word) is None:
+            self.error('expected "{}"'.format(word))
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.accept_word('or'):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda context: np.logical_or.reduce([term(context) for term in terms])
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.accept_word('and'):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda context: np.logical_and.reduce([term(context) for term in terms])
+
+    def parse_not(self):
+        if self.accept_word('not'):
+            term = self.parse_not()
+            return lambda context: ~term(context)
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind, text = self.next_token()
+        if kind == 'op' and text == '(':
+            term = self.parse_or()
+            kind, text = self.next_token()
+            if text != ')':
+                self.error('expected ")"')
+            return term
+        if kind != 'word':
+            self.error('unexpected "{}"'.format(text))
+
+        name = text.lower()
+        if name in NAMED_FILTERS:
+            self.accept_word(*NAMED_FILTER_SUFFIXES)
+            if name == 'negative':
+                self.uses_max_mag_diff = True
+            return NAMED_FILTERS[name]
+        return self.parse_comparison(text)
+
+    def parse_comparison(self, column):
+        """Parses the rest of a comparison that starts with a column name"""
+        if self.accept_word('between'):
+            low = self.parse_number()
+            self.expect_word('and')
+            high = self.parse_number()
+            unit = self.parse_unit()
+            return lambda context: between(context.numeric(column, unit), low, high)
+
+        if self.accept_word('contains'):
+            kind, text = self.next_token()
+            if kind != 'string':
+                self.error('expected a quoted string after "contains"')
+            return lambda context: WDS.contains_any(context.string_column(column), [text])
+
+        kind, text = self.next_token()
+        if kind != 'op' or text not in COMPARISONS:
+            self.error('expected a comparison after "{}"'.format(column))
+        compare = COMPARISONS[text]
+        if self.peek() is not None and self.peek()[0] == 'string':
+            if text not in ['==', '!=']:
+                self.error('strings can only be compared with == or !=')
+            value = self.next_token()[1].strip()
+            return lambda context: context.string_mask(column,
+                lambda strings: compare(strings, value))
+        value = self.parse_number()
+        unit = self.parse_unit()
+        return lambda context: compare_numeric(compare, context.numeric(column, unit), value)
+
+    def parse_number(self):
+        kind, text = self.next_token()
+        if kind != 'number':
+            self.error('expected a number, found "{}"'.format(text))
+        return float(text)
+
+    def parse_unit(self):
+        unit = self.accept_word(*UNIT_WORDS)
+        if unit is None:
+            return None
+        return u.Unit(unit)
+
+
+class FilterContext:
+    """The table a compiled filter is being applied to, and the
+    max_mag_diff used by the 'negative' filter. Columns are looked up
+    by name ignoring case, and converted to arrays each time they are
+    used.
+    """
+    def __init__(self, wds_table, max_mag_diff):
+        self.wds_table = wds_table
+        self.max_mag_diff = max_mag_diff
+        self.colname_dict = {}
+        for colname in wds_table.colnames:
+            self.colname_dict[colname.lower()] = colname
+        return
+
+    def column(self, name):
+        """Returns the table column called name, ignoring case"""
+        if name in self.wds_table.colnames:
+            return self.wds_table[name]
+        if name.lower() in self.colname_dict:
+            return self.wds_table[self.colname_dict[name.lower()]]
+        raise ValueError('Invalid filter: unknown column "{}". Columns are {}'.format(name,
+            ', '.join(['dmag'] + self.wds_table.colnames)))
+
+    def numeric(self, name, value_unit=None):
+        """Returns a column as a float array with NaN for missing values.
+        If value_unit is given the column is converted into that unit, so
+        it can be compared with values given in that unit, raising
+        ValueError if the column has no unit or one that cannot be
+        converted.
+        """
+        if name.lower() == 'dmag':
+            mag1 = self.numeric('mag1')
+            mag2 = self.numeric('mag2')
+            data, col_unit = mag2 - mag1, u.mag
+        else:
+            col = self.column(name)
+            if col.dtype.kind in 'SU' or WDS.categorical_parts(col)[0] is not None:
+                raise ValueError('Invalid filter: column "{}" is not numeric'.format(name))
+            data = np.ma.filled(np.ma.asarray(col, dtype=float), np.nan)
+            col_unit = col.unit
+        if value_unit is not None and value_unit != col_unit:
+            if col_unit is None:
+                raise ValueError('Invalid filter: column "{}" has no unit, so it cannot be compared with a value in {}'.format(name,
+                    value_unit))
+            if not col_unit.is_equivalent(value_unit):
+                raise ValueError('Invalid filter: column "{}" is in {}, which cannot be converted to {}'.format(name,
+                    col_unit, value_unit))
+            data = data * col_unit.to(value_unit)
+        return data
+
+    def string_column(self, name):
+        """Returns the table column called name, checking that it holds
+        strings, either directly or as categorical codes"""
+        if name.lower() == 'dmag':
+            raise ValueError('Invalid filter: column "{}" is not a string column'.format(name))
+        col = self.column(name)
+        if col.dtype.kind not in 'SU' and WDS.categorical_parts(col)[0] is None:
+            raise ValueError('Invalid filter: column "{}" is not a string column'.format(name))
+        return col
+
+    def string_mask(self, name, function):
+        """Applies function, which returns a boolean mask, to a string
+        column with leading and trailing spaces removed. For categorical
+        columns it is applied to each distinct value only once.
+        """
+        col = self.string_column(name)
+        categories, codes = WDS.categorical_parts(col)
+        if categories is not None:
+            return function(np.char.strip(categories))[codes]
+        data = np.ma.filled(np.ma.asarray(col), '')
+        if data.dtype.kind == 'S':
+            data = np.char.decode(data, 'ascii')
+        return function(np.char.strip(data))
+
+
+def between(data, low, high):
+    with np.errstate(invalid='ignore'):
+        return (data >= low) & (data <= high)
+
+def compare_numeric(compare, data, value):
+    with np.errstate(invalid='ignore'):
+        return compare(data, value)
+
+def negative_mask(context):
+    keep = ~WDS.spectroscopic_binary_mask(context.column('Comp'))
+    keep &= ~WDS.unphysical_mask(context.column('Notes'))
+    keep &= ~WDS.mag_diff_mask(context.column('mag1'), context.column('mag2'),
+        context.max_mag_diff)
+    return keep
+
+def physical_mask(context):
+    return WDS.physical_mask(context.column('Notes'))
+
+def unphysical_mask(context):
+    return WDS.unphysical_mask(context.column('Notes'))
+
+def abc_mask(context):
+    return WDS.abc_mask(context.column('Comp'))
+
+def spectroscopic_binary_mask(context):
+    return WDS.spectroscopic_binary_mask(context.column('Comp'))
+
+def all_mask(context):
+    return np.ones(len(context.wds_table), dtype=bool)
+
+# The 'positive' filter mode selects the physical components.
+NAMED_FILTERS = {
+    'negative':      negative_mask,
+    'positive':      physical_mask,
+    'abc':           abc_mask,
+    'physical':      physical_mask,
+    'unphysical':    unphysical_mask,
+    'spectroscopic': spectroscopic_binary_mask,
+    'all':           all_mask}
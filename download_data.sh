@@ -22,6 +22,9 @@
 #                           As of 6/12/20 the main WDS fits file is still corrupt.
 #                           Update documentation. Still need to add
 #                           conversion of ascii WDS table to fits.
+# @history 2026-10-17 dks : Build the WDS catalog snapshot after download.
+# @history 2026-10-17 dks : Convert the gzipped ascii WDS table directly.
+# @history 2026-10-17 dks : Refresh an existing converted WDS catalog in place.
 #-----------------------------------------------------------------------
 #
 
@@ -86,6 +89,7 @@ p_odir=$(pwd)
 # Python scripts we need to run.
 p_fmod=$p_odir/fitsmodhead.py
 p_a2fits=$p_odir/wds_convert.py
+p_snap=$p_odir/wds_snapshot.py
 
 if [ ! -d $p_data_dir ]; then
     echo "Creating base data directory: $p_data_dir"
@@ -181,19 +185,33 @@ if [ $p_do_text -eq 1 ]; then
         exit 1
     fi
 
-    if [ -e B_wds.dat.gz ]; then
-        gunzip -v --force B_wds.dat.gz
-    else
+    if [ ! -e B_wds.dat.gz ]; then
         echo "  Error: B_wds.dat.gz not found in" $(pwd)
         exit 1
     fi
     
-    python3 $p_a2fits B_wds.dat ReadMe.WDS B_wds.fits
+    # wds_convert.py reads the gzipped data directly. If we already have
+    # a converted catalog only the changed rows are updated, and the
+    # changes are listed in B_wds.changes.csv for process_wds_ids.py --changes
+    if [ -e B_wds.fits.gz ]; then
+        python3 $p_a2fits B_wds.dat.gz ReadMe.WDS B_wds.fits.gz --refresh B_wds.fits.gz
+    else
+        python3 $p_a2fits B_wds.dat.gz ReadMe.WDS B_wds.fits && gzip -v9 --force B_wds.fits
+    fi
     if [ $? -ne 0 ]; then
         echo "  Error: $p_a2fits exited with non-zero return code."
         exit 2
     fi
-    gzip -v9 --force B_wds.dat B_wds.fits
+fi
+
+# Build the memory-mappable snapshot of the cleaned catalog that
+# process_wds_ids.py loads instead of B_wds.fits.gz.
+if [ -e B_wds.fits.gz ]; then
+    echo "Building snapshot of cleaned WDS catalog."
+    (cd $p_odir && python3 $p_snap $p_wds_dir/B_wds.fits.gz)
+    if [ $? -ne 0 ]; then
+        echo "  Warning: $p_snap exited with non-zero return code."
+    fi
 fi
 
 cd $p_odir
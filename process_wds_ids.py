@@ -17,14 +17,14 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import numpy as np
 import os
 import os.path
 import sys
-from astropy.io import fits
 from astropy.table import Table, Column, vstack
 import DavesAstropyUtils as dapu
 import warnings
-from astropy.utils.exceptions import AstropyUserWarning, AstropyWarning
+from astropy.utils.exceptions import AstropyUserWarning
 import WDS
 
 __author__ = "Dave Strickland"
@@ -36,14 +36,11 @@ __license__ = "GPLv3"
 __version__ = "0.2.0"
 
 def command_line_opts():
-    # TODO: environment variable for WDS location
-    p_wds='data/WDS/B_wds.fits.gz'
-    p_filter = 'negative'
-    p_magdiff = 6.0
     p_wds_detail_table = 'wds_detail.html'
     p_fmt = ' Format is determined from file name.'
     p_css = 'darkTable.css'
     p_inp = 'INPUT_STAR_QUERY_OUTPUT.fits'
+    p_write_batch = 1000
 
     parser = argparse.ArgumentParser()
     # required command line arguments
@@ -65,6 +62,29 @@ def command_line_opts():
     parser.add_argument('--css',
         dest='cssfile', default=p_css, metavar='table_style.css',
         help='CSS table style for output HTML (default: {})'.format(p_css))
+    add_wds_opts(parser)
+
+    parser.add_argument('--write-batch',
+        dest='write_batch', default=p_write_batch, type=int, metavar='N',
+        help='Number of targets to process before writing their components to the output tables,'+
+            ' which can be looked at while the rest are processed.'+
+            ' Use 0 to write all the targets at the end. (default: {})'.format(p_write_batch))
+
+    parser.add_argument('-v', '--verbose',
+        dest='verbose', action='store_true',
+        help='Verbose output for each object processed. Useful for debugging purposes.')
+        
+    args = parser.parse_args()
+    return args
+
+def add_wds_opts(parser):
+    """Adds the options for selecting WDS components to the
+    argparse.ArgumentParser parser, which run_pipeline.py shares"""
+    # TODO: environment variable for WDS location
+    p_wds='data/WDS/B_wds.fits.gz'
+    p_filter = 'negative'
+    p_magdiff = 6.0
+
     parser.add_argument('-w', '--wdsfile',
         dest='wdsfile', default=p_wds,
         help='Location of WDS data table. (default: {})'.format(p_wds))
@@ -74,18 +94,28 @@ def command_line_opts():
             ' Valid entries are "abc", "negative", or "positive" (default: {})'.format(p_filter)+
             ' "abc" selects A, B and C components.'+
             ' "positive" selects only physically likely companions.'+
-            ' "negative" deselects unphysical components and components with large magnitude differences.')
+            ' "negative" deselects unphysical components and components with large magnitude differences.'+
+            ' These can also be combined with AND, OR, NOT and conditions on WDS columns,'+
+            ' e.g. "positive AND sep2 between 1 and 30 arcsec AND mag2 < 9".'+
+            ' See WDSFilter.py for the full syntax.')
+
+    parser.add_argument('--match-radius',
+        dest='match_radius', default=None, type=float, metavar='ARCSEC',
+        help='Find WDS IDs for targets that Simbad gave no WDS ID for by matching'+
+            ' their position to the nearest WDS primary within this many arcseconds'+
+            ' (default: no positional matching)')
+
+    parser.add_argument('--changes',
+        dest='changes', default=None, metavar='MANIFEST',
+        help='Only process targets whose WDS system appears in this change manifest,'+
+            ' written by wds_convert.py --refresh. The other targets keep their components'+
+            ' from the existing output table, and those not in it are processed too.'+
+            ' (default: process all targets)')
 
     parser.add_argument('--magdiff',
         dest='magdiff', default=p_magdiff, type=float,
         help='Maximum magnitude difference allowed in negative filter (default: {})'.format(p_magdiff))
-
-    parser.add_argument('-v', '--verbose',
-        dest='verbose', action='store_true',
-        help='Verbose output for each object processed. Useful for debugging purposes.')
-        
-    args = parser.parse_args()
-    return args
+    return
 
 def main():
     warnings.simplefilter('ignore', category=AstropyUserWarning, append=True)
@@ -101,13 +131,72 @@ def main():
     p_idata = dapu.read_table(p_args.fitsfile, p_args.verbose)
 
     # Create WDS class to handle WDS-related data collection
+    p_wds = load_wds(p_args)
+
+    # The results for changed WDS systems are merged into the existing
+    # output, which has to be read before it is overwritten
+    p_previous = None
+    if p_args.changes is not None:
+        p_previous = read_previous_output(p_args.output_table, p_args.verbose)
+
+    # The output tables are written a batch of targets at a time
+    p_otable_writer = dapu.open_table_writer(p_args.output_table, p_args.cssfile)
+    p_detail_writer = None
+    if p_args.wds_detail is not None:
+        p_detail_writer = dapu.open_table_writer(p_args.wds_detail, p_args.cssfile)
+
+    print('Processing {} targets from {}'.format(len(p_idata), p_args.fitsfile))
+    [inputs_no_wds_list, all_wds_filtered_out_list] = find_components(p_args, p_idata, p_wds,
+        p_otable_writer, p_detail_writer, p_previous)
+
+    p_otable_writer.close()
+    print('Wrote filtered WDS component for input targets to {}'.format(p_args.output_table))
+    if p_detail_writer is None:
+        if p_args.verbose:
+            print('Note this information could be written to disk using --wds_detail')
+    else:
+        p_detail_writer.close()
+        print('Wrote WDS component detail info to {}'.format(p_args.wds_detail))
+
+    report_no_components(p_args, inputs_no_wds_list, all_wds_filtered_out_list)
+    return
+
+def load_wds(p_args):
+    """Returns a WDS.WDS of the WDS catalog in p_args.wdsfile, ready to
+    apply the filter in p_args.filter"""
     p_wds = WDS.WDS(p_args.wdsfile, p_args.magdiff, p_args.verbose)
-    
-    # Process each input in turn maintaining link between user ID
-    # and WDS id, if present. Store output tables for later combination.
-    output_tables = [] # store returned table of WDS data
-    processed_targets = []
-    processed_wds_ids = []
+    try:
+        p_wds.compile_filter(p_args.filter)
+    except ValueError as err:
+        print('Error: {}'.format(err))
+        sys.exit(2)
+    return p_wds
+
+def find_components(p_args, p_idata, p_wds, p_otable_writer, p_detail_writer=None,
+    p_previous=None):
+    """Finds the likely WDS components of each target in p_idata, a
+    table from star_query.py, using the WDS.WDS p_wds.
+
+    The table of targets and their components is written with the
+    TableWriter p_otable_writer a batch of targets at a time, along with
+    the detail of the components if p_detail_writer is given.
+
+    If p_args.changes lists the changed WDS systems, the targets in the
+    other systems keep their components from the table p_previous
+    written by an earlier run, in the input order. Targets that are not
+    in p_previous, or are in changed systems, are processed as usual.
+    The detail table only has the components of the targets processed.
+
+    Returns lists of the targets with no WDS ID, and of those whose
+    components were all filtered out.
+    """
+    # Extract the WDS ID of each input target, maintaining the link
+    # between user ID and WDS id, if present.
+    target_idx_list = []
+    target_list = []
+    target_wds_list = []
+    # Whether each target's components are kept from p_previous
+    target_kept_list = []
     num_targets = len(p_idata)
     num_found = 0
     num_skipped = 0
@@ -117,11 +206,23 @@ def main():
     inputs_no_wds_list=[]
     all_wds_filtered_out_list=[]
     
-    print('Processing {} targets from {}'.format(num_targets, p_args.fitsfile))
+    p_owds_list = [WDS.wds_id_from_simbad_wds(p_iwds) for p_iwds in p_idata['WDS']]
+    p_changed_wds = None
+    if p_args.changes is not None:
+        p_changed_wds = read_changed_wds_ids(p_args.changes, p_args.verbose)
+        print('  Only processing targets in the {} WDS systems listed in {},'.format(len(p_changed_wds),
+            p_args.changes)+' or not in the existing output')
+    num_kept = 0
+    p_previous_rows = previous_rows_by_target(p_previous)
+    p_match_dict = {}
+    if p_args.match_radius is not None:
+        p_match_dict = match_by_position(p_wds, p_idata, p_owds_list,
+            p_args.match_radius)
+
     for idx in range(num_targets):
         p_target = p_idata['Star'][idx]
         p_iwds = p_idata['WDS'][idx]
-        p_owds = WDS.wds_id_from_simbad_wds(p_iwds)
+        p_owds = p_owds_list[idx]
         if p_owds is None:
             # inform user and skip to next target
             print('  Target #{} {} did not have WDS-like ID. Skipping.'.format(idx, p_target))
@@ -129,42 +230,135 @@ def main():
             inputs_no_wds_list.append(p_target)
             continue
         
-        print('  Target #{} {} obtained WDS-like ID {} from {}'.format(idx, p_target, p_owds, p_iwds))
-
-        # Get the like component data from the WDS
-        p_table, p_ids = p_wds.get_likely_components(p_owds, p_args.filter)
-        if p_table is None:
-            print('    Target #{} {} has no likely WDS components after filtering'.format(idx, p_target))
-            num_skipped += 1
-            all_wds_filtered_out_list.append(p_target)
+        if (p_changed_wds is not None and p_owds not in p_changed_wds and
+            str(p_target) in p_previous_rows):
+            if p_args.verbose:
+                print('  Target #{} {} WDS ID {} is unchanged. Keeping its components.'.format(idx,
+                    p_target, p_owds))
+            target_idx_list.append(idx)
+            target_list.append(p_target)
+            target_wds_list.append(p_owds)
+            target_kept_list.append(True)
             continue
-
-        # Otherwise we got some valid data.
-        num_found += 1
-        output_tables.append(p_table)
-        for num in range(len(p_ids)):
-            processed_targets.append(p_target)
-            processed_wds_ids.append(p_ids[num])
         
-    # summarize loop
-    print('Found WDS IDs for {} input targets, skipped {}'.format(num_found, num_skipped))
+        if idx in p_match_dict:
+            print('  Target #{} {} matched WDS ID {} by position, separation {:.1f} arcsec'.format(idx,
+                p_target, p_owds, p_match_dict[idx]))
+        else:
+            print('  Target #{} {} obtained WDS-like ID {} from {}'.format(idx, p_target, p_owds, p_iwds))
+        target_idx_list.append(idx)
+        target_list.append(p_target)
+        target_wds_list.append(p_owds)
+        target_kept_list.append(False)
 
-    # create an output table from the data we have
-    p_otable = make_output_table(processed_targets, processed_wds_ids)
-    dapu.write_table(p_otable, p_args.output_table, p_args.cssfile)
-    print('Wrote filtered WDS component for input targets to {}'.format(p_args.output_table))
+    p_write_batch = p_args.write_batch
+    if p_write_batch <= 0:
+        p_write_batch = max(1, len(target_list))
 
-    # combine data for components into final table
-    detail_table = vstack(output_tables, join_type='outer')
-    if p_args.wds_detail is None:
-        if p_args.verbose:
+    # Always write at least one batch, so the output tables have their
+    # columns even if there are no targets
+    for p_start in range(0, max(1, len(target_list)), p_write_batch):
+        p_end = p_start + p_write_batch
+        p_kept = target_kept_list[p_start:p_end]
+        # Get the likely component data from the WDS for the whole batch at once
+        detail_table, p_ids_lists = p_wds.get_likely_components_batch([p_owds
+            for p_owds, kept in zip(target_wds_list[p_start:p_end], p_kept) if not kept],
+            p_args.filter)
+        p_ids_iter = iter(p_ids_lists)
+        processed_targets = []
+        processed_wds_ids = []
+        # Where each row of the output comes from: the row of the new
+        # components, or of p_previous if negative (-1 is row 0)
+        p_row_sources = []
+        for idx, p_target, kept in zip(target_idx_list[p_start:p_end], target_list[p_start:p_end],
+            p_kept):
+            if kept:
+                p_rows = p_previous_rows.pop(str(p_target), [])
+                p_row_sources.extend([-1 - row for row in p_rows])
+                num_kept += 1
+                continue
+            p_ids = next(p_ids_iter)
+            if p_ids is None:
+                print('    Target #{} {} has no likely WDS components after filtering'.format(idx, p_target))
+                num_skipped += 1
+                all_wds_filtered_out_list.append(p_target)
+                continue
+
+            # Otherwise we got some valid data.
+            num_found += 1
+            for num in range(len(p_ids)):
+                p_row_sources.append(len(processed_targets))
+                processed_targets.append(p_target)
+                processed_wds_ids.append(p_ids[num])
+
+        # create an output table from the data we have
+        p_positions = p_wds.component_positions(detail_table)
+        p_otable = make_output_table(processed_targets, processed_wds_ids, p_positions)
+        if any(p_kept):
+            p_otable = merge_previous(p_otable, p_previous, p_row_sources)
+        p_otable_writer.write(p_otable)
+
+        # detail_table already holds the combined data for all components
+        if p_detail_writer is not None:
+            p_detail_writer.write(detail_table)
+        elif p_args.verbose:
             print('Select WDS detail information follows:')
             print(detail_table.info)
-            print('Note this information could be written to disk using --wds_detail')
-    else:
-        dapu.write_table(detail_table, p_args.wds_detail, p_args.cssfile)
-        print('Wrote WDS component detail info to {}'.format(p_args.wds_detail))
 
+    # summarize loop
+    print('Found WDS IDs for {} input targets, skipped {}'.format(num_found, num_skipped))
+    if p_changed_wds is not None:
+        print('  Kept the components of {} targets whose WDS system did not change'.format(num_kept)+
+            ' from the existing output')
+    return inputs_no_wds_list, all_wds_filtered_out_list
+
+def read_previous_output(output_table, p_verbose=False):
+    """Returns the table of targets and components written to
+    output_table by an earlier run, for the results of a --changes run
+    to be merged into, or None if there isn't one"""
+    if not os.path.isfile(output_table):
+        print('Warning: {} not found. Processing all targets.'.format(output_table))
+        return None
+    p_previous = dapu.read_table(output_table, p_verbose)
+    p_columns = make_output_table([], [], {}).colnames
+    if p_previous.colnames != p_columns:
+        print('Warning: {} does not have the columns {}. Processing all targets.'.format(
+            output_table, p_columns))
+        return None
+    print('Merging the results for changed WDS systems into {}'.format(output_table))
+    # Rebuilt so the columns have the same types and formats as the new
+    # rows, whichever format the table was read back from
+    p_targets = [str(p_target) for p_target in p_previous['Star']]
+    p_ids = [str(p_id) for p_id in p_previous['WDS']]
+    p_positions = dict(zip(p_ids, zip(np.ma.filled(p_previous['RA_wds_deg'], np.nan),
+        np.ma.filled(p_previous['DEC_wds_deg'], np.nan))))
+    return make_output_table(p_targets, p_ids, p_positions)
+
+def previous_rows_by_target(p_previous):
+    """Returns a dictionary mapping each target in the table p_previous
+    to the list of its rows, or an empty one if p_previous is None"""
+    p_previous_rows = {}
+    if p_previous is None:
+        return p_previous_rows
+    for row, p_target in enumerate(p_previous['Star']):
+        p_previous_rows.setdefault(str(p_target), []).append(row)
+    return p_previous_rows
+
+def merge_previous(p_otable, p_previous, p_row_sources):
+    """Returns the rows of the tables p_otable and p_previous in the
+    order given by p_row_sources, where row n of p_otable is given by n
+    and row n of p_previous by -1-n"""
+    p_row_sources = np.array(p_row_sources, dtype=int)
+    p_new = p_row_sources >= 0
+    p_merged = vstack([p_otable, p_previous[-1 - p_row_sources[~p_new]]],
+        metadata_conflicts='silent')
+    p_order = np.empty(len(p_row_sources), dtype=int)
+    p_order[p_new] = p_row_sources[p_new]
+    p_order[~p_new] = len(p_otable) + np.arange(np.count_nonzero(~p_new))
+    return p_merged[p_order]
+
+def report_no_components(p_args, inputs_no_wds_list, all_wds_filtered_out_list):
+    """Lists the targets find_components found no components for"""
     print('Information on targets with no WDS or all WDS components filtered out.')
     print('  {} input targets with no WDS info: {}'.format(len(inputs_no_wds_list), inputs_no_wds_list))
     print('  {} input targets where {} filtering removed all components: {}'.format(len(all_wds_filtered_out_list), 
@@ -172,20 +366,78 @@ def main():
         all_wds_filtered_out_list))
     return
 
-def make_output_table(target_list, wds_id_list):
+def read_changed_wds_ids(manifest_file, p_verbose=False):
+    """Returns the set of WDS IDs listed in a change manifest written
+    by wds_convert.py --refresh"""
+    p_manifest = dapu.read_table(manifest_file, p_verbose)
+    if len(p_manifest) == 0:
+        return set()
+    return set([str(p_wds).strip() for p_wds in p_manifest['WDS']])
+
+def match_by_position(p_wds, p_idata, p_owds_list, match_radius):
+    """Finds WDS IDs for targets that have none, using a cone search
+    of the WDS catalog around the target position from star_query.py.
+
+    Targets are matched to the WDS system whose primary is closest,
+    provided it lies within match_radius arcseconds. p_owds_list is
+    updated in place, and a dictionary mapping the index of each matched
+    target to the separation in arcseconds is returned.
+    """
+    p_match_dict = {}
+    for col in ['RA_icrs_deg', 'DEC_icrs_deg']:
+        if col not in p_idata.colnames:
+            print('  Warning: Input has no {} column, cannot match targets by position'.format(col))
+            return p_match_dict
+
+    p_unmatched = np.array([idx for idx, p_owds in enumerate(p_owds_list)
+        if p_owds is None], dtype=int)
+    if len(p_unmatched) == 0:
+        return p_match_dict
+    ra_deg  = np.ma.filled(np.ma.asarray(p_idata['RA_icrs_deg'], dtype=float), np.nan)
+    dec_deg = np.ma.filled(np.ma.asarray(p_idata['DEC_icrs_deg'], dtype=float), np.nan)
+    matches = p_wds.cone_search_batch(ra_deg[p_unmatched], dec_deg[p_unmatched],
+        match_radius / 3600.0)
+
+    # Matches are sorted by separation, so the first for each target is closest.
+    p_targets, p_first = np.unique(matches['Target'], return_index=True)
+    for target, row in zip(p_targets, p_first):
+        idx = p_unmatched[target]
+        p_owds_list[idx] = str(matches['WDS'][row])
+        p_match_dict[idx] = matches['Sep'][row]
+    return p_match_dict
+
+def make_output_table(target_list, wds_id_list, position_dict=None):
     """Construct an astropy Table from the target ID
     list and the filtered WDS component list
+
+    If a dictionary mapping WDS identifiers to (RA, Dec) positions is
+    given, as returned by WDS.component_positions, the position of each
+    component is included too.
     """
     output_table = Table()
+    # The types are given so an empty table has string columns too
     target_column = Column(data=target_list,
         description='Original user-specified target identifier',
-        name='Star',
+        name='Star', dtype=str,
         format='{}')
     wds_column = Column(data=wds_id_list,
         description='WDS identifiers for selected components',
-        name='WDS',
+        name='WDS', dtype=str,
         format='{}')
     output_table.add_columns(cols=[target_column, wds_column])
+    if position_dict is not None:
+        no_position = (np.nan, np.nan)
+        positions = np.array([position_dict.get(wds_id, no_position)
+            for wds_id in wds_id_list], dtype=float).reshape(-1, 2)
+        ra_column = Column(data=positions[:,0],
+            description='Right ascension of component in decimal degrees, from WDS',
+            name='RA_wds_deg', unit='deg',
+            format='{:.6f}')
+        dec_column = Column(data=positions[:,1],
+            description='Declination of component in decimal degrees, from WDS',
+            name='DEC_wds_deg', unit='deg',
+            format='{:.6f}')
+        output_table.add_columns(cols=[ra_column, dec_column])
     return output_table
 
 if __name__ == "__main__":
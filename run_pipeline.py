@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Runs all the processing stages on a list of stars in one go, from
+the list itself (level 0), through the Simbad data for those stars
+(level 1), to the Simbad data for the likely components of their
+multiple star systems (level 2).
+
+This does the same as running star_query.py, process_wds_ids.py and
+then star_query.py --stage2, but within a single process. The tables
+are handed from one stage to the next in memory rather than written out
+and read back in, and the WDS catalog is loaded only once. The level 1
+and WDS component tables are only written if asked for.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import sys
+import warnings
+from astropy.utils.exceptions import AstropyWarning
+import DavesAstropyUtils as dapu
+import process_wds_ids
+import star_query
+from SimbadJournal import JOURNAL_SUFFIX
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+# Columns of the process_wds_ids.py output table used by stage 2
+STAGE2_NAMECOL = 'Star'
+STAGE2_IDCOL = 'WDS'
+
+def command_line_opts():
+    p_ihtml = 'input_file_or_txt'
+    p_ohtml = 'output_summary.html'
+    p_otable = 'output.fits.gz'
+    p_namecol = 'Star'
+    p_fmt = ' Format is determined from file name.'
+
+    parser = argparse.ArgumentParser()
+    # required command line arguments
+    parser.add_argument(dest='input_file', metavar=p_ihtml,
+        help='Input HTML table or ASCII TXT file of stars to be processed (level 0).')
+    parser.add_argument(dest='ohtml', default=None, metavar=p_ohtml,
+        help='Name for output HTML summary of the Simbad data for the selected'+
+            ' WDS components of each star (level 2).')
+    parser.add_argument(dest='otable', default=None, metavar=p_otable,
+        help='Name for output table of the Simbad data for the selected'+
+            ' WDS components of each star (level 2).'+p_fmt)
+
+    # optional arguments
+    parser.add_argument('-c', '--col',
+        dest='namecol', default=p_namecol, metavar='colname',
+        help='Name of the table column containing primary target star name/identifier (default: {})'.format(p_namecol))
+    parser.add_argument('--level1',
+        dest='level1_table', default=None, metavar='level1.fits.gz',
+        help='Name for optional output table of the Simbad data for the input stars (level 1),'+
+            ' as written by star_query.py.'+p_fmt)
+    parser.add_argument('--level1-html',
+        dest='level1_html', default=None, metavar='level1.html',
+        help='Name for optional output HTML summary of the Simbad data for the input stars (level 1).')
+    parser.add_argument('--components',
+        dest='components_table', default=None, metavar='components.fits',
+        help='Name for optional output table of the input stars and their selected WDS components,'+
+            ' as written by process_wds_ids.py.'+p_fmt)
+    parser.add_argument('--wds-detail',
+        dest='wds_detail', default=None, metavar='wds_detail.html',
+        help='Name for optional output of WDS informational data on processed'+
+            ' WDS components that passed filtering.'+p_fmt)
+    star_query.add_query_opts(parser)
+    process_wds_ids.add_wds_opts(parser)
+
+    parser.add_argument('-v', '--verbose',
+        dest='verbose', action='store_true',
+        help='Verbose output for each object processed. Useful for debugging purposes.')
+
+    args = parser.parse_args()
+    return args
+
+def main():
+    # Suppress warnings from the unit module 'cos we're not interested.
+    warnings.simplefilter('ignore', category=AstropyWarning, append=True)
+
+    p_args = command_line_opts()
+
+    # known incorrect names or ones that Simbad reacts oddly to.
+    bad_names_dict = dapu.read_star_aliases(p_args.star_alias_file)
+    if p_args.verbose:
+        print('Using {}-element star alias dictionary from {}'.format(
+            len(bad_names_dict),
+            p_args.star_alias_file))
+
+    p_ifile = p_args.input_file
+    print('Input HTML or TXT file: {}'.format(p_ifile))
+    print('Output level 2 data table: {}'.format(p_args.otable))
+    print('Output level 2 summary (HTML): {}'.format(p_args.ohtml))
+
+    # Each stage of star_query.py processing has its own journal, which is
+    # kept until the end so that the whole run can be resumed.
+    p_stage1_args = stage_args(p_args, False, p_args.namecol,
+        p_args.otable + '.level1' + JOURNAL_SUFFIX)
+    p_stage2_args = stage_args(p_args, True, STAGE2_NAMECOL,
+        p_args.otable + JOURNAL_SUFFIX)
+
+    # A --changes run merges its results into the existing components
+    # table, which has to be read before it is overwritten. Without one
+    # every target is processed, so the level 2 output stays complete.
+    p_previous = None
+    if p_args.changes is not None:
+        if p_args.components_table is None:
+            print('Warning: --changes needs the --components table of an earlier run to merge into.'+
+                ' Processing all targets.')
+            p_args.changes = None
+        else:
+            p_previous = process_wds_ids.read_previous_output(p_args.components_table,
+                p_args.verbose)
+
+    # Open all the outputs up front, so a bad file name is found before
+    # any processing is done. The level 1 and component tables are kept
+    # in memory for the next stage, and only written if asked for.
+    p_level1_writer = dapu.MemoryTableWriter(open_writer(p_args.level1_table))
+    p_level1_html_writer = open_writer(p_args.level1_html, p_args.cssfile)
+    p_components_writer = dapu.MemoryTableWriter(open_writer(p_args.components_table,
+        p_args.cssfile))
+    p_detail_writer = open_writer(p_args.wds_detail, p_args.cssfile)
+    p_fits_writer = open_writer(p_args.otable)
+    p_html_writer = open_writer(p_args.ohtml, p_args.cssfile)
+
+    # Stage 1: Simbad data for the input stars
+    p_data = dapu.read_table(p_ifile)
+    star_query.check_columns(p_stage1_args, p_data, p_ifile)
+    print('Stage 1: About to process {} stars from {}'.format(len(p_data), p_ifile))
+    [p_ofail_list, p_qfail_list] = star_query.do_astroquery(p_stage1_args, p_data,
+        bad_names_dict, p_level1_writer, p_level1_html_writer)
+    p_level1_writer.close()
+    if p_args.level1_table is not None:
+        print('Wrote {} stars to {}'.format(p_level1_writer.num_rows, p_args.level1_table))
+    if p_level1_html_writer is not None:
+        p_level1_html_writer.close()
+    star_query.report_failures(p_ofail_list, p_qfail_list)
+    p_level1 = p_level1_writer.table()
+    if p_level1 is None:
+        print('Error: Simbad found none of the input stars, so there are no WDS components to look for')
+        # Don't leave empty outputs behind
+        for p_writer in [p_components_writer, p_detail_writer, p_fits_writer, p_html_writer]:
+            if p_writer is not None:
+                p_writer.close()
+        star_query.remove_journals(p_stage1_args)
+        sys.exit(4)
+
+    # Find the likely WDS components of each star
+    p_wds = process_wds_ids.load_wds(p_args)
+    print('Processing {} targets from stage 1'.format(len(p_level1)))
+    [inputs_no_wds_list, all_wds_filtered_out_list] = process_wds_ids.find_components(p_args,
+        p_level1, p_wds, p_components_writer, p_detail_writer, p_previous)
+    p_components_writer.close()
+    if p_args.components_table is not None:
+        print('Wrote filtered WDS component for input targets to {}'.format(p_args.components_table))
+    if p_detail_writer is not None:
+        p_detail_writer.close()
+        print('Wrote WDS component detail info to {}'.format(p_args.wds_detail))
+    process_wds_ids.report_no_components(p_args, inputs_no_wds_list, all_wds_filtered_out_list)
+    p_components = p_components_writer.table()
+
+    # Stage 2: Simbad data for the selected components
+    print('Stage 2: About to process {} WDS components'.format(len(p_components)))
+    [p_ofail_list, p_qfail_list] = star_query.do_astroquery(p_stage2_args, p_components,
+        bad_names_dict, p_fits_writer, p_html_writer)
+    p_fits_writer.close()
+    p_html_writer.close()
+    print('Wrote {} stars to {}'.format(p_fits_writer.num_rows, p_args.otable))
+
+    # The outputs are complete, so the journals are no longer needed
+    star_query.remove_journals(p_stage1_args)
+    star_query.remove_journals(p_stage2_args)
+
+    star_query.report_failures(p_ofail_list, p_qfail_list)
+    return
+
+def stage_args(p_args, stage2, namecol, journal_file):
+    """Returns a copy of the command line options p_args with those
+    star_query.py would be given for one stage of the processing"""
+    p_stage_args = argparse.Namespace(**vars(p_args))
+    p_stage_args.stage2 = stage2
+    p_stage_args.stage2col = STAGE2_IDCOL
+    p_stage_args.namecol = namecol
+    p_stage_args.journal_file = journal_file
+    return p_stage_args
+
+def open_writer(an_output_file, a_css_style=None):
+    """Returns a DavesAstropyUtils.TableWriter for an_output_file, or
+    None if no file name is given"""
+    if an_output_file is None:
+        return None
+    return dapu.open_table_writer(an_output_file, a_css_style)
+
+if __name__ == "__main__":
+    main()
@@ -19,12 +19,19 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import numpy as np
-from astropy.table import Table, Column, hstack
+from astropy.table import Table
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
 import warnings
-from astropy.utils.exceptions import AstropyUserWarning, AstropyWarning
-from SimbadStarQuery import SimbadStarQuery
+from astropy.utils.exceptions import AstropyWarning
+from SimbadStarQuery import SimbadStarQuery, SimbadResultBuffer, BATCH_SIZE, THREADS, RATE_LIMIT, MINIMAL_VOTABLE_FIELDS
+from SimbadCache import SimbadCache, CACHE_FILE, CACHE_TTL_DAYS, CACHE_SIZE_MB
+from SimbadJournal import SimbadJournal, JOURNAL_SUFFIX
 import DavesAstropyUtils as dapu
+import os
 import re
 import sys
 
@@ -36,30 +43,60 @@ __email__ =  "dave.strickland@gmail.com"
 __license__ = "GPLv3"
 __version__ = "0.2.0"
 
+# Matches parenthesized parts of star names, e.g. '(Almach)'
+PARENS_RE = re.compile(r'\(.*?\)')
+# Maximum number of distinct star names fix_names remembers
+FIX_NAMES_CACHE_SIZE = 65536
+
 def fix_names(anInputStr):
     """Perform various fixed on star names from the web HTML tables.
 
     - Strips cases like 'gamma And   \n  (Almach)' down to 'gamma And'
     - Removes unicode characters Simbad doesn't recognize
+
+    Names that have been fixed before are looked up rather than fixed
+    again.
     """    
     if not (isinstance(anInputStr, str) or isinstance(anInputStr, np.str_)):
         raise TypeError('anInputStr must be a str or numpy.str_. Was {}'.format(type(anInputStr)))
+    return fix_name_str(str(anInputStr))
 
+@functools.lru_cache(maxsize=FIX_NAMES_CACHE_SIZE)
+def fix_name_str(anInputStr):
+    """Does the work of fix_names for a str"""
     # Search for (*) and replace it with ''
-    anInputStr = re.sub('\(.*?\)', '', anInputStr)
+    anInputStr = PARENS_RE.sub('', anInputStr)
 
     # Get rid of internal newlines.
     cleanStr = ' '.join( [ el.strip() for el in anInputStr.splitlines() ] )
     outputStr = dapu.convert_greek_unicode_symbol(cleanStr)
     return outputStr
 
+def fix_names_column(names):
+    """Applies fix_names to a whole column of star names at once,
+    returning a list of the fixed names.
+
+    Each distinct name is only fixed once, however many times it occurs.
+    """
+    if np.ma.is_masked(names):
+        raise TypeError('names must not have missing values')
+    p_names = np.ma.getdata(names)
+    if len(p_names) == 0:
+        return []
+    if p_names.dtype.kind == 'S':
+        # As read from FITS, which Table rows would give as str
+        p_names = np.char.decode(p_names, 'utf-8')
+    if p_names.dtype.kind != 'U':
+        raise TypeError('names must be a column of str. Was {}'.format(p_names.dtype))
+    p_unique, p_inverse = np.unique(p_names, return_inverse=True)
+    p_fixed = np.array([fix_name_str(str(name)) for name in p_unique], dtype=object)
+    return p_fixed[p_inverse].tolist()
+
 def command_line_opts():
     p_ihtml = 'input_file_or_txt'
     p_phtml = 'pretty_input_version.html'
     p_ohtml = 'output_summary.html'
     p_otable = 'output.fits.gz'
-    p_css = '$DOUBLE_STARS/Data/darkTable.css'
-    p_alias_file = 'simbad_star_alias.csv'
     p_namecol = 'Star'
     p_stage2col = 'WDS'
 
@@ -70,7 +107,7 @@ def command_line_opts():
     parser.add_argument(dest='ohtml', default=None, metavar=p_ohtml,
         help='Name for output HTML summary of processed data.')
     parser.add_argument(dest='otable', default=None, metavar=p_otable,
-        help='name for output processed data table (fits format).')
+        help='name for output processed data table (fits format, or ecsv/csv).')
 
     # optional arguments
     parser.add_argument('-p', '--pretty',
@@ -82,15 +119,7 @@ def command_line_opts():
         ' In the default (aka primary stage) processing the targets are listed by the name in this'+
         ' column and the Simbad search uses this identifier (or the alternative from'+
         ' the "aliases" file).')
-    parser.add_argument('--fullhtml', 
-        dest='fullhtml', action='store_true', 
-        help='Output all data fields used for the fits output to the summary HTML file. By default bibcode, errors, parallax and proper motion are excluded from the summary HTML.')
-    parser.add_argument('--css',
-        dest='cssfile', default=p_css, metavar='table_style.css',
-        help='CSS table style for output HTML (default: {})'.format(p_css))
-    parser.add_argument('--aliases',
-        dest='star_alias_file', default=p_alias_file, metavar='ALIASES.csv',
-        help='CSV file containing mapping between user-supplied star names and names acceptable to Simbad (default: {})'.format(p_alias_file))
+    add_query_opts(parser)
 
     parser.add_argument('--stage2',
         dest='stage2', action='store_true', default=False,
@@ -103,6 +132,12 @@ def command_line_opts():
         dest='stage2col', default=p_stage2col, metavar='stage2col',
         help='Name of the table column containing identifier used for each target in stage2 processing (default: {})'.format(p_stage2col))
 
+    parser.add_argument('--journal',
+        dest='journal_file', default=None, metavar='JOURNAL',
+        help='File in which Simbad responses are recorded as they arrive, so that'+
+            ' an interrupted run can be resumed. It is removed once the output'+
+            ' files are written. (default: output table name + {})'.format(JOURNAL_SUFFIX))
+
     parser.add_argument('-v', '--verbose',
         dest='verbose', action='store_true',
         help='Verbose output for each object processed. Useful for debugging purposes.')
@@ -110,6 +145,73 @@ def command_line_opts():
     args = parser.parse_args()
     return args
 
+def add_query_opts(parser):
+    """Adds the options for querying Simbad and writing the results to
+    the argparse.ArgumentParser parser, which run_pipeline.py shares"""
+    p_css = '$DOUBLE_STARS/Data/darkTable.css'
+    p_alias_file = 'simbad_star_alias.csv'
+    p_write_batch = 1000
+    p_workers = 1
+
+    parser.add_argument('--fullhtml', 
+        dest='fullhtml', action='store_true', 
+        help='Output all data fields used for the fits output to the summary HTML file. By default bibcode, errors, parallax and proper motion are excluded from the summary HTML.')
+    parser.add_argument('--css',
+        dest='cssfile', default=p_css, metavar='table_style.css',
+        help='CSS table style for output HTML (default: {})'.format(p_css))
+    parser.add_argument('--minimal-fields',
+        dest='minimal_fields', action='store_true',
+        help='Only request the Simbad fields shown in the summary HTML by default,'+
+            ' which keeps Simbad responses small. The other columns are then left out'+
+            ' of the fits output too.')
+    parser.add_argument('--aliases',
+        dest='star_alias_file', default=p_alias_file, metavar='ALIASES.csv',
+        help='CSV file containing mapping between user-supplied star names and names acceptable to Simbad (default: {})'.format(p_alias_file))
+
+    parser.add_argument('--batch-size',
+        dest='batch_size', default=BATCH_SIZE, type=int, metavar='N',
+        help='Number of objects to query Simbad for in each request.'+
+            ' Use 0 to query them one at a time. (default: {})'.format(BATCH_SIZE))
+
+    parser.add_argument('--write-batch',
+        dest='write_batch', default=p_write_batch, type=int, metavar='N',
+        help='Number of stars to process before writing their results to the output files,'+
+            ' which can be looked at while the rest are processed.'+
+            ' Use 0 to write all the stars at the end. (default: {})'.format(p_write_batch))
+
+    parser.add_argument('--threads',
+        dest='threads', default=THREADS, type=int, metavar='N',
+        help='Number of Simbad requests to keep in flight at once (default: {})'.format(THREADS))
+    parser.add_argument('--workers',
+        dest='workers', default=p_workers, type=int, metavar='N',
+        help='Number of processes to query and process the stars in, each taking'+
+            ' every Nth batch of --write-batch stars with its own threads, cache'+
+            ' connection and journal. The rate limit is shared between them, and'+
+            ' the results are written in the input order. Resume a run with the'+
+            ' same number of workers. (default: {})'.format(p_workers))
+    parser.add_argument('--rate-limit',
+        dest='rate_limit', default=RATE_LIMIT, type=float, metavar='PER_SEC',
+        help='Maximum number of Simbad requests per second. Use 0 for no limit.'+
+            ' (default: {})'.format(RATE_LIMIT))
+    parser.add_argument('--cache',
+        dest='cache_file', default=CACHE_FILE, metavar='CACHE.sqlite',
+        help='File used to cache Simbad query results between runs (default: {})'.format(CACHE_FILE))
+    parser.add_argument('--cache-ttl',
+        dest='cache_ttl', default=CACHE_TTL_DAYS, type=float, metavar='DAYS',
+        help='Number of days before cached Simbad results are queried again (default: {})'.format(CACHE_TTL_DAYS))
+    parser.add_argument('--cache-size',
+        dest='cache_size', default=CACHE_SIZE_MB, type=float, metavar='MB',
+        help='Maximum size of the Simbad cache, after which the least recently used'+
+            ' results are removed (default: {})'.format(CACHE_SIZE_MB))
+    parser.add_argument('--no-cache',
+        dest='use_cache', action='store_false',
+        help='Always query Simbad, and do not store the results in the cache.')
+    parser.add_argument('--resume',
+        dest='resume', action='store_true',
+        help='Resume an interrupted run, only querying Simbad for the targets'+
+            ' not already recorded in the journal.')
+    return
+
 def main():
     # Suppress warnings from the unit module 'cos we're not interested.
     warnings.simplefilter('ignore', category=AstropyWarning, append=True)
@@ -123,6 +225,9 @@ def main():
             len(bad_names_dict),
             p_args.star_alias_file))
 
+    if p_args.journal_file is None:
+        p_args.journal_file = p_args.otable + JOURNAL_SUFFIX
+
     p_ifile = p_args.input_file
     print('Input HTML or TXT file: {}'.format(p_ifile))
     if p_args.pretty is not None:
@@ -139,7 +244,29 @@ def main():
     if p_args.pretty is not None:
         dapu.write_to_html(p_data, p_args.pretty, p_args.cssfile)
 
-    # Check the column with the star names/identifiers exists
+    check_columns(p_args, p_data, p_ifile)
+
+    print('About to process {} stars from {}'.format(len(p_data), p_ifile))
+    # The main table and html summary are written a batch of stars at a time
+    p_fits_writer = dapu.open_table_writer(p_args.otable)
+    p_html_writer = dapu.HtmlTableWriter(p_args.ohtml, p_args.cssfile)
+    p_ofail_list = None # user object name fail list
+    p_qfail_list = None # actual query names that failed
+    [p_ofail_list, p_qfail_list] = do_astroquery(p_args, p_data, bad_names_dict,
+        p_fits_writer, p_html_writer)
+    p_fits_writer.close()
+    p_html_writer.close()
+    print('Wrote {} stars to {}'.format(p_fits_writer.num_rows, p_args.otable))
+
+    # The outputs are complete, so the journals are no longer needed
+    remove_journals(p_args)
+
+    report_failures(p_ofail_list, p_qfail_list)
+    return
+
+def check_columns(p_args, p_data, p_ifile):
+    """Exits if the columns of star names/identifiers to be used are
+    not in the table p_data read from p_ifile"""
     if not p_args.namecol in p_data.colnames:
         print('Error: Target ID column name "{}" not found in {} data'.format(p_args.namecol, p_ifile))
         print('  Did you mean "{}" instead?'.format(p_data.colnames[0]))
@@ -149,13 +276,29 @@ def main():
         if not p_args.stage2col in p_data.colnames:
             print('Error: Identifier column name "{}" not found in {} data'.format(p_args.namecol, p_ifile))
             sys.exit(2)
+    return
 
-    print('About to process {} stars from {}'.format(len(p_data), p_ifile))
-    p_otable = None
-    p_ofail_list = None # user object name fail list
-    p_qfail_list = None # actual query names that failed
-    [p_otable, p_ofail_list, p_qfail_list] = do_astroquery(p_args, p_data, bad_names_dict)
+def remove_journals(p_args):
+    """Removes the journals of a run once its outputs are complete"""
+    for p_journal_file in [p_args.journal_file] + [worker_journal_file(p_args, num)
+        for num in range(p_args.workers)]:
+        if os.path.exists(p_journal_file):
+            os.remove(p_journal_file)
+    return
 
+def report_failures(p_ofail_list, p_qfail_list):
+    """Warns the user about objects we failed to query successfully"""
+    if p_ofail_list is not None and len(p_ofail_list) > 0:
+        print('Queries failed for the following {} object names.'.format(len(p_ofail_list)))
+        print('  Please check these using http://simbad.u-strasbg.fr/simbad/sim-fid OR')
+        print('  using http://simbad.u-strasbg.fr/simbad/sim-fcoo')
+        print('  Failed objects, user-input target names: {}'.format(p_ofail_list))
+        print('  Failed objects, Simbad query IDs used:   {}'.format(p_qfail_list))
+    return
+    
+def write_results(p_args, p_otable, p_fits_writer, p_html_writer):
+    """Writes a batch of processed stars to the main table and, unless
+    p_html_writer is None, the HTML summary"""
     # to replace missing data with a fill value.
     # NOTE: Doesn't quite work as not all missing values are identified
     # as such in simbad returned data, for unknown reasons.
@@ -164,8 +307,10 @@ def main():
     # write out main table as data and html
     if p_args.verbose:
         print(p_otable.info)
-    p_otable.write(p_args.otable, format='fits', overwrite=True)
-    #p_otable.write(p_args.otable, format='ascii.ecsv', delimiter=',', overwrite=True)
+        print(p_otable)
+    p_fits_writer.write(p_otable)
+    if p_html_writer is None:
+        return
 
     # HTML format we only write a summary, removing some columns
     if p_args.fullhtml: 
@@ -182,43 +327,61 @@ def main():
             'spec_qual', 'spec_bibcode',
             'Fe_H_bibcode']
 
-    p_tmp_table = Table(p_otable, copy=True)
+    p_tmp_table = Table(p_otable, copy=False)
+    # Some columns may not have been requested from Simbad
+    p_exclude_list = [col for col in p_exclude_list if col in p_tmp_table.colnames]
     if len(p_exclude_list) > 0:
         p_tmp_table.remove_columns(p_exclude_list)
-    dapu.write_to_html(p_tmp_table, p_args.ohtml, p_args.cssfile)
-
-    # warn user about objects we failed to query successfully
-    if p_ofail_list is not None and len(p_ofail_list) > 0:
-        print('Queries failed for the following {} object names.'.format(len(p_ofail_list)))
-        print('  Please check these using http://simbad.u-strasbg.fr/simbad/sim-fid OR')
-        print('  using http://simbad.u-strasbg.fr/simbad/sim-fcoo')
-        print('  Failed objects, user-input target names: {}'.format(p_ofail_list))
-        print('  Failed objects, Simbad query IDs used:   {}'.format(p_qfail_list))
+    p_html_writer.write(p_tmp_table)
     return
-    
 
-def do_astroquery(p_args, p_data, p_alias_dict):
-    print('Using astroquery for data retrieval.')
-    
-    # Initialize the class that does the queries and formats the tables.
-    sid = SimbadStarQuery(p_alias_dict)
-    p_otable = None
+def make_star_query(p_args, p_alias_dict, p_rate_limit):
+    """Returns a SimbadStarQuery set up from the command line options
+    and the SimbadCache it uses, or None if the cache is not used"""
+    p_cache = None
+    if p_args.use_cache:
+        p_cache = SimbadCache(p_args.cache_file, p_args.cache_ttl, p_args.cache_size)
+    p_votable_fields = None
+    if p_args.minimal_fields:
+        p_votable_fields = MINIMAL_VOTABLE_FIELDS
+    sid = SimbadStarQuery(p_alias_dict, p_cache, p_rate_limit, p_votable_fields)
+    return sid, p_cache
+
+def get_query_names(p_args, p_data):
+    """Returns lists of the fixed-up user star names and the IDs to
+    query Simbad for, for each row of p_data"""
+    p_star_names = fix_names_column(p_data[p_args.namecol])
+    if p_args.stage2:
+        # extract the alternate ID used for simbad referencing
+        p_query_names = [' '.join([p_args.stage2col, stage2_id])
+            for stage2_id in p_data[p_args.stage2col]]
+    else:
+        # just use user target ID to identify object and search simbad
+        p_query_names = p_star_names
+    return p_star_names, p_query_names
+
+def query_stars(p_args, sid, p_results, p_star_names, p_query_names):
+    """Queries Simbad for a batch of stars and processes the results
+    into a table, using the SimbadStarQuery sid and the
+    SimbadResultBuffer p_results.
+
+    Returns the table, or None if no stars were found, and lists of the
+    user target names and query IDs of the stars that failed.
+    """
     p_fail_obj_list = [] # list of input target names
     p_fail_qry_list = [] # list of actual query names used
-    p_object_num = -1
-    for row in p_data:
-        p_object_num = p_object_num + 1
-        star_name = fix_names(row[p_args.namecol])
+    # Simbad is queried for all the objects in the batch up front, in
+    # batched requests made concurrently, then they are processed in the
+    # input order.
+    sid.prefetch(p_query_names, p_args.batch_size, p_args.threads)
+
+    for star_name, query_name in zip(p_star_names, p_query_names):
         if p_args.stage2:
-            # extract the alternate ID used for simbad referencing
-            query_name = ' '.join([p_args.stage2col, row[p_args.stage2col]])
             print('Processing {} with query ID {}'.format(star_name, query_name))
         else:
-            # just use user target ID to identify object and search simbad
             print('Processing {}'.format(star_name))
-            query_name = star_name
 
-        sid.do_query(star_name, query_name)
+        sid.fetch_result(star_name, query_name)
         if not sid.successfully_queried:
             print('  Warning: Simbad.query_object fails for {}'.format(star_name))
             p_fail_obj_list.append(star_name)
@@ -236,26 +399,164 @@ def do_astroquery(p_args, p_data, p_alias_dict):
             p_fail_obj_list.append(star_name)
             p_fail_qry_list.append(sid.query_id)
             continue
-        
+    
+        # Collect the raw results, to be processed together at the end
+        p_results.add(sid)
 
-        # Define the output table structure based on content on simbad object
-        if p_otable is None:
-            p_otable = sid.get_table()
-            if p_args.verbose:
-                print('  Initial table:\n',
-                    p_otable.colnames)
+    # Build the output table for the batch from all its results at once
+    p_otable = p_results.flush()
+    sid.release(p_query_names)
+    return p_otable, p_fail_obj_list, p_fail_qry_list
 
-        else:
-            # Add row data existing table
-            p_otable.add_row( sid.get_row() )
-            ##if p_args.verbose:
-            ##    # Note sure why row print out isn't truncated the normal way
-            ##    print('  Table for object number {}:\n'.format(p_object_num), 
-            ##        p_otable[p_object_num])
+def do_astroquery(p_args, p_data, p_alias_dict, p_fits_writer, p_html_writer):
+    print('Using astroquery for data retrieval.')
+    if p_args.use_cache:
+        print('Using Simbad cache {}'.format(p_args.cache_file))
+    p_star_names, p_query_names = get_query_names(p_args, p_data)
+    if p_args.workers > 1:
+        return do_astroquery_workers(p_args, p_alias_dict, p_star_names, p_query_names,
+            p_fits_writer, p_html_writer)
 
-    if p_args.verbose:
-        print(p_otable)
-    return p_otable, p_fail_obj_list, p_fail_qry_list
+    # Initialize the class that does the queries and formats the tables.
+    sid, p_cache = make_star_query(p_args, p_alias_dict, p_args.rate_limit)
+    p_journal = SimbadJournal(p_args.journal_file, sid.simbad.get_votable_fields(),
+        p_args.resume)
+    sid.set_journal(p_journal)
+    p_fail_obj_list = [] # list of input target names
+    p_fail_qry_list = [] # list of actual query names used
+
+    if p_args.resume:
+        p_num_done = len([query_name for query_name in p_query_names
+            if sid.get_simbad_object_id(query_name, p_alias_dict) in sid.prefetched])
+        print('Resuming from journal {}: {} of {} targets already queried'.format(p_args.journal_file,
+            p_num_done, len(p_query_names)))
+
+    # Work through the stars a batch at a time, writing out the results of
+    # each batch before starting on the next, so memory use stays bounded.
+    print('Querying Simbad for {} objects in batches of {} using {} threads'.format(len(p_query_names),
+        max(1, p_args.batch_size), p_args.threads))
+    p_write_batch = p_args.write_batch
+    if p_write_batch <= 0:
+        p_write_batch = max(1, len(p_query_names))
+    p_results = SimbadResultBuffer(sid, p_write_batch)
+    for p_start in range(0, len(p_query_names), p_write_batch):
+        p_otable, p_fail_objs, p_fail_qrys = query_stars(p_args, sid, p_results,
+            p_star_names[p_start:p_start+p_write_batch],
+            p_query_names[p_start:p_start+p_write_batch])
+        p_fail_obj_list += p_fail_objs
+        p_fail_qry_list += p_fail_qrys
+        if p_otable is not None:
+            write_results(p_args, p_otable, p_fits_writer, p_html_writer)
+
+    p_journal.close()
+    if p_cache is not None:
+        print('Simbad cache: {}'.format(p_cache.summary()))
+        p_cache.close()
+    return p_fail_obj_list, p_fail_qry_list
+
+def worker_journal_file(p_args, worker_num):
+    """Returns the name of the journal of --workers process worker_num"""
+    return '{}.{}'.format(p_args.journal_file, worker_num)
+
+# The SimbadStarQuery and related state of a --workers process
+worker_state = {}
+
+def init_worker(p_args, p_alias_dict, worker_num, p_write_batch):
+    """Sets up a --workers process with its own SimbadStarQuery, cache
+    connection and journal, sharing the rate limit with the others, to
+    process batches of up to p_write_batch stars"""
+    warnings.simplefilter('ignore', category=AstropyWarning, append=True)
+    sid, p_cache = make_star_query(p_args, p_alias_dict, p_args.rate_limit / p_args.workers)
+    p_journal_file = worker_journal_file(p_args, worker_num)
+    p_journal = SimbadJournal(p_journal_file, sid.simbad.get_votable_fields(), p_args.resume)
+    p_num_restored = sid.set_journal(p_journal)
+
+    p_results = SimbadResultBuffer(sid, p_write_batch)
+    worker_state.update({'args': p_args, 'sid': sid, 'cache': p_cache,
+        'journal': p_journal, 'num_restored': p_num_restored, 'results': p_results})
+    return
+
+def worker_num_restored():
+    """Returns the number of results a --workers process restored from
+    its journal"""
+    return worker_state['num_restored']
+
+def query_stars_in_worker(p_star_names, p_query_names):
+    """Runs query_stars in a --workers process, returning what it
+    printed along with its results, so the parent process can print it
+    in the input order"""
+    p_output = io.StringIO()
+    with contextlib.redirect_stdout(p_output):
+        p_results = query_stars(worker_state['args'], worker_state['sid'],
+            worker_state['results'], p_star_names, p_query_names)
+    return (p_output.getvalue(),) + p_results
+
+def finish_worker():
+    """Closes the journal and cache of a --workers process, returning
+    a summary of its cache use, or None if it had no cache"""
+    worker_state['journal'].close()
+    p_cache = worker_state['cache']
+    if p_cache is None:
+        return None
+    p_summary = p_cache.summary()
+    p_cache.close()
+    return p_summary
+
+def do_astroquery_workers(p_args, p_alias_dict, p_star_names, p_query_names,
+    p_fits_writer, p_html_writer):
+    """Queries Simbad for and processes the stars in p_args.workers
+    processes, as do_astroquery does in one.
+
+    The stars are split into batches of p_args.write_batch, and each
+    process always takes the same share of the batches, every Nth one,
+    so its journal can be resumed. The batches are written out in the
+    input order as their results come back.
+    """
+    p_workers = p_args.workers
+    p_write_batch = p_args.write_batch
+    if p_write_batch <= 0:
+        # Still give each process a share of the stars
+        p_write_batch = max(1, -(-len(p_query_names) // p_workers))
+    p_starts = list(range(0, len(p_query_names), p_write_batch))
+    print('Querying Simbad for {} objects in batches of {} using {} processes of {} threads'.format(
+        len(p_query_names), max(1, p_args.batch_size), p_workers, p_args.threads))
+
+    p_fail_obj_list = [] # list of input target names
+    p_fail_qry_list = [] # list of actual query names used
+    with contextlib.ExitStack() as stack:
+        # A pool of one process for each worker, so that each batch goes
+        # to the same worker every time
+        p_executors = [stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=1,
+            initializer=init_worker, initargs=(p_args, p_alias_dict, num, p_write_batch)))
+            for num in range(p_workers)]
+        if p_args.resume:
+            p_restored = [executor.submit(worker_num_restored) for executor in p_executors]
+            for num, p_num_restored in enumerate(p_restored):
+                print('Resuming from journal {}: {} targets already queried'.format(
+                    worker_journal_file(p_args, num), p_num_restored.result()))
+        # Keep a couple of batches queued for each worker, but no more,
+        # so the results waiting to be written stay bounded
+        p_futures = {}
+        p_next = 0
+        for p_batch_num, p_start in enumerate(p_starts):
+            while p_next < len(p_starts) and p_next < p_batch_num + 2*p_workers:
+                p_next_start = p_starts[p_next]
+                p_futures[p_next] = p_executors[p_next % p_workers].submit(query_stars_in_worker,
+                    p_star_names[p_next_start:p_next_start+p_write_batch],
+                    p_query_names[p_next_start:p_next_start+p_write_batch])
+                p_next += 1
+            p_output, p_otable, p_fail_objs, p_fail_qrys = p_futures.pop(p_batch_num).result()
+            print(p_output, end='')
+            p_fail_obj_list += p_fail_objs
+            p_fail_qry_list += p_fail_qrys
+            if p_otable is not None:
+                write_results(p_args, p_otable, p_fits_writer, p_html_writer)
+
+        p_summaries = [executor.submit(finish_worker) for executor in p_executors]
+        for num, p_summary in enumerate(p_summaries):
+            if p_summary.result() is not None:
+                print('Simbad cache, worker {}: {}'.format(num, p_summary.result()))
+    return p_fail_obj_list, p_fail_qry_list
     
 if __name__ == "__main__":
     main()
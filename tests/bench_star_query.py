@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Times star_query.py on a list of synthetic stars, using the stand-in
+Simbad service in fake_simbad.py instead of the real one.
+
+The stars are written to a temporary input table with Star and WDS
+columns, and star_query.py is run on them in this process with any
+further options given, e.g. --batch-size 100. The wall time and the
+number of requests made are printed.
+
+Use --tree to time the star_query.py of another checkout of the
+repository, e.g. one made with git worktree at an earlier commit, and
+--keep to keep its outputs for comparison. For example
+
+  tests/bench_star_query.py --stars 10000 --keep new -- --batch-size 100 --no-cache
+  tests/bench_star_query.py --stars 10000 --keep old --tree ../old -- --batch-size 100 --no-cache
+  cmp new.fits old.fits
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import contextlib
+import io
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from astropy.table import Table
+import fake_simbad
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def command_line_opts():
+    p_stars = 10000
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stars',
+        dest='stars', default=p_stars, type=int, metavar='N',
+        help='Number of synthetic stars to query for (default: {})'.format(p_stars))
+    parser.add_argument('--latency',
+        dest='latency', default=fake_simbad.LATENCY, type=float, metavar='SECONDS',
+        help='Time each request to the stand-in Simbad service takes (default: {})'.format(
+            fake_simbad.LATENCY))
+    parser.add_argument('--tree',
+        dest='tree', default=REPO_DIR, metavar='DIR',
+        help='Checkout of the repository whose star_query.py is timed (default: {})'.format(REPO_DIR))
+    parser.add_argument('--keep',
+        dest='keep', default=None, metavar='NAME',
+        help='Keep the outputs as NAME.fits and NAME.html')
+    parser.add_argument(dest='star_query_opts', nargs='*', metavar='star_query_option',
+        help='Further options for star_query.py, given after --')
+
+    args = parser.parse_args()
+    return args
+
+def write_stars(input_file, num_stars):
+    """Writes the input table of synthetic stars"""
+    p_names = ['HD {}'.format(num) for num in range(1, num_stars+1)]
+    p_wds = ['J{:05d}+{:04d}AB'.format(num, num) for num in range(1, num_stars+1)]
+    Table({'Star': p_names, 'WDS': p_wds}).write(input_file, format='ascii.csv', overwrite=True)
+    return
+
+def main():
+    p_args = command_line_opts()
+    fake_simbad.LATENCY = p_args.latency
+    # The stand-in has to replace astroquery.simbad before star_query
+    # imports it
+    fake_simbad.install()
+    sys.path.insert(0, os.path.abspath(p_args.tree))
+    import star_query
+    print('Timing {}'.format(star_query.__file__))
+
+    with tempfile.TemporaryDirectory() as p_dir:
+        input_file = os.path.join(p_dir, 'stars.csv')
+        otable = os.path.join(p_dir, 'out.fits')
+        ohtml = os.path.join(p_dir, 'out.html')
+        write_stars(input_file, p_args.stars)
+        sys.argv = ['star_query.py', input_file, ohtml, otable,
+            '--css', os.path.join(REPO_DIR, 'darkTable.css'),
+            '--aliases', os.path.join(REPO_DIR, 'simbad_star_alias.csv')] + p_args.star_query_opts
+        p_output = io.StringIO()
+        p_start = time.perf_counter()
+        with contextlib.redirect_stdout(p_output):
+            star_query.main()
+        p_wall = time.perf_counter() - p_start
+        if p_args.keep is not None:
+            shutil.copyfile(otable, p_args.keep + '.fits')
+            shutil.copyfile(ohtml, p_args.keep + '.html')
+
+    print('\n'.join(p_output.getvalue().splitlines()[-3:]))
+    print('{} stars in {:.1f} s'.format(p_args.stars, p_wall))
+    print('Requests: {}'.format(fake_simbad.CALLS))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""The modules under test live at the top of the repository."""
+
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
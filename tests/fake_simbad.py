@@ -0,0 +1,165 @@
+"""Stand-in for the astroquery Simbad service, for the tests and benchmarks.
+
+It answers query_object, query_objects and query_objectids for made-up
+stars, without any network access:
+
+- 'HD n' is star n.
+- 'WDS Jnnnnn...' is also star n.
+- 'NAME Starn' is star n, and is its MAIN_ID when n is a multiple of 7.
+- Stars whose number ends in 49 (modulo 50) are unknown to Simbad.
+
+Each request sleeps for LATENCY seconds, so the effect of batching
+requests can be measured. The requests made are counted in CALLS.
+Queries for the names in FAILING raise a ConnectionError, as a timed out
+request would.
+"""
+
+import sys
+import time
+import types
+import numpy as np
+from astropy.table import Table, Column, MaskedColumn
+
+# Seconds each request takes
+LATENCY = 0.0
+# Number of requests and of objects asked for
+CALLS = {'query_object': 0, 'query_objects': 0, 'query_objectids': 0, 'objects': 0}
+# Query names whose requests fail
+FAILING = set()
+
+# The result columns returned for each votable field
+FIELD_COLUMNS = {'main_id': ['MAIN_ID'], 'ra(icrs)': ['RA_icrs'], 'dec(icrs)': ['DEC_icrs'],
+    'coo_bibcode': ['COO_BIBCODE'], 'flux(B)': ['FLUX_B'], 'flux_error(B)': ['FLUX_ERROR_B'],
+    'flux_bibcode(B)': ['FLUX_BIBCODE_B'], 'flux(V)': ['FLUX_V'], 'flux_error(V)': ['FLUX_ERROR_V'],
+    'flux_bibcode(V)': ['FLUX_BIBCODE_V'], 'plx': ['PLX_VALUE'], 'plx_error': ['PLX_ERROR'],
+    'plx_bibcode': ['PLX_BIBCODE'],
+    'pm': ['PMRA', 'PMDEC', 'PM_ERR_MAJA', 'PM_ERR_MINA', 'PM_ERR_ANGLE'],
+    'pm_bibcode': ['PM_BIBCODE'], 'sp': ['SP_TYPE'], 'sp_qual': ['SP_QUAL'],
+    'sp_bibcode': ['SP_BIBCODE'],
+    'fe_h': ['Fe_H_Teff', 'Fe_H_log_g', 'Fe_H_Fe_H', 'Fe_H_flag', 'Fe_H_CompStar',
+        'Fe_H_CatNo', 'Fe_H_bibcode'],
+    'ids': ['IDS']}
+
+def reset():
+    """Clears the request counts and failing names"""
+    for key in CALLS:
+        CALLS[key] = 0
+    FAILING.clear()
+    return
+
+def star_row(num):
+    """Returns the Simbad result row of star num, as a dictionary, and
+    the list of its identifiers"""
+    ids = ['HD {}'.format(num), 'HIP {}'.format(1000+num), 'SAO {}'.format(5000+num)]
+    if num % 3 == 0:
+        ids += ['WDS J{:05d}+{:04d}AB'.format(num, num), 'WDS J{:05d}+{:04d}A'.format(num, num)]
+    if num % 7 == 0:
+        ids.append('NAME Star{}'.format(num))
+    ra = '{:02d} {:02d} {:05.2f}'.format(num % 24, num % 60, (num*1.37) % 60)
+    dec = '+{:02d} {:02d} {:04.1f}'.format(num % 89, (num*7) % 60, (num*0.3) % 60)
+    main_id = 'NAME Star{}'.format(num) if num % 7 == 0 else 'HD {}'.format(num)
+    row = dict(MAIN_ID=main_id, RA_icrs=ra, DEC_icrs=dec, COO_BIBCODE='2007A&A...474..653V',
+        FLUX_B=5+num%5*0.11, FLUX_ERROR_B=0.01, FLUX_BIBCODE_B='2000A&A...355L..27H',
+        FLUX_V=4.5+num%5*0.1, FLUX_ERROR_V=0.02, FLUX_BIBCODE_V='2000A&A...355L..27H',
+        PLX_VALUE=10+num*0.01, PLX_ERROR=0.2, PLX_BIBCODE='2007A&A...474..653V',
+        PMRA=num*0.5, PMDEC=-num*0.25, PM_ERR_MAJA=0.1, PM_ERR_MINA=0.1, PM_ERR_ANGLE=90,
+        PM_BIBCODE='2007A&A...474..653V', SP_TYPE='G{}V'.format(num%10), SP_QUAL='C',
+        SP_BIBCODE='1999MSS...C05....0H', Fe_H_Teff=5000+num, Fe_H_log_g=4.4, Fe_H_Fe_H=-0.1,
+        Fe_H_flag='', Fe_H_CompStar='Sun', Fe_H_CatNo='X', Fe_H_bibcode='2010A&A...515A.111S',
+        IDS='|'.join(ids))
+    return row, ids
+
+def lookup(name):
+    """Returns the number of the star called name, or None if Simbad
+    does not know it"""
+    name = ' '.join(name.split())
+    for prefix in ['HD ', 'WDS J', 'NAME Star']:
+        if name.startswith(prefix):
+            p_num = name[len(prefix):len(prefix)+5] if prefix == 'WDS J' else name[len(prefix):]
+            try:
+                num = int(p_num)
+            except ValueError:
+                return None
+            if num % 50 == 49:
+                return None
+            return num
+    return None
+
+class FakeSimbad:
+    """Answers the astroquery SimbadClass requests SimbadStarQuery makes"""
+    def __init__(self):
+        self.fields = ['main_id', 'coordinates']
+
+    def reset_votable_fields(self):
+        self.fields = ['main_id', 'coordinates']
+
+    def remove_votable_fields(self, *fields):
+        for field in fields:
+            self.fields.remove(field)
+
+    def add_votable_fields(self, *fields):
+        self.fields.extend(fields)
+
+    def get_votable_fields(self):
+        return list(self.fields)
+
+    def request(self, names):
+        """Waits as a request to Simbad would, failing for FAILING names"""
+        time.sleep(LATENCY)
+        for name in names:
+            if name in FAILING:
+                raise ConnectionError('simulated timeout for ' + name)
+        return
+
+    def make_table(self, rows, script_numbers=None):
+        """Returns the result table of the rows, with only the columns
+        of the votable fields asked for, or None if there are none"""
+        if len(rows) == 0:
+            return None
+        p_columns = [column for field in self.fields for column in FIELD_COLUMNS.get(field, [])]
+        names = [name for name in rows[0].keys() if name in p_columns]
+        p_table = Table()
+        for name in names:
+            values = [row[name] for row in rows]
+            if isinstance(values[0], str):
+                p_table[name] = Column(np.array(values, dtype=object))
+            else:
+                p_table[name] = MaskedColumn(values)
+        if script_numbers is not None:
+            p_table['SCRIPT_NUMBER_ID'] = script_numbers
+        return p_table
+
+    def query_object(self, name):
+        CALLS['query_object'] += 1
+        CALLS['objects'] += 1
+        self.request([name])
+        num = lookup(name)
+        return None if num is None else self.make_table([star_row(num)[0]])
+
+    def query_objects(self, names):
+        CALLS['query_objects'] += 1
+        CALLS['objects'] += len(names)
+        self.request(names)
+        rows = []
+        script_numbers = []
+        for script_number, name in enumerate(names, 1):
+            num = lookup(name)
+            if num is not None:
+                rows.append(star_row(num)[0])
+                script_numbers.append(script_number)
+        return self.make_table(rows, script_numbers)
+
+    def query_objectids(self, name):
+        CALLS['query_objectids'] += 1
+        self.request([name])
+        ids = star_row(lookup(name))[1]
+        return Table({'ID': np.array([p_id.encode() for p_id in ids], dtype=object)})
+
+def install():
+    """Replaces the astroquery.simbad module with one using FakeSimbad,
+    which has to be done before the modules using it are imported"""
+    module = types.ModuleType('astroquery.simbad')
+    module.Simbad = FakeSimbad()
+    module.SimbadClass = FakeSimbad
+    sys.modules['astroquery.simbad'] = module
+    return module
@@ -0,0 +1,89 @@
+"""Tests of merging a process_wds_ids.py --changes run into the existing output."""
+
+import argparse
+import os.path
+import numpy as np
+import pytest
+from astropy.table import Table
+import DavesAstropyUtils as dapu
+import process_wds_ids
+import wds_convert
+import WDS
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'wds')
+
+SUFFIXES = ['.fits', '.fits.gz', '.ecsv', '.csv']
+
+def previous_table():
+    return process_wds_ids.make_output_table(['HD 1', 'HD 1', 'HD 22'],
+        ['J00001+0001A', 'J00001+0001B', 'J00022+0022A'],
+        {'J00001+0001A': (0.25, 1.5), 'J00001+0001B': (0.5, 1.75)})
+
+@pytest.mark.parametrize('suffix', SUFFIXES)
+def test_read_previous_output(tmp_path, suffix):
+    """The table read back has the same types and formats as new output,
+    whatever format it was written in"""
+    output_file = str(tmp_path / ('out' + suffix))
+    previous = previous_table()
+    with dapu.open_table_writer(output_file) as writer:
+        writer.write(previous)
+    result = process_wds_ids.read_previous_output(output_file)
+    assert result.colnames == previous.colnames
+    for name in result.colnames:
+        assert result[name].dtype.kind == previous[name].dtype.kind
+        assert result[name].info.format == previous[name].info.format
+    assert list(result['Star']) == ['HD 1', 'HD 1', 'HD 22']
+    assert list(result['RA_wds_deg'][:2]) == [0.25, 0.5]
+    assert np.isnan(result['DEC_wds_deg'][2])
+
+def test_read_previous_output_missing(tmp_path):
+    assert process_wds_ids.read_previous_output(str(tmp_path / 'none.fits')) is None
+
+def test_merge_previous():
+    """New rows and kept rows are interleaved in the order given"""
+    previous = previous_table()
+    new = process_wds_ids.make_output_table(['HD 5', 'HD 30'],
+        ['J00005+0005A', 'J00030+0030B'], {})
+    rows = process_wds_ids.previous_rows_by_target(previous)
+    assert rows == {'HD 1': [0, 1], 'HD 22': [2]}
+    merged = process_wds_ids.merge_previous(new, previous, [-1, -2, 0, -3, 1])
+    assert list(merged['Star']) == ['HD 1', 'HD 1', 'HD 5', 'HD 22', 'HD 30']
+    assert list(merged['WDS']) == ['J00001+0001A', 'J00001+0001B', 'J00005+0005A',
+        'J00022+0022A', 'J00030+0030B']
+
+@pytest.fixture
+def wds(tmp_path):
+    wds_file = str(tmp_path / 'wds.fits')
+    wds_convert.convert(os.path.join(DATA_DIR, 'wds.dat'),
+        os.path.join(DATA_DIR, 'ReadMe')).write(wds_file, format='fits')
+    p_wds = WDS.WDS(wds_file, 6.0, False, use_snapshot=False)
+    p_wds.compile_filter('negative')
+    return p_wds
+
+def find_components(p_wds, idata, changes=None, previous=None):
+    p_args = argparse.Namespace(changes=changes, match_radius=None, verbose=False,
+        write_batch=2, filter='negative')
+    writer = dapu.MemoryTableWriter(None)
+    lists = process_wds_ids.find_components(p_args, idata, p_wds, writer, None, previous)
+    writer.close()
+    return writer.table(), lists
+
+def test_changes_keep_previous_targets_only(wds, tmp_path):
+    """Targets in unchanged WDS systems keep their components from the
+    previous output, but targets not in it are processed as usual"""
+    idata = Table({'Star': ['S1', 'S2', 'S3', 'S4', 'S5'],
+        'WDS': ['J00025-3230BC', 'J00030+3736', 'None', 'J00033-5513AB', 'J00033-5513']})
+    full, full_lists = find_components(wds, idata)
+    assert list(full['Star']) == ['S2', 'S2', 'S4', 'S4', 'S5', 'S5']
+
+    changes_file = str(tmp_path / 'changes.csv')
+    Table({'WDS': ['00030+3736'], 'Comp': ['AB'], 'Change': ['update'],
+        'Columns': ['mag1']}).write(changes_file, format='ascii.csv')
+    # S4 has a made up component, to show it is kept, and S5 is a new
+    # target that is missing from the previous output
+    previous = process_wds_ids.make_output_table(['S2', 'S4'], ['J00030+3736A', 'J00033-5513C'],
+        {'J00033-5513C': (1.0, 2.0)})
+    merged, merged_lists = find_components(wds, idata, changes_file, previous)
+    assert list(merged['Star']) == ['S2', 'S2', 'S4', 'S5', 'S5']
+    assert list(merged['WDS']) == list(full['WDS'][:2]) + ['J00033-5513C'] + list(full['WDS'][4:])
+    assert merged_lists == full_lists
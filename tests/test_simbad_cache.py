@@ -0,0 +1,52 @@
+"""Tests of the size accounting and eviction of SimbadCache."""
+
+import sqlite3
+from SimbadCache import SimbadCache
+
+def summed_bytes(cache):
+    return cache.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+def test_total_size_is_kept(tmp_path):
+    """The total kept by the triggers matches the sizes of the entries
+    through inserts, replacements, expiry and clearing"""
+    cache = SimbadCache(str(tmp_path / 'cache.sqlite'))
+    cache.put_many([('a', 'x'), ('b', 'y' * 100), ('c', list(range(50)))])
+    assert cache.total_bytes() == summed_bytes(cache) > 0
+    cache.put('b', 'short')
+    assert cache.total_bytes() == summed_bytes(cache)
+    cache.put('c', 'expired', ttl_days=-1)
+    assert cache.get('c') is None
+    assert cache.expired == 1
+    assert cache.total_bytes() == summed_bytes(cache)
+    cache.clear()
+    assert cache.total_bytes() == 0
+    cache.close()
+
+def test_total_size_of_existing_cache(tmp_path):
+    """A cache file written before the total was kept gets its total
+    from the entries already in it"""
+    cache_file = str(tmp_path / 'cache.sqlite')
+    connection = sqlite3.connect(cache_file)
+    with connection:
+        connection.execute('CREATE TABLE entries ('+
+            'key TEXT PRIMARY KEY, expires REAL, accessed REAL, size INTEGER, payload BLOB)')
+        connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+            [('a', 1e20, 1.0, 3, b'abc'), ('b', 1e20, 2.0, 4, b'abcd')])
+    connection.close()
+    cache = SimbadCache(cache_file)
+    assert cache.total_bytes() == 7
+    cache.close()
+    # Opening it again does not count the entries twice
+    cache = SimbadCache(cache_file)
+    assert cache.total_bytes() == 7
+    cache.close()
+
+def test_evict_least_recently_used(tmp_path):
+    cache = SimbadCache(str(tmp_path / 'cache.sqlite'), size_mb=0.001)
+    for num in range(20):
+        cache.put('key{}'.format(num), 'v' * 100)
+    assert cache.evictions > 0
+    assert cache.total_bytes() == summed_bytes(cache) <= cache.max_bytes
+    assert cache.get('key19') is not None
+    assert cache.get('key0') is None
+    cache.close()
@@ -0,0 +1,69 @@
+"""Tests of resuming from a SimbadJournal."""
+
+import os
+import pytest
+import fake_simbad
+import SimbadJournal
+import SimbadStarQuery
+from SimbadJournal import SimbadJournal as Journal
+from SimbadStarQuery import SimbadStarQuery as StarQuery
+
+FIELDS = ['main_id', 'ids']
+
+@pytest.fixture
+def fake(monkeypatch):
+    monkeypatch.setattr(SimbadStarQuery, 'SimbadClass', fake_simbad.FakeSimbad)
+    fake_simbad.reset()
+    yield fake_simbad
+    fake_simbad.reset()
+
+def test_record_cut_short(tmp_path):
+    """A record cut short at the end of the journal is dropped, and the
+    journal carries on from the last whole record"""
+    journal_file = str(tmp_path / 'out.journal')
+    journal = Journal(journal_file, FIELDS)
+    journal.add_results(['HD 1'], [(None, None)])
+    good_size = os.path.getsize(journal_file)
+    journal.add_results(['HD 2', 'HD 3'], [(None, None), (None, None)])
+    journal.close()
+    with open(journal_file, 'r+b') as afile:
+        afile.truncate(os.path.getsize(journal_file) - 3)
+
+    journal = Journal(journal_file, FIELDS, resume=True)
+    assert journal.records == [(SimbadJournal.RESULTS, ['HD 1'], [(None, None)])]
+    assert os.path.getsize(journal_file) == good_size
+    journal.close()
+
+def test_unreadable_journal(tmp_path, capsys):
+    journal_file = str(tmp_path / 'out.journal')
+    with open(journal_file, 'wb') as afile:
+        afile.write(b'not a journal')
+    journal = Journal(journal_file, FIELDS, resume=True)
+    journal.close()
+    assert journal.records == []
+    assert 'Could not read journal' in capsys.readouterr().out
+
+def test_resume_failed_requests(fake, tmp_path):
+    """Objects whose request failed are journaled, and are reported as
+    failed again when resuming rather than queried"""
+    journal_file = str(tmp_path / 'out.journal')
+    query_ids = ['HD {}'.format(num) for num in range(1, 7)]
+    fake.FAILING.add('HD 5')
+    sid = StarQuery(rate_limit=0)
+    sid.set_journal(Journal(journal_file, sid.simbad.get_votable_fields()))
+    sid.prefetch(query_ids, batch_size=3)
+    sid.journal.close()
+    assert fake.CALLS['query_objects'] == 2
+
+    fake.reset()
+    sid = StarQuery(rate_limit=0)
+    num_restored = sid.set_journal(Journal(journal_file, sid.simbad.get_votable_fields(),
+        resume=True))
+    assert num_restored == len(query_ids)
+    sid.prefetch(query_ids, batch_size=3)
+    sid.journal.close()
+    assert fake.CALLS['query_objects'] == 0
+    sid.fetch_result('HD 2')
+    assert sid.successfully_queried
+    sid.fetch_result('HD 5')
+    assert not sid.successfully_queried
@@ -0,0 +1,92 @@
+"""Tests of star_query.py against the stand-in Simbad service in fake_simbad."""
+
+import multiprocessing
+import os.path
+import sys
+import pytest
+from astropy.table import Table
+import fake_simbad
+import SimbadStarQuery
+import star_query
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NUM_STARS = 120
+
+@pytest.fixture
+def fake(monkeypatch):
+    monkeypatch.setattr(SimbadStarQuery, 'SimbadClass', fake_simbad.FakeSimbad)
+    fake_simbad.reset()
+    yield fake_simbad
+    fake_simbad.reset()
+
+def write_stars(tmp_path, num_stars=NUM_STARS):
+    input_file = str(tmp_path / 'stars.csv')
+    Table({'Star': ['HD {}'.format(num) for num in range(1, num_stars+1)]}).write(input_file,
+        format='ascii.csv')
+    return input_file
+
+def run_star_query(monkeypatch, tmp_path, name, *opts):
+    """Runs star_query.py on the stars in tmp_path, returning the
+    names of its FITS and HTML outputs"""
+    otable = str(tmp_path / (name + '.fits'))
+    ohtml = str(tmp_path / (name + '.html'))
+    monkeypatch.setattr(sys, 'argv', ['star_query.py', str(tmp_path / 'stars.csv'), ohtml, otable,
+        '--css', os.path.join(REPO_DIR, 'darkTable.css'),
+        '--aliases', os.path.join(REPO_DIR, 'simbad_star_alias.csv'),
+        '--no-cache', '--rate-limit', '0'] + list(opts))
+    star_query.main()
+    return otable, ohtml
+
+def read_bytes(file_name):
+    with open(file_name, 'rb') as afile:
+        return afile.read()
+
+def test_batched_queries(fake, monkeypatch, tmp_path):
+    """Batched requests give the same outputs as one query per star,
+    from far fewer requests"""
+    write_stars(tmp_path)
+    single_fits, single_html = run_star_query(monkeypatch, tmp_path, 'single', '--batch-size', '0')
+    assert fake.CALLS['query_object'] == NUM_STARS
+    assert fake.CALLS['query_objects'] == 0
+
+    fake.reset()
+    batch_fits, batch_html = run_star_query(monkeypatch, tmp_path, 'batch', '--batch-size', '50')
+    assert fake.CALLS['query_object'] == 0
+    assert fake.CALLS['query_objectids'] == 0
+    assert fake.CALLS['query_objects'] == 3
+
+    assert read_bytes(single_fits) == read_bytes(batch_fits)
+    assert read_bytes(single_html) == read_bytes(batch_html)
+    result = Table.read(batch_fits)
+    # HD 49 and HD 99 are unknown to Simbad
+    assert len(result) == NUM_STARS - 2
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+    reason='the worker processes only use the stand-in if forked')
+def test_workers(fake, monkeypatch, tmp_path):
+    """Worker processes give the same outputs as a single process, even
+    when the first batches have no stars Simbad finds"""
+    names = ['Unknown {}'.format(num) for num in range(30)] + ['HD {}'.format(num)
+        for num in range(1, NUM_STARS+1)]
+    Table({'Star': names}).write(str(tmp_path / 'stars.csv'), format='ascii.csv')
+    opts = ['--batch-size', '10', '--write-batch', '20']
+    single_fits, single_html = run_star_query(monkeypatch, tmp_path, 'single', *opts)
+    fake.reset()
+    workers_fits, workers_html = run_star_query(monkeypatch, tmp_path, 'workers', *opts,
+        '--workers', '3')
+    # The queries are all made by the workers, not the parent process
+    assert fake.CALLS['objects'] == 0
+    assert read_bytes(single_fits) == read_bytes(workers_fits)
+    assert read_bytes(single_html) == read_bytes(workers_html)
+
+def test_write_batch_widths(fake, monkeypatch, tmp_path):
+    """The string columns written a batch at a time are as wide as when
+    all the stars are written at once"""
+    names = ['HD {}'.format(num) for num in range(1, NUM_STARS+1)]
+    # A long name starting a later batch widens the columns of that batch
+    names[14] = 'HD 123456789'
+    Table({'Star': names}).write(str(tmp_path / 'stars.csv'), format='ascii.csv')
+    whole_fits, whole_html = run_star_query(monkeypatch, tmp_path, 'whole', '--write-batch', '0')
+    batch_fits, batch_html = run_star_query(monkeypatch, tmp_path, 'batch', '--write-batch', '7')
+    assert read_bytes(whole_fits) == read_bytes(batch_fits)
+    assert read_bytes(whole_html) == read_bytes(batch_html)
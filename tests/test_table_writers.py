@@ -0,0 +1,110 @@
+"""Tests of the DavesAstropyUtils TableWriter classes."""
+
+import numpy as np
+import pytest
+from astropy.table import Table, MaskedColumn, vstack
+import DavesAstropyUtils as dapu
+import process_wds_ids
+
+SUFFIXES = ['.fits', '.fits.gz', '.ecsv', '.csv']
+
+def read_back(file_name):
+    if '.fits' in file_name:
+        return Table.read(file_name, format='fits')
+    if file_name.endswith('.ecsv'):
+        return Table.read(file_name, format='ascii.ecsv')
+    return Table.read(file_name, format='ascii.csv')
+
+def test_table_writer_is_abstract():
+    with pytest.raises(TypeError):
+        dapu.TableWriter('unused.fits')
+
+@pytest.mark.parametrize('suffix', SUFFIXES)
+def test_empty_first_batch(tmp_path, suffix):
+    """An empty first batch, with float columns where later batches have
+    strings, must not fix the column types"""
+    output_file = str(tmp_path / ('out' + suffix))
+    empty = Table({'Star': np.array([], dtype=float), 'WDS': np.array([], dtype=float)})
+    batches = [Table({'Star': ['s1', 's22'], 'WDS': ['J00001+0001A', 'J00001+0001B']}),
+        Table({'Star': ['s333'], 'WDS': ['J00003-0003A']})]
+    with dapu.open_table_writer(output_file) as writer:
+        writer.write(empty)
+        for batch in batches:
+            writer.write(batch)
+    assert writer.num_rows == 3
+    result = read_back(output_file)
+    assert list(result['Star']) == ['s1', 's22', 's333']
+    assert list(result['WDS']) == ['J00001+0001A', 'J00001+0001B', 'J00003-0003A']
+
+@pytest.mark.parametrize('suffix', SUFFIXES)
+def test_only_empty_batches(tmp_path, suffix):
+    """If there are never any rows the columns are still written"""
+    output_file = str(tmp_path / ('out' + suffix))
+    with dapu.open_table_writer(output_file) as writer:
+        writer.write(process_wds_ids.make_output_table([], [], {}))
+    result = read_back(output_file)
+    assert len(result) == 0
+    assert result.colnames == ['Star', 'WDS', 'RA_wds_deg', 'DEC_wds_deg']
+
+def test_make_output_table_types():
+    otable = process_wds_ids.make_output_table([], [], {})
+    assert otable['Star'].dtype.kind == 'U'
+    assert otable['WDS'].dtype.kind == 'U'
+
+def test_no_batches(tmp_path):
+    output_file = str(tmp_path / 'out.csv')
+    writer = dapu.open_table_writer(output_file)
+    writer.close()
+    assert not (tmp_path / 'out.csv').exists()
+
+@pytest.mark.parametrize('suffix', ['.fits', '.fits.gz'])
+def test_fits_null_values(tmp_path, suffix):
+    """Masked integers keep their nulls whichever batch they are in,
+    including when a later batch has a different fill value, or widens
+    a string column so the earlier rows are rewritten"""
+    output_file = str(tmp_path / ('out' + suffix))
+    batches = [Table({'n': [1, 2], 's': ['a', 'b']}),
+        Table({'n': MaskedColumn([3, 4], mask=[True, False]), 's': ['c', 'd']}),
+        Table({'n': MaskedColumn([5, 6], mask=[False, True], fill_value=-1), 's': ['e', 'f']}),
+        Table({'n': [7, 8], 's': ['a much longer string', 'h']})]
+    with dapu.open_table_writer(output_file) as writer:
+        for batch in batches:
+            writer.write(batch)
+    result = read_back(output_file)
+    expected = vstack(batches)
+    assert list(np.ma.getmaskarray(result['n'])) == [False, False, True, False, False, True, False, False]
+    assert list(result['n'].compressed()) == list(expected['n'].compressed())
+    assert list(result['s']) == list(expected['s'])
+
+def test_memory_writer_tee(tmp_path):
+    output_file = str(tmp_path / 'out.ecsv')
+    writer = dapu.MemoryTableWriter(dapu.open_table_writer(output_file))
+    writer.write(Table({'a': np.array([], dtype=float)}))
+    writer.write(Table({'a': ['x']}))
+    writer.write(Table({'a': ['yy']}))
+    writer.close()
+    assert list(writer.table()['a']) == ['x', 'yy']
+    assert list(read_back(output_file)['a']) == ['x', 'yy']
+
+@pytest.mark.parametrize('suffix', ['.fits', '.fits.gz'])
+def test_widened_masked_strings(tmp_path, suffix):
+    """Masked strings in a batch narrower than those before it are still
+    written as blank, not as the cut short default fill value"""
+    output_file = str(tmp_path / ('out' + suffix))
+    with dapu.open_table_writer(output_file) as writer:
+        writer.write(Table({'n': [1, 2], 's': ['abc', 'de']}))
+        # Built a column at a time, as wds_convert.make_table does, which
+        # cuts the fill value of a one row string column short
+        batch = Table()
+        batch['n'] = [3]
+        batch['s'] = MaskedColumn(['x'], mask=[True])
+        writer.write(batch)
+    assert list(read_back(output_file)['s'].filled('')) == ['abc', 'de', '']
+
+def test_unknown_suffix_is_fits(tmp_path, capsys):
+    output_file = str(tmp_path / 'out.fit')
+    with dapu.open_table_writer(output_file) as writer:
+        writer.write(Table({'a': [1, 2]}))
+    assert isinstance(writer, dapu.FitsTableWriter)
+    assert 'Writing {} as FITS'.format(output_file) in capsys.readouterr().out
+    assert list(Table.read(output_file, format='fits')['a']) == [1, 2]
@@ -0,0 +1,142 @@
+"""Tests that wds_convert.py parses the ASCII WDS data as the astropy
+CDS reader does."""
+
+import os.path
+import sys
+import numpy as np
+import pytest
+from astropy.table import Table, vstack
+import wds_convert
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'wds')
+DATA_FILE = os.path.join(DATA_DIR, 'wds.dat')
+README_FILE = os.path.join(DATA_DIR, 'ReadMe')
+
+def assert_tables_equal(table, expected):
+    assert table.colnames == expected.colnames
+    for name in expected.colnames:
+        assert table[name].dtype == expected[name].dtype, name
+        assert hasattr(table[name], 'mask') == hasattr(expected[name], 'mask'), name
+        assert list(np.ma.getmaskarray(table[name])) == list(np.ma.getmaskarray(expected[name])), name
+        assert np.array_equal(np.ma.getdata(table[name]), np.ma.getdata(expected[name]),
+            equal_nan=(expected[name].dtype.kind == 'f')), name
+        assert table[name].unit == expected[name].unit, name
+
+def read_cds(data_file=DATA_FILE, readme_file=README_FILE):
+    return Table.read(data_file, format='ascii.cds', readme=readme_file)
+
+def test_fixture_has_blank_fields():
+    expected = read_cds()
+    # Blank fields in columns that are not marked '?' in the ReadMe
+    for name in ['Nobs', 'Comp', 'SpType', 'Notes', 'Disc', 'DM', 'RAh']:
+        assert np.any(np.ma.getmaskarray(expected[name])), name
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_numpy_parser_matches_cds_reader(jobs):
+    assert_tables_equal(wds_convert.convert(DATA_FILE, README_FILE, jobs=jobs), read_cds())
+
+def test_line_parser_matches_cds_reader():
+    with open(DATA_FILE, 'r') as data_file:
+        lines = data_file.readlines()
+    assert_tables_equal(wds_convert.read_lines(lines, README_FILE), read_cds())
+
+def test_fits_outputs_match(tmp_path):
+    expected_file = str(tmp_path / 'expected.fits')
+    numpy_file = str(tmp_path / 'numpy.fits')
+    cds_file = str(tmp_path / 'cds.fits')
+    streamed_file = str(tmp_path / 'streamed.fits')
+    read_cds().write(expected_file, format='fits')
+    wds_convert.convert(DATA_FILE, README_FILE).write(numpy_file, format='fits')
+    # Several chunks, so the streamed output is written more than once
+    wds_convert.convert_cds(DATA_FILE, README_FILE, cds_file, chunk_lines=3)
+    wds_convert.convert_fits(DATA_FILE, README_FILE, streamed_file, block_bytes=500)
+    with open(expected_file, 'rb') as expected:
+        expected_bytes = expected.read()
+    for output_file in [numpy_file, cds_file, streamed_file]:
+        with open(output_file, 'rb') as output:
+            assert output.read() == expected_bytes, output_file
+
+def test_dash_null_values(tmp_path):
+    """A '?=-' null value stands for one to four dashes"""
+    with open(README_FILE, 'r') as readme:
+        readme_text = readme.read()
+    readme_text = readme_text.replace('mag1    ? Magnitude', 'mag1    ?=- Magnitude')
+    assert '?=-' in readme_text
+    readme_file = str(tmp_path / 'ReadMe')
+    with open(readme_file, 'w') as readme:
+        readme.write(readme_text)
+    with open(DATA_FILE, 'r') as data_file:
+        lines = data_file.readlines()
+    for num, dashes in enumerate(['    -', '   --', '  ---', ' ----']):
+        lines[num] = lines[num][:58] + dashes + lines[num][63:]
+    data_file = str(tmp_path / 'wds.dat')
+    with open(data_file, 'w') as output:
+        output.write(''.join(lines))
+
+    expected = read_cds(data_file, readme_file)
+    assert list(np.ma.getmaskarray(expected['mag1'][:4])) == [True]*4
+    assert_tables_equal(wds_convert.convert(data_file, readme_file), expected)
+
+def run_convert(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['wds_convert.py', DATA_FILE, README_FILE] + list(args))
+    assert wds_convert.main(sys.argv) == 0
+
+def test_refresh_unchanged(tmp_path, monkeypatch):
+    """Refreshing with the same data finds no changes, although blank
+    strings are read back from the FITS file unmasked"""
+    fits_file = str(tmp_path / 'w.fits')
+    manifest_file = str(tmp_path / 'w.changes.csv')
+    run_convert(monkeypatch, fits_file)
+    with open(fits_file, 'rb') as fits:
+        fits_bytes = fits.read()
+    run_convert(monkeypatch, fits_file, '--refresh', fits_file)
+    assert len(Table.read(manifest_file, format='ascii.csv')) == 0
+    with open(fits_file, 'rb') as fits:
+        assert fits.read() == fits_bytes
+
+def edited_table(old):
+    """Returns a copy of the WDS table old with rows 1 and 3 updated,
+    row 2 deleted and a new row inserted at the start"""
+    new = old.copy()
+    new['mag1'][1] = 8.0
+    new['Notes'][3] = np.ma.masked
+    inserted = new[4:5].copy()
+    inserted['Comp'][0] = 'BD'
+    new.remove_row(2)
+    return vstack([inserted, new])
+
+@pytest.fixture
+def old_and_new(tmp_path):
+    """The fixture catalog as read back from FITS, and an edited version
+    of it as returned by convert"""
+    fits_file = str(tmp_path / 'w.fits')
+    wds_convert.convert(DATA_FILE, README_FILE).write(fits_file, format='fits')
+    old = wds_convert.read_converted(fits_file)
+    new = edited_table(wds_convert.convert(DATA_FILE, README_FILE))
+    return old, new
+
+def test_diff_tables(old_and_new):
+    old, new = old_and_new
+    changes = wds_convert.diff_tables(old, new)
+    assert list(changes['deleted']) == [2]
+    assert list(changes['inserted']) == [0]
+    assert list(changes['old_updated']) == [1, 3]
+    assert list(changes['new_updated']) == [2, 3]
+    assert changes['changed_columns'] == ['mag1', 'Notes']
+
+    manifest = wds_convert.make_manifest(old, new, changes)
+    assert [tuple(row) for row in manifest] == [('00025+1455', '', 'update', 'mag1'),
+        ('00030+0347', 'Aa,Ac', 'update', 'Notes'),
+        ('00030+2909', 'BD', 'insert', ''),
+        ('00030+3736', '', 'delete', '')]
+
+def test_apply_changes(old_and_new):
+    """The refreshed catalog has the rows of the new one, with the
+    unchanged and updated rows in their old order and new rows last"""
+    old, new = old_and_new
+    refreshed = wds_convert.apply_changes(old, new, wds_convert.diff_tables(old, new))
+    assert list(refreshed['WDS']) == list(old['WDS'][[0, 1, 3, 4, 5, 6, 7]]) + ['00030+2909']
+    assert refreshed['mag1'][1] == 8.0
+    assert refreshed['Comp'][-1] == 'BD'
+    changes = wds_convert.diff_tables(refreshed, new)
+    assert [len(changes[key]) for key in ['deleted', 'inserted', 'new_updated']] == [0, 0, 0]
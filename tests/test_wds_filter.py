@@ -0,0 +1,84 @@
+"""Tests of parsing and applying WDSFilter expressions."""
+
+import os.path
+import numpy as np
+import pytest
+import wds_convert
+from WDSFilter import WDSFilter
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'wds')
+
+MAX_MAG_DIFF = 6.0
+
+@pytest.fixture(scope='module')
+def wds_table():
+    return wds_convert.convert(os.path.join(DATA_DIR, 'wds.dat'),
+        os.path.join(DATA_DIR, 'ReadMe'))
+
+def selected(wds_table, expression):
+    """Returns the row numbers the expression selects"""
+    return list(np.flatnonzero(WDSFilter(expression).mask(wds_table, MAX_MAG_DIFF)))
+
+@pytest.mark.parametrize('expression, rows', [
+    ('physical', [3, 4, 5]),
+    ('physical notes', [3, 4, 5]),
+    ('positive', [3, 4, 5]),
+    ('unphysical', [0, 1]),
+    ('spectroscopic binaries', [3, 7]),
+    ('abc', [0, 1, 2, 3, 5, 6]),
+    ('negative', [2, 6]),
+    ('all', list(range(8))),
+    ('PHYSICAL', [3, 4, 5])])
+def test_named_filters(wds_table, expression, rows):
+    assert selected(wds_table, expression) == rows
+
+@pytest.mark.parametrize('expression, rows', [
+    # AND binds more tightly than OR
+    ('unphysical OR physical AND mag1 < 5', [0, 1, 4]),
+    ('unphysical OR (physical AND mag1 < 5)', [0, 1, 4]),
+    ('(unphysical OR physical) AND mag1 < 5', [4]),
+    # and NOT more tightly than AND
+    ('NOT physical', [0, 1, 2, 6, 7]),
+    ('NOT physical AND mag1 < 5', [7]),
+    ('NOT (physical AND mag1 < 5)', [0, 1, 2, 3, 5, 6, 7]),
+    ('not not physical', [3, 4, 5])])
+def test_precedence(wds_table, expression, rows):
+    assert selected(wds_table, expression) == rows
+
+@pytest.mark.parametrize('expression, rows', [
+    ('sep2 > 240', [5, 6]),
+    ('sep2 > 4 arcmin', [5, 6]),
+    ('sep2 > 240000 mas', [5, 6]),
+    ('sep2 between 0.06 and 0.07 deg', [1, 4]),
+    ('dmag > 10', [4, 5, 7]),
+    ('dmag > 10 mag', [4, 5, 7])])
+def test_units(wds_table, expression, rows):
+    assert selected(wds_table, expression) == rows
+
+@pytest.mark.parametrize('expression, rows', [
+    ("Notes == 'Z'", [3, 5]),
+    ("notes != 'Z'", [0, 1, 2, 4, 6, 7]),
+    ("Comp contains 'a,'", [3, 7])])
+def test_strings(wds_table, expression, rows):
+    assert selected(wds_table, expression) == rows
+
+@pytest.mark.parametrize('expression, message', [
+    ('mag1 <', 'unexpected end of expression'),
+    ('(physical', 'unexpected end of expression'),
+    ('physical physical', 'unexpected "physical"'),
+    ('mag1 < faint', 'expected a number, found "faint"'),
+    ('mag1 between 1 or 2', 'expected "and"'),
+    ("Notes < 'Z'", 'strings can only be compared with == or !='),
+    ('mag1 ~ 2', 'cannot parse "~ 2"'),
+    ('foo > 1', 'unknown column "foo"'),
+    ('Notes > 1', 'column "Notes" is not numeric'),
+    ("mag1 contains 'x'", 'column "mag1" is not a string column'),
+    ('Nobs > 2 arcmin', 'column "Nobs" has no unit'),
+    ('sep2 > 2 mag', 'column "sep2" is in arcsec, which cannot be converted to mag')])
+def test_errors(wds_table, expression, message):
+    """Errors in the expression are found when it is parsed, and errors
+    in its use of the columns when it is first applied, as
+    WDS.compile_filter does to an empty slice of the catalog"""
+    with pytest.raises(ValueError, match='Invalid filter') as err:
+        WDSFilter(expression).mask(wds_table[:0], MAX_MAG_DIFF)
+    assert message in str(err.value)
@@ -22,14 +22,33 @@
 #  
 """Convert ASCII WDS file into Fits format, correcting formatting errors. 
 
+The column layout is taken from the CDS ReadMe file, and the fixed-width
+data converted a column at a time with numpy. The astropy CDS reader,
+which gives identical results far more slowly, can be used instead.
+
+With --refresh an existing converted catalog is updated with only the
+rows that were inserted, updated or deleted in the new data, and a
+manifest of those changes is written for process_wds_ids.py --changes.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import gzip
+import io
+import itertools
 import os
 import os.path
+import re
 import sys
-from astropy.io import fits
+import tempfile
+import numpy as np
+from astropy import units as u
 from astropy.io import ascii
+from astropy.table import Table, Column, MaskedColumn, vstack
+import DavesAstropyUtils as dapu
 
 __author__     = "Dave Strickland"
 __copyright__  = "Copyright 2020, Dave Strickland"
@@ -39,17 +58,67 @@ __email__      =  "dave.strickland@gmail.com"
 __license__    = "GPLv3"
 __version__    = "0.2.0"
 
+# The data file name used for the main data file in the WDS ReadMe.
+WDS_TABLE_NAME = 'wds.dat'
+
+# Expected line length (130 characters plus newline)
+EXPECTED_LINE_LEN = 131
+
+# Number of lines of data parsed at a time by the CDS reader.
+CHUNK_LINES = 5000
+
+# Number of bytes of data parsed at a time by the numpy parser, when
+# running in a single process or in parallel.
+BLOCK_BYTES = 4*1024*1024
+PARALLEL_BLOCK_BYTES = 1024*1024
+
+# Exact powers of ten used to convert decimal digits to floats.
+POWERS_OF_TEN = np.array([float('1e{}'.format(k)) for k in range(16)])
+
+# A column description line in a CDS ReadMe, e.g.
+#   1- 10  A10   ---     WDS     WDS name (based on J2000 position)
+README_COL_RE = re.compile(r"""\s*
+    (?P<start>\d+\s*-)?\s*(?P<end>\d+)\s+
+    (?P<format>[\w.]+)\s+(?P<units>\S+)\s+(?P<name>\S+)
+    (\s+(?P<descr>\S.*))?""", re.VERBOSE)
+
+# The formats of CDS columns, e.g. A10, I4 or F5.2.
+README_FORMAT_RE = re.compile(r'(?P<letter>[AIFE])(?P<width>\d+)(\.\d+)?$')
+
+# Columns whose explanation starts with '?' may be blank or equal to an
+# optional null value, e.g. '?=-'. Matches the same limits and order
+# specifiers as the astropy CDS reader.
+README_NULL_RE = re.compile(r"""(?P<limits>[\[\]]\S*[\[\]])?\?
+    ((?P<equal>=)(?P<nullval>\S*))?(?P<order>[-+]?[=]?)
+    (\s*(?P<descr>\S.*))?""", re.VERBOSE)
+
 def command_line_opts():
     parser = argparse.ArgumentParser('Converts ASCII WDS table to Fits format')
 
     # required command line arguments
     parser.add_argument(dest='data_file', metavar='wds.dat',
-        help='Input ASCII WDS data file.')
+        help='Input ASCII WDS data file. May be gzipped.')
     parser.add_argument(dest='readme_file', metavar='ReadMe.WDS',
         help='Input ASCII WDS ReadMe file.')
     parser.add_argument(dest='fits_file', metavar='fits_output.fits',
         help='Output Fits-format file.')
 
+    parser.add_argument('-j', '--jobs',
+        dest='jobs', default=1, type=int, metavar='N',
+        help='Number of processes to parse the data with. (default: 1)')
+    parser.add_argument('--refresh',
+        dest='refresh', default=None, metavar='EXISTING_FITS',
+        help='Update an existing converted catalog with only the rows that'+
+            ' changed, writing a manifest of the changes. EXISTING_FITS may be'+
+            ' the same as the output file, which is left untouched if nothing changed.')
+    parser.add_argument('--manifest',
+        dest='manifest', default=None, metavar='CHANGES_CSV',
+        help='Name of the change manifest written by --refresh. (default: output'+
+            ' file name with the .fits suffix replaced by .changes.csv)')
+    parser.add_argument('--cds',
+        dest='use_cds', action='store_true',
+        help='Parse the data with the (much slower) astropy CDS reader'+
+            ' rather than the numpy parser. The output is identical.')
     parser.add_argument('-v', '--verbose',
         dest='verbose', action='store_true',
         help='Verbose output for each object processed. Useful for debugging purposes.')
@@ -57,13 +126,22 @@ def command_line_opts():
     args = parser.parse_args()
     return args
 
-def clean_data(idata_file, odata_file):
-    """Cleans up and corrects the ASCII WDS data.
+def open_data_file(idata_file):
+    """Opens the ASCII WDS data file for reading as text, decompressing
+    it on the fly if it is gzipped."""
+    if idata_file.endswith('.gz'):
+        return gzip.open(idata_file, 'rt')
+    return open(idata_file, 'r')
+
+def clean_lines(idata_file):
+    """Cleans up and corrects the ASCII WDS data, yielding one line
+    of cleaned data at a time.
     
-    At present it only handles known errors in the DEs column.
+    At present it only handles known errors in the DEs column. Lines
+    that can't be fixed are reported and left out. Only one line of the
+    input is held in memory at a time, and gzipped input is read directly.
     
-    :param idata_file: Name of input ASCII data file
-    :param odata_file: Name of output ASCII file cleaned data will be written to.
+    :param idata_file: Name of input ASCII data file, optionally gzipped
     """
     
     if not os.path.isfile(idata_file):
@@ -71,39 +149,655 @@ def clean_data(idata_file, odata_file):
         sys.exit(1)
     
     print('Cleaning up data from {}'.format(idata_file))    
-    with open(idata_file, 'r') as f:
-        raw_data = f.readlines()
-    
-    # Expected line length (130 characters plus newline)
-    expected_len = 131
     
     # Process data
-    clean_data = []
-    n_bad = 0
+    n_bad  = 0
+    n_fix  = 0
+    n_good = 0
+    idx    = -1
+    with open_data_file(idata_file) as f:
+        for idx, line in enumerate(f):
+            if not line.endswith('\n'):
+                # Last line without a trailing newline
+                line += '\n'
+            if len(line) != EXPECTED_LINE_LEN:
+                n_bad += 1
+                new_line, is_good = fix_line(line)
+                if is_good:
+                    n_fix += 1
+                    n_good += 1
+                    yield new_line
+                else:
+                    print('  Unexpected line was line {} (1-based)'.format(idx+1))
+            else:
+                n_good += 1
+                yield line
+    
+    print('  Read and processed {} lines from {}'.format(idx+1, idata_file))
+    print('  There were {} bad lines of data'.format(n_bad) +
+        ' of which we fixed {}.'.format(n_fix))
+    print('  Passed on {} lines of data'.format(n_good))
+    return
+
+def read_chunks(lines, readme_file, chunk_lines=CHUNK_LINES):
+    """Parses an iterable of cleaned WDS data lines, such as that
+    returned by clean_lines, chunk_lines lines at a time. Yields an
+    astropy Table for each chunk, so the raw text of at most one chunk
+    is held in memory.
+    """
+    lines = iter(lines)
+    chunk = list(itertools.islice(lines, chunk_lines))
+    while len(chunk) > 0:
+        yield read_lines(chunk, readme_file)
+        chunk = list(itertools.islice(lines, chunk_lines))
+    return
+
+def read_lines(lines, readme_file):
+    """Parses a list of cleaned WDS data lines into an astropy Table
+    using the CDS reader and the column descriptions in readme_file.
+    """
+    # Blank fields are masked, as they are by Table.read, which gives
+    # the reader this fill value unless told otherwise.
+    r = ascii.get_reader(ascii.Cds, readme=readme_file, fill_values=[('', '0')])
+    # The CDS reader finds the description of the data in the ReadMe
+    # by the name of the data file, which is wds.dat for the main data
+    # file. Since the lines don't come from a file we set it ourselves.
+    r.data.table_name = WDS_TABLE_NAME
+    r.data.start_line = 0
+    return r.read(lines)
+
+def convert_cds(idata_file, readme_file, fits_file, chunk_lines=CHUNK_LINES):
+    """Reads, cleans and parses the ASCII WDS data file with the astropy
+    CDS reader, writing it to fits_file. The data file is streamed
+    through clean_lines and read_chunks, and each chunk written out
+    with a DavesAstropyUtils.FitsTableWriter as soon as it is parsed,
+    so no more than one chunk of the table is held in memory.
+    
+    Returns the number of rows written.
+    """
+    writer = dapu.FitsTableWriter(fits_file)
+    for table in read_chunks(clean_lines(idata_file), readme_file, chunk_lines):
+        writer.write(table)
+    writer.close()
+    if writer.num_rows == 0:
+        print('Error: No data read from {}'.format(idata_file))
+        sys.exit(1)
+    return writer.num_rows
+
+def convert_cds_table(idata_file, readme_file, fits_file):
+    """Converts the ASCII WDS data file with convert_cds, returning the
+    astropy Table read back from a temporary file alongside fits_file,
+    in the form returned by read_converted."""
+    handle, temp_file = tempfile.mkstemp(suffix='.fits',
+        dir=os.path.dirname(os.path.abspath(fits_file)))
+    os.close(handle)
+    try:
+        convert_cds(idata_file, readme_file, temp_file)
+        table = read_converted(temp_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return table
+
+def read_readme(readme_file, table_name=WDS_TABLE_NAME):
+    """Reads the byte-by-byte description of the data file table_name
+    from a CDS ReadMe file.
+    
+    Returns a list with a dictionary for each column, giving its name,
+    the zero-based start and end byte offsets within a line, the
+    format letter ('A', 'I', 'F' or 'E'), the unit, the description,
+    and the null value if the column may be missing (None otherwise).
+    Units and descriptions are interpreted in the same way as the
+    astropy CDS reader.
+    """
+    if not os.path.isfile(readme_file):
+        print('Error: ReadMe file {} not found'.format(readme_file))
+        sys.exit(1)
+    
+    columns = []
+    in_table = False
+    n_delim  = 0
+    with open(readme_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not in_table:
+                match = re.match(r'Byte-by-byte Description of file: (?P<name>.+)$',
+                    line, re.IGNORECASE)
+                if match:
+                    names = [name for name in re.split('[, ]+', match.group('name')) if name]
+                    in_table = any(fnmatch.fnmatch(table_name, name) for name in names)
+                continue
+            
+            # Section delimiters surround the column headings, then the
+            # column descriptions.
+            if line.startswith('---') or line.startswith('==='):
+                n_delim += 1
+                if n_delim == 3:
+                    break
+                continue
+            if n_delim < 2:
+                continue
+            
+            match = README_COL_RE.match(line)
+            format_match = None
+            if match:
+                format_match = README_FORMAT_RE.match(match.group('format'))
+            if format_match is None:
+                # A continuation of the previous column's description
+                if len(columns) == 0:
+                    print('Error: Cannot parse line [{}] of {}'.format(line, readme_file))
+                    sys.exit(1)
+                columns[-1]['description'] = ' '.join([columns[-1]['description'],
+                    line]).strip()
+                continue
+            
+            col = {'name': match.group('name'),
+                'start':  int(re.sub(r'[-\s]', '', match.group('start') or match.group('end'))) - 1,
+                'end':    int(match.group('end')),
+                'format': format_match.group('letter'),
+                'unit':   None,
+                'description': (match.group('descr') or '').strip(),
+                'null':   None}
+            if match.group('units') != '---':
+                col['unit'] = u.Unit(match.group('units'), format='cds', parse_strict='warn')
+            null_match = README_NULL_RE.match(col['description'])
+            if null_match:
+                col['description'] = (null_match.group('descr') or '').strip()
+                col['null'] = null_match.group('nullval') or ''
+            columns.append(col)
+    
+    if len(columns) == 0:
+        print('Error: No description of {} found in {}'.format(table_name, readme_file))
+        sys.exit(1)
+    return columns
+
+def record_dtype(columns, record_len=EXPECTED_LINE_LEN):
+    """Returns a numpy structured dtype that views a line of the data
+    file, including its newline, as one byte string field per column.
+    """
+    return np.dtype({'names': [col['name'] for col in columns],
+        'formats': ['S{}'.format(col['end'] - col['start']) for col in columns],
+        'offsets': [col['start'] for col in columns],
+        'itemsize': record_len})
+
+def read_blocks(idata_file, block_bytes=BLOCK_BYTES):
+    """Reads the (optionally gzipped) ASCII WDS data file in blocks of
+    roughly block_bytes bytes, split at line boundaries.
+    
+    Yields tuples of the zero-based number of the first line in the
+    block and the block itself.
+    """
+    if not os.path.isfile(idata_file):
+        print('Error: Input file {} not found'.format(idata_file))
+        sys.exit(1)
+    
+    open_func = gzip.open if idata_file.endswith('.gz') else open
+    first_line = 0
+    rest = b''
+    with open_func(idata_file, 'rb') as f:
+        while True:
+            block = f.read(block_bytes)
+            if len(block) == 0:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:]
+            if cut == 0:
+                continue
+            yield first_line, block[:cut]
+            first_line += block.count(b'\n', 0, cut)
+    if len(rest) > 0:
+        # Last line without a trailing newline
+        yield first_line, rest + b'\n'
+    return
+
+def split_records(block, first_line, record_len=EXPECTED_LINE_LEN):
+    """Splits a block of whole lines of data into fixed length records.
+    
+    Lines of the wrong length are repaired with fix_line, and those that
+    can't be are reported using their line number in the original file
+    and left out. If every line has the right length, as is usual, the
+    records are a view of the block without any per-line work.
+    
+    Returns a tuple of an (N, record_len) uint8 array of records, the
+    number of lines in the block, and the numbers of bad and fixed lines.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n')) + 1
+    starts = np.append(0, ends[:-1])
+    lengths = ends - starts
+    good = lengths == record_len
+    n_lines = len(starts)
+    if np.all(good):
+        return data.reshape(n_lines, record_len), n_lines, 0, 0
+    
+    records = np.empty((n_lines, record_len), dtype=np.uint8)
+    records[good] = data[starts[good][:, np.newaxis] + np.arange(record_len)]
+    keep = good.copy()
     n_fix = 0
-    for idx, line in enumerate(raw_data):
-        line_len = len(line)
-        if line_len != expected_len:
-            n_bad += 1
-            new_line, is_good = fix_line(line)
-            if is_good:
-                clean_data.append(new_line)
-                n_fix += 1
+    for idx in np.flatnonzero(~good):
+        line = block[starts[idx]:ends[idx]].decode('latin-1')
+        new_line, is_good = fix_line(line)
+        if is_good:
+            records[idx] = np.frombuffer(new_line.encode('latin-1'), dtype=np.uint8)
+            keep[idx] = True
+            n_fix += 1
+        else:
+            print('  Unexpected line was line {} (1-based)'.format(first_line+idx+1))
+    return records[keep], n_lines, n_lines - np.count_nonzero(good), n_fix
+
+def null_values(col):
+    """Returns the list of values that mean a value is missing in the
+    column col, as described by read_readme, other than a blank field.
+    A null value of '-' stands for one to four dashes, as it does for
+    the astropy CDS reader."""
+    if col['null'] in [None, '']:
+        return []
+    if col['null'] == '-':
+        return ['-'*num for num in range(1, 5)]
+    return [col['null']]
+
+def parse_records(records, columns):
+    """Converts an (N, record_len) uint8 array of records into a
+    dictionary of numpy arrays, one per column, with missing values
+    represented in the same way as Table.read with the astropy CDS
+    reader: blank fields in any column, and the null values of columns
+    that have them, are masked.
+    
+    String columns are viewed in place through a structured dtype (see
+    record_dtype), and numeric columns converted by parse_numbers, so
+    each column is converted for all records at once.
+    
+    Returns a dictionary mapping each column name to a tuple of its
+    data and a boolean mask of missing values.
+    """
+    records = np.ascontiguousarray(records)
+    fields = records.view(record_dtype(columns, records.shape[1])).reshape(-1)
+    arrays = {}
+    for col in columns:
+        data = None
+        mask = None
+        nulls = null_values(col)
+        if col['format'] != 'A' and len(nulls) == 0:
+            data, mask = parse_numbers(records[:, col['start']:col['end']], col['format'])
+        
+        if data is None:
+            raw = np.char.strip(fields[col['name']])
+            # The CDS reader replaces missing values before converting
+            # them, blank fields by '0' and null values by NaN or 0.
+            blank = raw == b''
+            is_null = np.isin(raw, [null.encode('latin-1') for null in nulls])
+            raw = np.where(blank, b'0', raw)
+            raw = np.where(is_null, b'nan' if col['format'] in 'FE' else b'0', raw)
+            mask = blank | is_null
+            if col['format'] == 'A':
+                try:
+                    data = raw.astype('U{}'.format(raw.dtype.itemsize))
+                except UnicodeDecodeError:
+                    data = np.char.decode(raw, 'latin-1')
+            elif col['format'] == 'I':
+                data = raw.astype(np.int64)
             else:
-                print('  Unexpected line was line {} (1-based)'.format(idx+1))
+                data = raw.astype(np.float64)
+        arrays[col['name']] = (data, mask)
+    return arrays
+
+def parse_numbers(chars, format_letter):
+    """Converts an (N, width) uint8 array holding the characters of a
+    fixed-width column of plain decimal numbers, e.g. '-12' or ' 3.25',
+    into int64 ('I' format) or float64 values using arithmetic on whole
+    columns of digits rather than parsing each string.
+    
+    Floats are calculated as an integer divided by a power of ten, both
+    exact, so they are identical to those from parsing the strings.
+    
+    Returns a tuple of the values and a boolean mask of blank entries,
+    whose values are 0. Returns (None, None) if any entry isn't a
+    plain decimal number, e.g. one with an exponent, so that the caller
+    can fall back to converting the strings.
+    """
+    num_rows, width = chars.shape
+    if width > 15:
+        return None, None
+    
+    # Scan the character positions in turn, checking that every entry
+    # is an optional sign then digits with at most one decimal point,
+    # with nothing but spaces either side.
+    valid       = np.ones(num_rows, dtype=bool)
+    started     = np.zeros(num_rows, dtype=bool)
+    ended       = np.zeros(num_rows, dtype=bool)
+    any_digit   = np.zeros(num_rows, dtype=bool)
+    negative    = np.zeros(num_rows, dtype=bool)
+    after_point = np.zeros(num_rows, dtype=bool)
+    num_points  = np.zeros(num_rows, dtype=np.int64)
+    mantissa    = np.zeros(num_rows, dtype=np.int64)
+    decimals    = np.zeros(num_rows, dtype=np.int64)
+    for char in np.ascontiguousarray(chars.T).astype(np.int64):
+        is_digit = (char >= ord('0')) & (char <= ord('9'))
+        is_point = char == ord('.')
+        is_minus = char == ord('-')
+        is_sign  = is_minus | (char == ord('+'))
+        is_space = char == ord(' ')
+        valid &= is_digit | is_point | is_sign | is_space
+        valid &= ~(ended & ~is_space)
+        valid &= ~(is_sign & started)
+        ended |= started & is_space
+        started |= ~is_space
+        negative |= is_minus
+        any_digit |= is_digit
+        num_points += is_point
+        after_point |= is_point
+        mantissa = np.where(is_digit, 10*mantissa + char - ord('0'), mantissa)
+        decimals += is_digit & after_point
+    blank = ~started
+    valid &= any_digit & (num_points <= (0 if format_letter == 'I' else 1))
+    if not np.all(valid | blank):
+        return None, None
+    
+    if format_letter == 'I':
+        return np.where(negative, -mantissa, mantissa), blank
+    values = mantissa / POWERS_OF_TEN[decimals]
+    values = np.where(negative, -values, values)
+    return values, blank
+
+def make_table(array_list, columns):
+    """Concatenates the column arrays produced by parse_records for
+    successive blocks of data into a single astropy Table, with the
+    column types, units and descriptions used by the astropy CDS reader.
+    """
+    table = Table()
+    for col in columns:
+        data = np.concatenate([arrays[col['name']][0] for arrays in array_list])
+        mask = np.concatenate([arrays[col['name']][1] for arrays in array_list])
+        if col['format'] == 'A':
+            # String columns are only as wide as their longest value
+            width = 1
+            if len(data) > 0:
+                width = max(1, int(np.max(np.char.str_len(data))))
+            data = data.astype('U{}'.format(width))
+        if np.any(mask):
+            table[col['name']] = MaskedColumn(data, mask=mask, unit=col['unit'],
+                description=col['description'])
         else:
-            clean_data.append(line)
+            table[col['name']] = Column(data, unit=col['unit'],
+                description=col['description'])
+    return table
+
+def parse_block(first_line, block, columns):
+    """Splits and parses one block of data lines, as read by read_blocks.
     
-    print('  Read and processed {} lines from {}'.format(idx+1, idata_file))
+    Messages printed while repairing lines are captured and returned,
+    so that when blocks are parsed in parallel they can be printed in
+    the same order as the lines of the original file.
+    
+    Returns a tuple of the dictionary of column arrays (see
+    parse_records), a tuple of the numbers of lines, bad lines, fixed
+    lines and records in the block, and the messages.
+    """
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        records, n_lines, n_bad, n_fix = split_records(block, first_line)
+    return (parse_records(records, columns), (n_lines, n_bad, n_fix, len(records)),
+        messages.getvalue())
+
+def parse_blocks_parallel(blocks, columns, jobs):
+    """Runs parse_block on each (first_line, block) tuple from blocks in
+    a pool of jobs processes, yielding the results in the original
+    order. Blocks are read as the pool needs them, so no more than
+    2*jobs blocks are held in memory at once.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for first_line, block in blocks:
+            pending.append(executor.submit(parse_block, first_line, block, columns))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    return
+
+def parse_data(idata_file, columns, block_bytes=None, jobs=1):
+    """Reads, cleans and parses the ASCII WDS data file a block at a
+    time, yielding the dictionary of column arrays of each block (see
+    parse_records) in the order of the original file.
+    
+    Each block is converted with numpy operations on whole columns at
+    once (see split_records and parse_records). Only lines that need
+    repair are handled one by one.
+    
+    If jobs is greater than one the blocks are parsed in that many
+    processes. Any messages about bad lines are printed in the same
+    order as the lines of the original file.
+    """
+    if block_bytes is None:
+        block_bytes = BLOCK_BYTES if jobs <= 1 else PARALLEL_BLOCK_BYTES
+    print('Cleaning up data from {}'.format(idata_file))
+    
+    blocks = read_blocks(idata_file, block_bytes)
+    if jobs > 1:
+        results = parse_blocks_parallel(blocks, columns, jobs)
+    else:
+        results = (parse_block(first_line, block, columns) for first_line, block in blocks)
+    
+    n_lines = 0
+    n_bad   = 0
+    n_fix   = 0
+    n_good  = 0
+    for arrays, counts, messages in results:
+        print(messages, end='')
+        n_lines += counts[0]
+        n_bad   += counts[1]
+        n_fix   += counts[2]
+        n_good  += counts[3]
+        yield arrays
+    
+    print('  Read and processed {} lines from {}'.format(n_lines, idata_file))
     print('  There were {} bad lines of data'.format(n_bad) +
         ' of which we fixed {}.'.format(n_fix))
+    print('  Passed on {} lines of data'.format(n_good))
+    if n_good == 0:
+        print('Error: No data read from {}'.format(idata_file))
+        sys.exit(1)
+    return
+
+def convert(idata_file, readme_file, block_bytes=None, jobs=1):
+    """Reads, cleans and parses the ASCII WDS data file with parse_data,
+    returning an astropy Table identical to that produced by the CDS
+    reader. The column layout is read once from readme_file.
+    
+    The whole table is held in memory, as --refresh needs it to compare
+    with the existing catalog. convert_fits writes the table without
+    doing so.
+    """
+    columns = read_readme(readme_file)
+    return make_table(list(parse_data(idata_file, columns, block_bytes, jobs)), columns)
+
+def convert_fits(idata_file, readme_file, fits_file, block_bytes=None, jobs=1):
+    """Converts the ASCII WDS data file as convert does, writing the
+    table to fits_file. Each block is written out with a
+    DavesAstropyUtils.FitsTableWriter as soon as it is parsed, which
+    widens the string columns if later blocks need it, so no more than
+    a few blocks of the table are held in memory. The file is identical
+    to that written from the table returned by convert.
     
-    # Write clean data to file.
-    with open(odata_file, 'w') as f:
-        f.writelines(clean_data)
-    print('  Wrote {} lines of data to {}'.format(len(clean_data), odata_file))
+    Returns the number of rows written.
+    """
+    columns = read_readme(readme_file)
+    writer = dapu.FitsTableWriter(fits_file)
+    for arrays in parse_data(idata_file, columns, block_bytes, jobs):
+        writer.write(make_table([arrays], columns))
+    writer.close()
+    return writer.num_rows
+
+def read_converted(fits_file):
+    """Reads a WDS catalog previously written by this script, with
+    string columns as unicode and missing floats as NaN, as they are
+    in tables returned by convert.
+    """
+    table = Table.read(fits_file, format='fits', mask_invalid=False)
+    table.convert_bytestring_to_unicode()
+    return table
+
+def row_keys(table):
+    """Returns an array of strings identifying each row of a WDS table
+    by its WDS ID and component. Rows that share both are told apart
+    by their order within the table.
+    """
+    wds  = np.char.strip(np.ma.filled(table['WDS'], '').astype(str))
+    comp = np.char.strip(np.ma.filled(table['Comp'], '').astype(str))
+    num_rows = len(table)
+    occurrence = np.zeros(num_rows, dtype=int)
+    if num_rows > 0:
+        order = np.lexsort((comp, wds))
+        wds_sorted, comp_sorted = wds[order], comp[order]
+        first = np.append(True, (wds_sorted[1:] != wds_sorted[:-1]) |
+            (comp_sorted[1:] != comp_sorted[:-1]))
+        group_start = np.maximum.accumulate(np.where(first, np.arange(num_rows), 0))
+        occurrence[order] = np.arange(num_rows) - group_start
+    return np.char.add(np.char.add(wds, '|'),
+        np.char.add(np.char.add(comp, '|'), occurrence.astype(str)))
+
+def values_equal(old_col, new_col):
+    """Returns a boolean array that is True where two columns hold the
+    same value. Missing values (masked, or NaN) are all equal.
+
+    Strings are compared as FITS stores them, which is with masked
+    values as '' and without trailing spaces, as read_converted reads
+    them back unmasked.
+    """
+    if old_col.dtype.kind in 'SU' or new_col.dtype.kind in 'SU':
+        old_strs = np.char.rstrip(np.ma.filled(old_col, '').astype(str))
+        new_strs = np.char.rstrip(np.ma.filled(new_col, '').astype(str))
+        return old_strs == new_strs
+    old_mask = np.ma.getmaskarray(old_col)
+    new_mask = np.ma.getmaskarray(new_col)
+    old_data = np.ma.getdata(old_col)
+    new_data = np.ma.getdata(new_col)
+    if old_data.dtype.kind == 'f' or new_data.dtype.kind == 'f':
+        old_mask = old_mask | np.isnan(old_data.astype(float))
+        new_mask = new_mask | np.isnan(new_data.astype(float))
+    return (old_mask & new_mask) | (~old_mask & ~new_mask & (old_data == new_data))
+
+def diff_tables(old, new):
+    """Compares the rows of two versions of the WDS catalog, matching
+    them by row_keys.
+    
+    Returns a dictionary of index arrays: 'deleted' and 'inserted' give
+    the rows only in old or only in new, and 'old_updated' and
+    'new_updated' the matching rows of old and new whose values differ.
+    'changed_columns' gives the names of the columns that changed in
+    each updated row, separated by commas.
+    """
+    old_keys = row_keys(old)
+    new_keys = row_keys(new)
+    common, old_idx, new_idx = np.intersect1d(old_keys, new_keys,
+        assume_unique=True, return_indices=True)
+    
+    changed = np.zeros((len(common), len(new.colnames)), dtype=bool)
+    for col_num, name in enumerate(new.colnames):
+        changed[:, col_num] = ~values_equal(old[name][old_idx], new[name][new_idx])
+    updated = np.any(changed, axis=1)
+    changed_columns = [','.join(np.array(new.colnames)[row]) for row in changed[updated]]
+    
+    changes = {'deleted': np.flatnonzero(~np.isin(old_keys, common, assume_unique=True)),
+        'inserted':    np.flatnonzero(~np.isin(new_keys, common, assume_unique=True)),
+        'old_updated': old_idx[updated],
+        'new_updated': new_idx[updated],
+        'changed_columns': changed_columns}
+    return changes
+
+def apply_changes(old, new, changes):
+    """Returns the catalog old with the changes found by diff_tables
+    applied: updated rows are replaced in place, deleted rows removed
+    and inserted rows appended, so unchanged rows keep their order.
+    """
+    num_old = len(old)
+    source = np.arange(num_old)
+    source[changes['old_updated']] = num_old + changes['new_updated']
+    keep = np.ones(num_old, dtype=bool)
+    keep[changes['deleted']] = False
+    rows = np.concatenate([source[keep], num_old + changes['inserted']])
+    
+    combined = vstack([old[new.colnames], new], join_type='exact',
+        metadata_conflicts='silent')
+    refreshed = combined[rows]
+    for name in new.colnames:
+        refreshed[name].unit = new[name].unit
+        refreshed[name].description = new[name].description
+    return refreshed
+
+def make_manifest(old, new, changes):
+    """Returns a table listing every changed row of the WDS catalog by
+    WDS ID and component, with the type of change (insert, update or
+    delete) and the names of the columns that changed in updated rows.
+    """
+    wds_list  = []
+    comp_list = []
+    change_list  = []
+    columns_list = []
+    for change, table, rows in [('delete', old, changes['deleted']),
+        ('insert', new, changes['inserted']),
+        ('update', new, changes['new_updated'])]:
+        wds_list.extend(np.ma.filled(table['WDS'][rows], '').astype(str))
+        comp_list.extend(np.char.strip(np.ma.filled(table['Comp'][rows], '').astype(str)))
+        change_list.extend([change]*len(rows))
+    columns_list = ['']*(len(changes['deleted']) + len(changes['inserted']))
+    columns_list.extend(changes['changed_columns'])
+    
+    manifest = Table()
+    manifest['WDS'] = Column(np.array(wds_list, dtype=str),
+        description='WDS ID of changed component')
+    manifest['Comp'] = Column(np.array(comp_list, dtype=str),
+        description='Changed component')
+    manifest['Change'] = Column(np.array(change_list, dtype=str),
+        description='Type of change: insert, update or delete')
+    manifest['Columns'] = Column(np.array(columns_list, dtype=str),
+        description='Columns that changed in updated components')
+    if len(manifest) > 0:
+        manifest.sort(['WDS', 'Comp'])
+    return manifest
+
+def refresh_catalog(new, old_file, fits_file, manifest_file):
+    """Updates the converted WDS catalog old_file with the changes in
+    the newly converted table new, writing the result to fits_file and
+    a manifest of the changes to manifest_file.
+    
+    If nothing changed and fits_file is old_file it isn't rewritten,
+    so anything built from it (such as the WDS.py snapshot) stays current.
+    """
+    print('Comparing with existing catalog {}'.format(old_file))
+    old = read_converted(old_file)
+    if sorted(old.colnames) != sorted(new.colnames):
+        print('Warning: {} has different columns. Writing the whole catalog.'.format(old_file))
+        new.write(fits_file, format='fits', overwrite=True)
+        print('  Wrote {} rows of data to {}'.format(len(new), fits_file))
+        return
+    
+    changes = diff_tables(old, new)
+    manifest = make_manifest(old, new, changes)
+    print('  {} inserted, {} updated and {} deleted rows in {} WDS systems'.format(
+        len(changes['inserted']), len(changes['new_updated']), len(changes['deleted']),
+        len(np.unique(manifest['WDS']))))
+    manifest.write(manifest_file, format='ascii.csv', overwrite=True)
+    print('  Wrote manifest of {} changes to {}'.format(len(manifest), manifest_file))
+    
+    if len(manifest) == 0 and os.path.abspath(old_file) == os.path.abspath(fits_file):
+        print('  No changes, leaving {} as it is'.format(fits_file))
+        return
+    refreshed = apply_changes(old, new, changes)
+    refreshed.write(fits_file, format='fits', overwrite=True)
+    print('  Wrote {} rows of data to {}'.format(len(refreshed), fits_file))
     return
 
+def default_manifest_file(fits_file):
+    """Returns the default change manifest name for fits_file, e.g.
+    B_wds.changes.csv for B_wds.fits.gz"""
+    base = fits_file
+    for suffix in ['.gz', '.fits', '.fit']:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    return base + '.changes.csv'
+
 def fix_line(iline):
     """Attempts to fix the line assuming that that the DEs column may be
        missing or partially missing.
@@ -140,18 +834,30 @@ def main(args):
     p_args = command_line_opts()
     readme_file = p_args.readme_file
     data_file   = p_args.data_file
+    if p_args.use_cds and p_args.jobs > 1:
+        print('Warning: --jobs is ignored when using the CDS reader.')
     
-    # The CDS file parser expects the data file name to exactly match
-    # the names given in the README. This is wds.dat for the main data
-    # file. 
-    tmpdata_file = 'wds.dat'
-    if data_file == tmpdata_file:
-        print('Warning: over-writing original input file.')
-    clean_data(data_file, tmpdata_file)
-    
-    r     = ascii.get_reader(ascii.Cds, readme=readme_file)
-    table = r.read(tmpdata_file)
-    table.write(p_args.fits_file, format='fits', overwrite=True)
+    if p_args.refresh is None or not os.path.isfile(p_args.refresh):
+        if p_args.refresh is not None:
+            print('Warning: {} not found. Writing the whole catalog.'.format(p_args.refresh))
+        # The table is written out as it is parsed, so memory use stays
+        # flat whatever the size of the catalog
+        if p_args.use_cds:
+            num_rows = convert_cds(data_file, readme_file, p_args.fits_file)
+        else:
+            num_rows = convert_fits(data_file, readme_file, p_args.fits_file, jobs=p_args.jobs)
+        print('  Wrote {} rows of data to {}'.format(num_rows, p_args.fits_file))
+        return 0
+    
+    # Refreshing compares the whole of the new catalog with the old
+    if p_args.use_cds:
+        table = convert_cds_table(data_file, readme_file, p_args.fits_file)
+    else:
+        table = convert(data_file, readme_file, jobs=p_args.jobs)
+    manifest_file = p_args.manifest
+    if manifest_file is None:
+        manifest_file = default_manifest_file(p_args.fits_file)
+    refresh_catalog(table, p_args.refresh, p_args.fits_file, manifest_file)
     return 0
 
 if __name__ == '__main__':
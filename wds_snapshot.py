@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Builds a fast-loading snapshot of the cleaned Washington Double Star
+catalog for use by WDS.py and process_wds_ids.py.
+
+The snapshot is a directory of uncompressed numpy files, one per table
+column plus the WDS ID index, that WDS.py memory-maps instead of
+re-reading and cleaning the gzipped FITS catalog on every run. It only
+needs to be rebuilt when the FITS catalog changes.
+
+The Simbad compatible component IDs of every WDS system are also
+precomputed for each filter mode given with --filter (by default the
+negative, positive and abc modes of process_wds_ids.py).
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import sys
+import warnings
+from astropy.utils.exceptions import AstropyUserWarning
+import WDS
+
+__author__     = "Dave Strickland"
+__copyright__  = "Copyright 2026, Dave Strickland"
+__date__       = "2026/10/17"
+__deprecated__ = False
+__email__      = "dave.strickland@gmail.com"
+__license__    = "GPLv3"
+__version__    = "0.2.0"
+
+def command_line_opts():
+    p_wds = 'data/WDS/B_wds.fits.gz'
+    p_filters = ['negative', 'positive', 'abc']
+    p_magdiff = 6.0
+
+    parser = argparse.ArgumentParser('Builds a snapshot of the cleaned WDS catalog')
+    parser.add_argument(dest='wdsfile', nargs='?', default=p_wds,
+        metavar='B_wds.fits.gz',
+        help='Location of WDS data table. (default: {})'.format(p_wds))
+    parser.add_argument('-s', '--snapshot',
+        dest='snapshot', default=None, metavar='SNAPSHOT_DIR',
+        help='Directory to write the snapshot to. (default: WDS data table'+
+            ' name with the .fits.gz suffix replaced by .snapshot)')
+    parser.add_argument('--filter',
+        dest='filters', action='append', default=None, metavar='FILTER',
+        help='Filter mode or expression to precompute component IDs for.'+
+            ' May be given more than once. (default: {})'.format(' '.join(p_filters)))
+    parser.add_argument('--magdiff',
+        dest='magdiff', default=p_magdiff, type=float,
+        help='Maximum magnitude difference allowed in negative filter. Must match'+
+            ' that used by process_wds_ids.py. (default: {})'.format(p_magdiff))
+    parser.add_argument('-v', '--verbose',
+        dest='verbose', action='store_true',
+        help='Verbose output. Useful for debugging purposes.')
+
+    args = parser.parse_args()
+    if args.filters is None:
+        args.filters = p_filters
+    return args
+
+def main():
+    warnings.simplefilter('ignore', category=AstropyUserWarning, append=True)
+    p_args = command_line_opts()
+
+    # Always read the FITS catalog, ignoring any existing snapshot.
+    p_wds = WDS.WDS(p_args.wdsfile, p_args.magdiff, p_args.verbose,
+        snapshot_dir=p_args.snapshot, use_snapshot=False)
+    try:
+        for p_filter in p_args.filters:
+            p_wds.compile_filter(p_filter)
+    except ValueError as err:
+        print('Error: {}'.format(err))
+        sys.exit(2)
+    p_wds.write_snapshot(p_args.filters)
+    return
+
+if __name__ == "__main__":
+    main()